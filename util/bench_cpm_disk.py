@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Benchmarks for cpm_disk.py operations, with a regression baseline.
+
+Times create, add, list, extract, delete and write-boot for each format
+at several directory fill levels and file-size mixes. Every operation
+runs against a real image file the way the command line does: open the
+image, do the work, commit.
+
+Fill levels (directory entries in use when the operation runs):
+  empty - only the batch of files being added or deleted
+  half  - half the directory entries
+  full  - every directory entry, or as many as the data area holds
+
+add times adding the last batch of files to an image holding the rest;
+delete times deleting that batch; extract reads every file on the disk.
+
+Usage:
+  bench_cpm_disk.py run -o results.json                 # Run everything
+  bench_cpm_disk.py run --formats hd1k --levels full    # Run a subset
+  bench_cpm_disk.py run --compare baseline.json         # Run, then check for regressions
+  bench_cpm_disk.py compare baseline.json results.json  # Compare two result files
+
+compare exits with status 1 when any benchmark is slower than the
+baseline by more than --threshold (default 25%), or when a benchmark in
+the baseline has no result. Differences below --min-delta seconds are
+treated as noise. run --compare checks only the benchmarks it ran.
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import cpm_disk
+
+FORMATS = ('sssd', 'sssd-noskew', 'hd1k', 'combo')
+LEVELS = ('empty', 'half', 'full')
+OPERATIONS = ('create', 'add', 'list', 'extract', 'delete', 'write-boot')
+# File sizes cycled through to fill a disk
+MIXES = {
+    'small': (128, 700, 1500, 3000),
+    'mixed': (256, 3000, 9000, 40000),
+}
+RESULTS_VERSION = 1
+
+
+def plan_files(diskdef, mix, entries, max_files=None, seed=0):
+    """Return (name, data) pairs that fill up to entries directory entries.
+
+    Files are sized from mix in turn, stopping before the directory
+    entries or the data area would overflow.
+    """
+    rng = random.Random(seed)
+    per_entry = diskdef.blocks_per_entry * diskdef.blocksize
+    free_blocks = diskdef.dsm + 1 - diskdef.dir_blocks
+    files = []
+    used_entries = used_blocks = 0
+    while max_files is None or len(files) < max_files:
+        size = mix[len(files) % len(mix)]
+        need_entries = max(1, math.ceil(size / per_entry))
+        need_blocks = math.ceil(size / diskdef.blocksize)
+        if used_entries + need_entries > entries or used_blocks + need_blocks > free_blocks:
+            break
+        files.append((f"F{len(files):04d}.DAT", rng.randbytes(size)))
+        used_entries += need_entries
+        used_blocks += need_blocks
+    return files
+
+
+class Scenario:
+    """One format, file mix and fill level, with its prepared image."""
+
+    def __init__(self, fmt, mix, level, batch, workdir):
+        self.fmt = fmt
+        self.mix = mix
+        self.level = level
+        self.diskdef = cpm_disk.format_diskdefs(fmt, image_size(fmt))[0]
+        maxdir = self.diskdef.maxdir
+        if level == 'empty':
+            files = plan_files(self.diskdef, MIXES[mix], maxdir, max_files=batch)
+        else:
+            files = plan_files(self.diskdef, MIXES[mix], maxdir // 2 if level == 'half' else maxdir)
+        self.files = files
+        self.batch = files[-batch:]
+        self.prefill = files[:-batch]
+
+        self.work = os.path.join(workdir, 'work.img')
+        # Images holding the prefill only and every file, copied for each run
+        self.prefilled = os.path.join(workdir, f"{fmt}-{mix}-{level}-prefill.img")
+        self.filled = os.path.join(workdir, f"{fmt}-{mix}-{level}-filled.img")
+        self._build(self.prefilled, self.prefill)
+        shutil.copyfile(self.prefilled, self.filled)
+        self._add(self.filled, self.batch)
+        with cpm_disk.open_image(self.filled) as image:
+            self.entries = maxdir - cpm_disk.get_disk_object(image, fmt).directory.free_count
+
+    def _build(self, path, files):
+        cpm_disk.create_image_file(path, 'sssd' if self.fmt == 'sssd-noskew' else self.fmt)
+        self._add(path, files)
+
+    def _add(self, path, files):
+        with cpm_disk.open_image(path, writable=True) as image:
+            disk = cpm_disk.get_disk_object(image, self.fmt)
+            if not disk.add_files(files, quiet=True):
+                raise ValueError(f"{self.fmt}/{self.mix}/{self.level}: files do not fit")
+            image.commit()
+
+    def prepare(self, op):
+        """Put the image op starts from in place (not timed)."""
+        if op == 'create':
+            if os.path.exists(self.work):
+                os.unlink(self.work)
+        elif op == 'add':
+            shutil.copyfile(self.prefilled, self.work)
+        else:
+            shutil.copyfile(self.filled, self.work)
+
+    def run(self, op):
+        """Perform op once against the work image."""
+        if op == 'create':
+            self._build(self.work, [])
+            return
+        writable = op in ('add', 'delete', 'write-boot')
+        with cpm_disk.open_image(self.work, writable=writable) as image:
+            disk = cpm_disk.get_disk_object(image, self.fmt)
+            if op == 'add':
+                if not disk.add_files(self.batch, quiet=True):
+                    raise ValueError(f"{self.fmt}/{self.mix}/{self.level}: add failed")
+            elif op == 'list':
+                disk.list_files()
+            elif op == 'extract':
+                for user, name in disk.list_files():
+                    disk.extract_file(name, user)
+            elif op == 'delete':
+                for name, _ in self.batch:
+                    disk.delete_file(name)
+            elif op == 'write-boot':
+                disk.write_boot_area(b'\xc3' * self.diskdef.boot_size)
+            image.commit()
+
+
+def image_size(fmt):
+    return {'combo': cpm_disk.HD1K_COMBO_SIZE, 'hd1k': cpm_disk.HD1K_SINGLE_SIZE}.get(
+        fmt, cpm_disk.SSSD_SIZE)
+
+
+def run_benchmarks(formats=FORMATS, mixes=tuple(MIXES), levels=LEVELS, ops=OPERATIONS,
+                   repeat=3, batch=8, log=sys.stderr):
+    """Run every selected benchmark and return the results document.
+
+    Each benchmark is timed repeat times and the fastest run is kept.
+    """
+    if batch < 1 or repeat < 1:
+        raise ValueError("batch and repeat must be at least 1")
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='bench_cpm_disk-') as workdir, \
+            open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for fmt in formats:
+            for mix in mixes:
+                for level in levels:
+                    scenario = Scenario(fmt, mix, level, batch, workdir)
+                    for op in ops:
+                        times = []
+                        for _ in range(repeat):
+                            scenario.prepare(op)
+                            start = time.perf_counter()
+                            scenario.run(op)
+                            times.append(time.perf_counter() - start)
+                        key = f"{fmt}/{mix}/{level}/{op}"
+                        results[key] = {'seconds': min(times), 'files': len(scenario.files),
+                                        'entries': scenario.entries}
+                        if log:
+                            print(f"{key:<32} {min(times) * 1000:9.2f} ms", file=log)
+                    for path in (scenario.prefilled, scenario.filled):
+                        os.unlink(path)
+    return {'version': RESULTS_VERSION, 'python': platform.python_version(),
+            'repeat': repeat, 'batch': batch, 'results': results}
+
+
+def compare_results(baseline, current, threshold=0.25, min_delta=0.001):
+    """Compare two results documents.
+
+    Returns:
+        (rows, regressions, missing): one (key, baseline seconds, current
+        seconds) row per benchmark present in both, the keys of rows
+        slower than the baseline by more than threshold (a fraction) and
+        by at least min_delta seconds, and the baseline keys that have no
+        current result.
+    """
+    rows = []
+    regressions = []
+    missing = []
+    for key, base in baseline['results'].items():
+        cur = current['results'].get(key)
+        if cur is None:
+            missing.append(key)
+            continue
+        rows.append((key, base['seconds'], cur['seconds']))
+        delta = cur['seconds'] - base['seconds']
+        if delta > base['seconds'] * threshold and delta >= min_delta:
+            regressions.append(key)
+    return rows, regressions, missing
+
+
+def report_comparison(baseline, current, threshold, min_delta):
+    """Print a comparison table; returns the exit status."""
+    rows, regressions, missing = compare_results(baseline, current, threshold, min_delta)
+    print(f"{'Benchmark':<32} {'Baseline':>11} {'Current':>11} {'Change':>8}")
+    print("-" * 65)
+    for key, base, cur in rows:
+        change = (cur - base) / base * 100 if base else 0.0
+        flag = "  REGRESSION" if key in regressions else ""
+        print(f"{key:<32} {base * 1000:8.2f} ms {cur * 1000:8.2f} ms {change:+7.1f}%{flag}")
+    for key in missing:
+        base = baseline['results'][key]['seconds']
+        print(f"{key:<32} {base * 1000:8.2f} ms {'-':>11} {'':>8}  MISSING")
+    if regressions or missing:
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than baseline by more than {threshold:.0%}")
+        if missing:
+            print(f"{len(missing)} baseline benchmark(s) missing from the results")
+        return 1
+    print(f"No regressions beyond {threshold:.0%} in {len(rows)} benchmark(s)")
+    return 0
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_threshold(value):
+    """Parse a threshold given as a fraction (0.25) or a percentage (25%)."""
+    if value.endswith('%'):
+        return float(value[:-1]) / 100
+    return float(value)
+
+
+def cmd_run(args):
+    results = run_benchmarks(args.formats, args.mixes, args.levels, args.ops,
+                             args.repeat, args.batch)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print(f"Wrote {len(results['results'])} results to {args.output}")
+    if args.compare:
+        baseline = load_results(args.compare)
+        # Only the benchmarks this run selected can be missing from it
+        selected = {f"{fmt}/{mix}/{level}/{op}" for fmt in args.formats for mix in args.mixes
+                    for level in args.levels for op in args.ops}
+        baseline['results'] = {key: value for key, value in baseline['results'].items()
+                               if key in selected}
+        return report_comparison(baseline, results, args.threshold, args.min_delta)
+    return 0
+
+
+def cmd_compare(args):
+    return report_comparison(load_results(args.baseline), load_results(args.results),
+                             args.threshold, args.min_delta)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for cpm_disk.py',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run benchmarks')
+    run_parser.add_argument('--formats', nargs='+', choices=FORMATS, default=FORMATS,
+                            help='Formats to benchmark (default: all)')
+    run_parser.add_argument('--mixes', nargs='+', choices=tuple(MIXES), default=tuple(MIXES),
+                            help='File-size mixes (default: all)')
+    run_parser.add_argument('--levels', nargs='+', choices=LEVELS, default=LEVELS,
+                            help='Directory fill levels (default: all)')
+    run_parser.add_argument('--ops', nargs='+', choices=OPERATIONS, default=OPERATIONS,
+                            help='Operations to time (default: all)')
+    run_parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs per benchmark; the fastest is kept (default 3)')
+    run_parser.add_argument('--batch', type=int, default=8,
+                            help='Files added or deleted per run (default 8)')
+    run_parser.add_argument('--output', '-o', default=None,
+                            help='Write results to this JSON file')
+    run_parser.add_argument('--compare', metavar='BASELINE', default=None,
+                            help='Compare against a baseline results file')
+    run_parser.set_defaults(func=cmd_run)
+
+    compare_parser = subparsers.add_parser('compare', help='Compare results against a baseline')
+    compare_parser.add_argument('baseline', help='Baseline results file')
+    compare_parser.add_argument('results', help='Results file to check')
+    compare_parser.set_defaults(func=cmd_compare)
+
+    for subparser in (run_parser, compare_parser):
+        subparser.add_argument('--threshold', type=parse_threshold, default=0.25,
+                               help='Allowed slowdown, e.g. 0.25 or 25%% (default 25%%)')
+        subparser.add_argument('--min-delta', type=float, default=0.001,
+                               help='Ignore slowdowns smaller than this many seconds (default 0.001)')
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
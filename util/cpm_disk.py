@@ -10,10 +10,31 @@ Usage:
   cpm_disk.py create <disk.img>                    # Create 8MB hd1k disk
   cpm_disk.py create --sssd <disk.img>             # Create 250KB SSSD floppy
   cpm_disk.py create --combo <disk.img>            # Create 51MB combo disk
+  cpm_disk.py format <disk.img>                    # Erase all files (directories only)
   cpm_disk.py add <disk.img> <file1.com> [...]     # Add files to disk
   cpm_disk.py list <disk.img>                      # List files in disk
   cpm_disk.py delete <disk.img> <file1.com> [...]  # Delete files from disk
   cpm_disk.py extract <disk.img> <file1.com> [...] # Extract files from disk
+  cpm_disk.py sync <disk.img> <dir>                # Mirror dir into disk (changed files only)
+  cpm_disk.py extract -o - <disk.img> <file.txt>   # Extract a file to stdout
+  cpm_disk.py extract --all-users <disk.img> '*.*' # Extract everything, by user area
+  cpm_disk.py list --slice 2 <combo.img>          # List files in slice 2 of a combo disk
+  cpm_disk.py list --all-slices <combo.img>        # List every slice (in parallel)
+  cpm_disk.py slice-export <combo.img> 2 <s2.img>  # Slice 2 as a standalone hd1k image
+  cpm_disk.py slice-import <s2.img> <combo.img> 3  # Overwrite slice 3 with an hd1k image
+  cpm_disk.py slice-copy <a.img> 0 <b.img> 5       # Copy slice 0 of a.img over slice 5 of b.img
+  cpm_disk.py verify [--json] <disk.img>           # Check every slice for damage
+  cpm_disk.py compact <disk.img>                   # Make every file contiguous
+  cpm_disk.py diff <a.img> <b.img>                 # Files added, removed or changed
+  cpm_disk.py serve                                # Keep images open for cpm_disk_client.py
+  cpm_disk.py compress <disk.img> <disk.cpmz>      # Pack into a seekable compressed container
+  cpm_disk.py decompress <disk.cpmz> <disk.img>    # Expand a container (or IMD) to a raw image
+  cpm_disk.py dedup-store add <store> <disk.img>... # Store blocks once, write disk.img.recipe
+  cpm_disk.py build-many <manifest.toml>           # Build many images in parallel
+  cpm_disk.py overlay create <base.img> <job.cow>  # Copy-on-write overlay on a base image
+  cpm_disk.py overlay commit|discard <job.cow>     # Fold changes into the base, or drop them
+  cpm_disk.py from-cfg -o out examples/compiler.cfg # One image per cpmemu drive
+  cpm_disk.py list <disk.img.recipe>               # Recipes open like images (read-only)
   cpm_disk.py read-boot <disk.img> <output.bin>       # Read boot area to file
   cpm_disk.py write-boot <disk.img> <input.bin>       # Write to sector 0
   cpm_disk.py write-boot <disk.img> <input.bin> 4     # Write starting at sector 4
@@ -25,12 +46,116 @@ Boot area sizes:
   - combo: 16384 bytes (after 1MB prefix)
 
 Format is auto-detected for existing disks based on file size.
+
+verify checks the directory of every filesystem in an image (all combo
+slices unless --slice is given) for block pointers past DSM or into the
+directory, blocks used twice, blocks held by unreadable entries, missing
+or repeated extents and RC values that disagree with the block count.
+It exits with status 1 if anything is found.
+
+compact moves blocks so the files sit one after another in directory
+order with the free space at the end. Data is copied into free blocks
+and committed before the directory is pointed at it, so stopping part
+way leaves a consistent (partly compacted) image.
+
+diff compares two images of the same format and size chunk by chunk,
+narrows the differences down to allocation blocks and maps them through
+both directories to added (+), removed (-), modified (M) and moved (R)
+files and boot-area changes. It exits with status 1 if the images
+differ, like diff(1).
+
+ImageDisk (.IMD) files are recognized by their signature and work with
+every command. Sectors are read straight from the file in ascending ID
+order, and changes are written back with uniform sectors compressed.
+
+Compressed containers (compress) hold fixed-size zlib or lzma chunks and
+a chunk index, with uniform chunks elided. Every command opens them in
+place: only the chunks a command touches are decompressed.
+
+An overlay (overlay create) records only the 4KB granules written
+through it, in a sparse file that names a read-only base image. Every
+command opens an overlay like an image, so a test job can start from a
+shared pristine base without copying it; overlay commit folds the
+changes into the base (other overlays on that base then refuse to
+open) and overlay discard empties the overlay again.
+
+build-many reads a TOML manifest of [[image]] tables, each with an
+output path, a format, an optional boot image and a list of file globs
+(plus optional user, sys and slice); [defaults] applies to every image.
+A formatted template is built once per format and boot image and cloned
+for each image with copy_file_range. Images are built on a process pool:
+
+  [defaults]
+  format = "hd1k"
+  boot = "boot/hd1k.bin"
+
+  [[image]]
+  output = "out/mbasic.img"
+  files = ["bin/MBASIC.COM", "tests/mbasic/*.BAS"]
+
+from-cfg reads a cpmemu .cfg file (with ${VAR} expansion) and writes
+<cfg>_<drive>.img for each drive_X directory; mapped files and the
+program go on drive A. Text-mode files are converted \\n -> \\r\\n and
+^Z-padded as they are streamed in, like cpmemu reads them.
+
+--stats (or CPM_DISK_STATS=1) prints directory, block, sector and byte
+counters and the time spent opening, reading directories and committing;
+--profile FILE writes a cProfile profile of the command.
+
+dedup-store splits images into CP/M allocation blocks and keeps each
+unique block once, in a directory or a sqlite file, plus a small recipe
+per image. Read-only commands take a recipe in place of an image and
+fetch only the blocks they need; decompress rebuilds the image.
+
+The add, list, delete and extract commands take --slice N or --all-slices
+to address the six 8MB slices of a combo disk (default: slice 0).
+
+Other formats are described cpmtools-style (seclen, tracks, sectrk,
+blocksize, maxdir, skew, boottrk, offset) and selected with --diskdef NAME;
+kpii and osborne1 are built in, and --diskdefs FILE loads more.
+
+Directory decoding and wildcard matching are vectorized when NumPy is
+installed; without it the same work is done in pure Python.
 """
 
 import sys
 import os
+import time
+import hashlib
+import heapq
+import json
+import lzma
+import mmap
+import re
+import signal
+import socket
+import sqlite3
+import stat
 import struct
+import tempfile
+import threading
+import zlib
 import argparse
+import asyncio
+import base64
+import bisect
+import contextlib
+import cProfile
+import errno
+import glob
+import functools
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:     # optional: directory decoding falls back to pure Python
+    np = None
+
+try:
+    import tomllib
+except ImportError:     # Python < 3.11: build-many is unavailable
+    tomllib = None
 
 # Common CP/M constants
 SECTOR_SIZE_HD = 512    # hd1k sector size
@@ -77,6 +202,271 @@ def generate_skew_table(sectors, skew):
 # Pre-computed skew table for ibm-3740
 SSSD_SKEW_TABLE = generate_skew_table(SSSD_SECTORS_PER_TRACK, SSSD_SKEW)
 
+
+class DiskDef(namedtuple('DiskDef', 'name seclen tracks sectrk blocksize maxdir skew boottrk offset skewtab')):
+    """A disk format, as described by a cpmtools diskdefs entry.
+
+    seclen, tracks, sectrk, blocksize, maxdir, skew and boottrk have their
+    cpmtools meanings. offset is the byte offset of track 0 in the image
+    (e.g. a RomWBW slice) and skewtab an explicit logical-to-physical
+    sector table, or None to derive one from skew. The Disk Parameter
+    Block values CP/M would use (SPT, BSH, EXM, DSM, DRM, OFF) are derived
+    as properties.
+    """
+
+    __slots__ = ()
+
+    @property
+    def spt(self):
+        """SPT: 128-byte records per track."""
+        return self.sectrk * self.seclen // 128
+
+    @property
+    def bsh(self):
+        """BSH: block shift, log2(blocksize / 128)."""
+        return (self.blocksize // 128).bit_length() - 1
+
+    @property
+    def dsm(self):
+        """DSM: highest block number."""
+        return (self.tracks - self.boottrk) * self.track_size // self.blocksize - 1
+
+    @property
+    def drm(self):
+        """DRM: highest directory entry number."""
+        return self.maxdir - 1
+
+    @property
+    def exm(self):
+        """EXM: logical 16KB extents per directory entry, minus one."""
+        if self.dsm < 256:
+            return self.blocksize // 1024 - 1
+        return self.blocksize // 2048 - 1
+
+    @property
+    def ptr16(self):
+        """True when block pointers are 16-bit (DSM > 255)."""
+        return self.dsm > 255
+
+    @property
+    def blocks_per_entry(self):
+        """Block pointers per directory entry."""
+        return 8 if self.ptr16 else 16
+
+    @property
+    def dir_blocks(self):
+        """Blocks reserved for the directory (AL0/AL1)."""
+        return (self.maxdir * 32 + self.blocksize - 1) // self.blocksize
+
+    @property
+    def track_size(self):
+        return self.sectrk * self.seclen
+
+    @property
+    def boot_size(self):
+        """Bytes in the reserved (OFF) tracks."""
+        return self.boottrk * self.track_size
+
+    @property
+    def data_start(self):
+        """Image offset of block 0."""
+        return self.offset + self.boot_size
+
+    @property
+    def image_size(self):
+        return self.offset + self.tracks * self.track_size
+
+    def sector_table(self):
+        """Logical-to-physical sector table for the data tracks."""
+        if self.skewtab:
+            return list(self.skewtab)
+        return generate_skew_table(self.sectrk, self.skew)
+
+
+@functools.lru_cache(maxsize=None)
+def block_run_table(diskdef):
+    """Precompute where each allocation block of a format lives in the image.
+
+    Returns a tuple indexed by block number, covering DSM + 1 blocks (and
+    at least 256 for formats with 8-bit pointers, so any pointer byte can
+    be looked up). Each element is a tuple of (offset, length) runs
+    covering the block's records in order. Physically adjacent records are
+    merged, so an unskewed block is a single run.
+    """
+    d = diskdef
+    count = d.dsm + 1 if d.ptr16 else max(d.dsm + 1, 256)
+    block_size = d.blocksize
+    table = d.sector_table()
+    if table == list(range(d.sectrk)):
+        return tuple(((d.data_start + b * block_size, block_size),) for b in range(count))
+
+    runs_by_block = []
+    for block in range(count):
+        runs = []
+        for pos in range(block * block_size, (block + 1) * block_size, 128):
+            sector, within = divmod(pos, d.seclen)
+            track, logical = divmod(sector, d.sectrk)
+            offset = (d.offset + ((d.boottrk + track) * d.sectrk + table[logical]) * d.seclen
+                      + within)
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1][1] += 128
+            else:
+                runs.append([offset, 128])
+        runs_by_block.append(tuple((start, length) for start, length in runs))
+    return tuple(runs_by_block)
+
+
+def parse_size(value, track_size=None):
+    """Parse a diskdefs size such as 1024, 16K, 1M or (given track_size) 2T."""
+    units = {'K': 1024, 'M': 1048576}
+    if track_size:
+        units['T'] = track_size
+    scale = units.get(value[-1:].upper())
+    return int(value[:-1]) * scale if scale else int(value, 0)
+
+
+def parse_diskdefs(text):
+    """Parse cpmtools diskdefs text into a dict mapping name to DiskDef.
+
+    Understands seclen, tracks, sectrk, blocksize, maxdir, skew, skewtab,
+    boottrk and offset; other keywords (os, datasect, libdsk:format, ...)
+    are accepted and ignored. Raises ValueError on malformed input.
+    """
+    defs = {}
+    fields = None
+    for lineno, line in enumerate(text.splitlines(), 1):
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+        key = words[0]
+        if key == 'diskdef':
+            if fields is not None or len(words) != 2:
+                raise ValueError(f"diskdefs line {lineno}: unexpected diskdef")
+            fields = {'name': words[1]}
+        elif fields is None:
+            raise ValueError(f"diskdefs line {lineno}: {key} outside a diskdef")
+        elif key == 'end':
+            defs[fields['name']] = make_diskdef(fields, lineno)
+            fields = None
+        elif len(words) != 2:
+            raise ValueError(f"diskdefs line {lineno}: {key} needs one value")
+        else:
+            fields[key] = words[1]
+    if fields is not None:
+        raise ValueError(f"diskdefs: {fields['name']} has no end")
+    return defs
+
+
+def make_diskdef(fields, lineno=0):
+    """Build a DiskDef from one diskdefs entry's keyword values."""
+    name = fields['name']
+    try:
+        values = {key: int(fields[key], 0)
+                  for key in ('seclen', 'tracks', 'sectrk', 'blocksize', 'maxdir')}
+        skew = int(fields.get('skew', '0'), 0)
+        boottrk = int(fields.get('boottrk', '0'), 0)
+        offset = parse_size(fields.get('offset', '0'), values['sectrk'] * values['seclen'])
+        skewtab = fields.get('skewtab')
+        if skewtab is not None:
+            skewtab = tuple(int(s, 0) for s in skewtab.split(','))
+    except KeyError as e:
+        raise ValueError(f"diskdefs line {lineno}: {name} lacks {e.args[0]}") from None
+
+    block_size = values['blocksize']
+    if block_size < 1024 or block_size & (block_size - 1):
+        raise ValueError(f"diskdefs line {lineno}: {name} blocksize must be a power of two >= 1024")
+    if values['seclen'] % 128:
+        raise ValueError(f"diskdefs line {lineno}: {name} seclen must be a multiple of 128")
+    if skewtab is not None and sorted(skewtab) != list(range(values['sectrk'])):
+        raise ValueError(f"diskdefs line {lineno}: {name} skewtab must list each sector once")
+    diskdef = DiskDef(name=name, skew=skew, boottrk=boottrk, offset=offset,
+                      skewtab=skewtab, **values)
+    if block_size == 1024 and diskdef.dsm > 255:
+        raise ValueError(f"diskdefs line {lineno}: {name} has {diskdef.dsm + 1} blocks; "
+                         f"1024-byte blocks allow at most 256 (use a larger blocksize)")
+    return diskdef
+
+
+# Built-in formats in cpmtools diskdefs syntax. More can be loaded with
+# --diskdefs (for example cpmtools' own /etc/cpmtools/diskdefs).
+BUILTIN_DISKDEFS = """
+diskdef ibm-3740
+  seclen 128
+  tracks 77
+  sectrk 26
+  blocksize 1024
+  maxdir 64
+  skew 6
+  boottrk 2
+  os 2.2
+end
+
+diskdef ibm-3740-noskew
+  seclen 128
+  tracks 77
+  sectrk 26
+  blocksize 1024
+  maxdir 64
+  skew 0
+  boottrk 2
+  os 2.2
+end
+
+diskdef wbw_hd1k
+  seclen 512
+  tracks 1024
+  sectrk 16
+  blocksize 4096
+  maxdir 1024
+  skew 0
+  boottrk 2
+  os 2.2
+end
+
+diskdef kpii
+  seclen 512
+  tracks 40
+  sectrk 10
+  blocksize 1024
+  maxdir 64
+  skew 0
+  boottrk 1
+  os 2.2
+end
+
+diskdef osborne1
+  seclen 1024
+  tracks 40
+  sectrk 5
+  blocksize 1024
+  maxdir 64
+  skew 2
+  boottrk 3
+  os 2.2
+end
+"""
+
+DISKDEFS = parse_diskdefs(BUILTIN_DISKDEFS)
+
+
+def lookup_diskdef(name):
+    """Return the DiskDef registered under name, or raise ValueError."""
+    try:
+        return DISKDEFS[name]
+    except KeyError:
+        raise ValueError(f"unknown disk format: {name} (known: {', '.join(sorted(DISKDEFS))})") from None
+
+
+def load_diskdefs(path):
+    """Add the formats in a cpmtools diskdefs file to DISKDEFS."""
+    with open(path) as f:
+        DISKDEFS.update(parse_diskdefs(f.read()))
+
+
+def sssd_block_runs(use_skew):
+    """Block run table (see block_run_table()) of the ibm-3740 format."""
+    return block_run_table(DISKDEFS['ibm-3740' if use_skew else 'ibm-3740-noskew'])
+
 # hd1k format constants
 BLOCK_SIZE = 4096  # 4KB blocks for hd1k
 
@@ -107,6 +497,24 @@ def cpm_pattern_to_83(pattern):
     return name + ext
 
 
+def cpm_filename_to_83(filename):
+    """Convert a host filename to the 11-character CP/M directory form.
+
+    E.g., "test.com" -> "TEST    COM", "README" -> "README     "
+    """
+    name, ext = os.path.splitext(filename.upper())
+    name = name[:8].ljust(8)
+    ext = ext[1:4].ljust(3) if ext else '   '
+    return name + ext
+
+
+def cpm_83_to_filename(name_83):
+    """Convert an 11-character CP/M directory name back to NAME.EXT form."""
+    name = name_83[:8].rstrip()
+    ext = name_83[8:].rstrip()
+    return f"{name}.{ext}" if ext else name
+
+
 def cpm_match(pattern_83, filename_83):
     """Match a filename against a CP/M pattern (both in 8.3 format).
 
@@ -119,12 +527,48 @@ def cpm_match(pattern_83, filename_83):
             return False
     return True
 
+
+def cpm_match_many(pattern_83, names_83):
+    """Match a list of 8.3 filenames against one CP/M pattern.
+
+    Returns a list of booleans, one per name. With NumPy the names are
+    compared as an (n, 11) byte array in a single operation.
+    """
+    if np is None or len(pattern_83) != 11 or not names_83:
+        return [cpm_match(pattern_83, name) for name in names_83]
+    try:
+        pattern = np.frombuffer(pattern_83.encode('ascii'), dtype=np.uint8)
+        names = np.frombuffer(''.join(names_83).encode('ascii'), dtype=np.uint8)
+    except UnicodeEncodeError:
+        return [cpm_match(pattern_83, name) for name in names_83]
+    if len(names) != 11 * len(names_83):
+        return [cpm_match(pattern_83, name) for name in names_83]
+    names = names.reshape(-1, 11)
+    hits = ((names == pattern) | (pattern == ord('?'))).all(axis=1)
+    return hits.tolist()
+
+
+def dir_entry_dtype(ptr16):
+    """NumPy structured dtype for one 32-byte CP/M directory entry."""
+    return np.dtype([
+        ('user', 'u1'),
+        ('name', 'u1', (8,)),
+        ('ext', 'u1', (3,)),
+        ('ex', 'u1'),
+        ('s1', 'u1'),
+        ('s2', 'u1'),
+        ('rc', 'u1'),
+        ('al', '<u2', (8,)) if ptr16 else ('al', 'u1', (16,)),
+    ])
+
 # Disk format sizes
 HD1K_SINGLE_SIZE = 8388608      # 8 MB
 HD1K_SLICE_SIZE = 8388608       # 8 MB per slice
 HD1K_MBR_PREFIX = 1048576       # 1 MB MBR prefix for combo
 HD1K_COMBO_SLICES = 6           # 6 slices in combo disk
 HD1K_COMBO_SIZE = HD1K_MBR_PREFIX + (HD1K_COMBO_SLICES * HD1K_SLICE_SIZE)  # ~51 MB
+HD1K_BOOT_SIZE = 2 * 16 * 512   # 2 boot tracks x 16 sectors x 512 bytes
+HD1K_DIR_SIZE = 1024 * 32       # 1024 directory entries x 32 bytes
 
 
 def format_sssd_disk(data):
@@ -138,10 +582,8 @@ def format_sssd_disk(data):
 
     Directory starts at track 2, sector 0
     """
-    dir_size = SSSD_DIR_ENTRIES * 32
-
-    # Initialize directory with 0xE5 (CP/M empty directory marker)
-    data[SSSD_DIR_START:SSSD_DIR_START + dir_size] = bytes([0xE5] * dir_size)
+    for offset, region in directory_regions('sssd'):
+        data[offset:offset + len(region)] = region
 
 
 def create_sssd_disk():
@@ -166,17 +608,77 @@ def format_hd1k_slice(data, offset):
 
     Directory starts at track 2, sector 0
     """
-    BOOT_TRACKS = 2
-    SECTORS_PER_TRACK = 16
-    DIR_ENTRIES = 1024
-    DIR_ENTRY_SIZE = 32
-
-    dir_offset = offset + (BOOT_TRACKS * SECTORS_PER_TRACK * SECTOR_SIZE_HD)
-    dir_size = DIR_ENTRIES * DIR_ENTRY_SIZE
+    dir_offset = offset + HD1K_BOOT_SIZE
 
     # Initialize directory with 0xE5 (CP/M empty directory marker)
-    if dir_offset + dir_size <= len(data):
-        data[dir_offset:dir_offset + dir_size] = bytes([0xE5] * dir_size)
+    if dir_offset + HD1K_DIR_SIZE <= len(data):
+        data[dir_offset:dir_offset + HD1K_DIR_SIZE] = b'\xE5' * HD1K_DIR_SIZE
+
+
+def directory_regions(fmt, slices=(0,)):
+    """Return the (offset, bytes) writes that initialize a format's directories.
+
+    The directory is filled with 0xE5 (CP/M empty directory marker). For
+    SSSD the whole directory track is filled, which covers the directory
+    sectors with or without skew. For combo disks one region is returned
+    per slice in slices. Any other fmt is looked up in DISKDEFS and its
+    directory blocks are filled.
+    """
+    if fmt in ('sssd', 'sssd-noskew'):
+        track_size = SSSD_SECTORS_PER_TRACK * SSSD_SECTOR_SIZE
+        return [(SSSD_DIR_START, b'\xE5' * track_size)]
+    dir_start = HD1K_BOOT_SIZE
+    dir_data = b'\xE5' * HD1K_DIR_SIZE
+    if fmt == 'hd1k':
+        return [(dir_start, dir_data)]
+    if fmt == 'combo':
+        return [(HD1K_MBR_PREFIX + n * HD1K_SLICE_SIZE + dir_start, dir_data) for n in slices]
+
+    diskdef = lookup_diskdef(fmt)
+    runs = block_run_table(diskdef)
+    return [(start, b'\xE5' * length)
+            for block in range(diskdef.dir_blocks) for start, length in runs[block]]
+
+
+def create_image_file(path, fmt, preallocate=False):
+    """Create a formatted disk image file without writing its empty space.
+
+    The file is truncated to size, which leaves it sparse where the
+    filesystem supports that, and only the MBR (combo) and directory
+    regions are written. The result is byte-for-byte the image that
+    create_sssd_disk()/create_hd1k_disk() would build in memory.
+
+    Args:
+        path: Image file to create (overwritten if it exists)
+        fmt: 'sssd', 'hd1k', 'combo' or a DISKDEFS name
+        preallocate: Reserve the space with posix_fallocate() where available
+
+    Returns:
+        Size of the image in bytes
+    """
+    if fmt == 'sssd':
+        size = SSSD_SIZE
+        regions = directory_regions(fmt)
+    elif fmt == 'combo':
+        size = HD1K_COMBO_SIZE
+        mbr = bytearray(512)
+        create_combo_mbr(mbr)
+        regions = [(0, mbr)] + directory_regions(fmt, range(HD1K_COMBO_SLICES))
+    elif fmt == 'hd1k':
+        size = HD1K_SINGLE_SIZE
+        regions = directory_regions(fmt)
+    else:
+        size = lookup_diskdef(fmt).image_size
+        regions = directory_regions(fmt)
+
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        if preallocate and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, size)
+        for offset, region in regions:
+            f.seek(offset)
+            f.write(region)
+    return size
 
 
 def create_combo_mbr(data):
@@ -210,6 +712,11 @@ def create_combo_mbr(data):
     data[0x1FF] = 0xAA
 
 
+def combo_slice_count(disk_data):
+    """Number of whole 8MB slices after the MBR prefix of a combo image."""
+    return max(0, (len(disk_data) - HD1K_MBR_PREFIX) // HD1K_SLICE_SIZE)
+
+
 def create_hd1k_disk(combo=False):
     """Create a new formatted hd1k disk image in memory.
 
@@ -242,905 +749,1608 @@ def create_hd1k_disk(combo=False):
     return data
 
 
-class SssdDisk:
-    """SSSD (ibm-3740) 8" floppy disk format."""
+class DiskStats:
+    """Counters for one command, printed by --stats or CPM_DISK_STATS=1.
 
-    SECTOR_SIZE = SSSD_SECTOR_SIZE  # 128 bytes
-    SECTORS_PER_TRACK = SSSD_SECTORS_PER_TRACK  # 26
-    BLOCK_SIZE = SSSD_BLOCK_SIZE  # 1024 bytes
-    DIR_ENTRIES = SSSD_DIR_ENTRIES  # 64
-    BOOT_TRACKS = SSSD_BOOT_TRACKS  # 2
-    DIR_START = SSSD_DIR_START  # 6656 bytes (2 tracks * 26 sectors * 128 bytes)
-    # With 1KB blocks and DSM < 256, block pointers are 8-bit
-    # EXM = 0 for 1KB blocks, so each extent = 128 records = 16KB = 16 blocks
-    BLOCKS_PER_EXTENT = 16
-    RECORDS_PER_BLOCK = BLOCK_SIZE // 128  # 8 records per 1KB block
+    The disk and image classes update the module-level STATS object, which
+    is None unless stats are enabled, so with stats off each counted
+    operation costs one global lookup. Work done in --all-slices worker
+    processes is not counted.
+    """
 
-    def __init__(self, disk_data, use_skew=True):
-        self.data = disk_data
-        self.use_skew = use_skew
-        self.skew_table = SSSD_SKEW_TABLE if use_skew else list(range(self.SECTORS_PER_TRACK))
+    COUNTERS = (
+        ('dir_entries_scanned', 'directory entries scanned'),
+        ('dir_entries_written', 'directory entries written'),
+        ('blocks_read', 'blocks read'),
+        ('blocks_written', 'blocks written'),
+        ('sectors_read', 'sectors read'),
+        ('sectors_written', 'sectors written'),
+        ('bytes_read', 'bytes read from image'),
+        ('bytes_written', 'bytes written to image'),
+        ('bytes_copied', 'bytes copied to host files'),
+        ('commit_bytes', 'bytes committed to image file'),
+        ('alloc_searches', 'allocation searches'),
+    )
 
-    def logical_sector_to_offset(self, track, logical_sector):
-        """Convert (track, logical_sector) to byte offset in disk image.
+    def __init__(self):
+        for name, _ in self.COUNTERS:
+            setattr(self, name, 0)
+        self.phases = {}  # phase name -> seconds
+        self.started = time.perf_counter()
 
-        Boot tracks (0-1) have no skew; data tracks use skew table.
-        logical_sector is 0-indexed.
-        """
-        if track < self.BOOT_TRACKS:
-            # Boot tracks: no skew
-            physical_sector = logical_sector
-        else:
-            # Data tracks: apply skew
-            physical_sector = self.skew_table[logical_sector]
-        return (track * self.SECTORS_PER_TRACK + physical_sector) * self.SECTOR_SIZE
+    def count_read(self, blocks, nbytes, seclen):
+        self.blocks_read += blocks
+        self.sectors_read += -(-nbytes // seclen)
+        self.bytes_read += nbytes
 
-    def read_sector(self, track, logical_sector):
-        """Read a single logical sector from disk."""
-        offset = self.logical_sector_to_offset(track, logical_sector)
-        return bytes(self.data[offset:offset + self.SECTOR_SIZE])
+    def count_write(self, blocks, nbytes, seclen):
+        self.blocks_written += blocks
+        self.sectors_written += -(-nbytes // seclen)
+        self.bytes_written += nbytes
 
-    def write_sector(self, track, logical_sector, data):
-        """Write a single logical sector to disk."""
-        offset = self.logical_sector_to_offset(track, logical_sector)
-        self.data[offset:offset + self.SECTOR_SIZE] = data[:self.SECTOR_SIZE]
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the wall time of a with-block to the named phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
 
-    def read_block(self, block_num):
-        """Read a block (8 consecutive logical sectors) from the data area.
+    def report(self, command, file=None):
+        """Print the counters and phase times."""
+        file = file or sys.stderr
+        total = time.perf_counter() - self.started
+        print(f"--- stats: {command} ({total * 1000:.2f} ms) ---", file=file)
+        for name, label in self.COUNTERS:
+            print(f"  {label:<32} {getattr(self, name):>12}", file=file)
+        for name, seconds in self.phases.items():
+            print(f"  {'time in ' + name:<32} {seconds * 1000:>9.2f} ms", file=file)
 
-        Block 0 starts at track BOOT_TRACKS (directory), blocks are numbered
-        sequentially across tracks.
-        """
-        # Calculate starting track and sector for this block
-        sectors_per_block = self.BLOCK_SIZE // self.SECTOR_SIZE  # 8
-        logical_sector_num = block_num * sectors_per_block
-        track = self.BOOT_TRACKS + (logical_sector_num // self.SECTORS_PER_TRACK)
-        sector_in_track = logical_sector_num % self.SECTORS_PER_TRACK
-
-        result = bytearray()
-        for i in range(sectors_per_block):
-            current_sector = sector_in_track + i
-            current_track = track
-            # Handle track crossing
-            while current_sector >= self.SECTORS_PER_TRACK:
-                current_sector -= self.SECTORS_PER_TRACK
-                current_track += 1
-            result.extend(self.read_sector(current_track, current_sector))
-        return bytes(result)
 
-    def write_block(self, block_num, data):
-        """Write a block (8 consecutive logical sectors) to the data area."""
-        sectors_per_block = self.BLOCK_SIZE // self.SECTOR_SIZE  # 8
-        logical_sector_num = block_num * sectors_per_block
-        track = self.BOOT_TRACKS + (logical_sector_num // self.SECTORS_PER_TRACK)
-        sector_in_track = logical_sector_num % self.SECTORS_PER_TRACK
-
-        # Pad data to block size if needed
-        if len(data) < self.BLOCK_SIZE:
-            data = data + bytes([0x1A] * (self.BLOCK_SIZE - len(data)))
-
-        for i in range(sectors_per_block):
-            current_sector = sector_in_track + i
-            current_track = track
-            while current_sector >= self.SECTORS_PER_TRACK:
-                current_sector -= self.SECTORS_PER_TRACK
-                current_track += 1
-            sector_data = data[i * self.SECTOR_SIZE:(i + 1) * self.SECTOR_SIZE]
-            self.write_sector(current_track, current_sector, sector_data)
+STATS = None  # the active DiskStats, or None when stats are off
 
-    def read_dir_entry(self, entry_num):
-        """Read a directory entry (32 bytes) by entry number."""
-        # Directory entries are in blocks 0 and 1
-        # Each block = 1024 bytes = 32 entries
-        block_num = entry_num // 32
-        offset_in_block = (entry_num % 32) * 32
-        block_data = self.read_block(block_num)
-        return bytes(block_data[offset_in_block:offset_in_block + 32])
 
-    def write_dir_entry(self, entry_num, entry_data):
-        """Write a directory entry (32 bytes) by entry number."""
-        block_num = entry_num // 32
-        offset_in_block = (entry_num % 32) * 32
-        block_data = bytearray(self.read_block(block_num))
-        block_data[offset_in_block:offset_in_block + 32] = entry_data[:32]
-        self.write_block(block_num, bytes(block_data))
+def enable_stats():
+    """Start counting into a fresh DiskStats and return it."""
+    global STATS
+    STATS = DiskStats()
+    return STATS
 
-    def find_free_dir_entry(self):
-        """Find first free directory entry (starts with 0xE5).
 
-        Returns entry number (not byte offset).
-        """
-        for i in range(self.DIR_ENTRIES):
-            entry = self.read_dir_entry(i)
-            if entry[0] == 0xE5:
-                return i
-        return None
+def stats_phase(name):
+    """Context manager timing a phase when stats are on (a no-op otherwise)."""
+    return STATS.phase(name) if STATS is not None else contextlib.nullcontext()
 
-    def find_max_block(self):
-        """Find highest used block number in directory.
 
-        Returns the highest block number in use, or 1 if no files exist
-        (blocks 0-1 are reserved for directory with 1KB blocks, 64 entries).
-        """
-        # Directory = 64 entries * 32 bytes = 2048 bytes = 2 blocks
-        max_block = 1
-        for i in range(self.DIR_ENTRIES):
-            entry = self.read_dir_entry(i)
-            if entry[0] != 0xE5:
-                # 8-bit block pointers for SSSD (16 pointers per entry)
-                for j in range(16):
-                    block = entry[16 + j]
-                    if block > max_block and block != 0:
-                        max_block = block
-        return max_block
+# Granularity used to coalesce dirty ranges before writing them back.
+# Matches the hd1k sector size so directory updates flush whole sectors.
+DIRTY_GRANULE = 512
 
-    def add_file(self, filename, file_data, sys_attr=False, user=0):
-        """Add a file to the disk image.
 
-        Args:
-            filename: Name of the file to add
-            file_data: File contents as bytes
-            sys_attr: If True, set the SYS attribute
-            user: User number (0-15)
-        """
-        # Parse filename (8.3 format)
-        name, ext = os.path.splitext(filename.upper())
-        name = name[:8].ljust(8)
-        ext = ext[1:4].ljust(3) if ext else '   '
+class DiskImage:
+    """Disk image file accessed through mmap with dirty-range write-back.
 
-        num_records = (len(file_data) + 127) // 128
-        blocks_needed = (num_records + self.RECORDS_PER_BLOCK - 1) // self.RECORDS_PER_BLOCK
+    Reads are served straight from the mapping, so opening an image never
+    copies it into memory. A writable image uses a private (copy-on-write)
+    mapping: changes stay in memory until commit() writes only the byte
+    ranges that were modified back to the file. A command that fails part
+    way through therefore leaves the file untouched.
 
-        next_block = self.find_max_block() + 1
+    The object supports len(), indexing and slice assignment like the
+    bytearray the disk classes were written against, so SssdDisk, Hd1kDisk
+    and ComboDisk can use either one as their backing store.
+    """
 
-        sys_flag = " [SYS]" if sys_attr else ""
-        user_flag = f" [U{user}]" if user != 0 else ""
-        print(f"Adding {filename}{sys_flag}{user_flag}: {len(file_data)} bytes, {num_records} records, {blocks_needed} blocks starting at {next_block}")
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        self._file = open(path, 'r+b' if writable else 'rb')
+        try:
+            access = mmap.ACCESS_COPY if writable else mmap.ACCESS_READ
+            self._map = mmap.mmap(self._file.fileno(), 0, access=access)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"{path}: cannot map empty disk image")
+        self._dirty = []  # list of (start, end) byte ranges, merged on commit
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._map)
+
+    def __getitem__(self, key):
+        return self._map[key]
+
+    def __setitem__(self, key, value):
+        size = len(self._map)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(size)
+            if step != 1:
+                raise ValueError("extended slice assignment not supported")
+        else:
+            start = key + size if key < 0 else key
+            stop = start + 1
+        # mmap refuses size-changing assignments, unlike bytearray, so a
+        # write past the end of the image raises instead of growing it.
+        self._map[key] = value
+        self._dirty.append((start, stop))
+
+    def view(self):
+        """Return a memoryview of the mapping (release it before close())."""
+        return memoryview(self._map)
+
+    def dirty_ranges(self):
+        """Return the modified byte ranges, merged and aligned to DIRTY_GRANULE."""
+        size = len(self._map)
+        ranges = []
+        for start, stop in sorted(self._dirty):
+            start -= start % DIRTY_GRANULE
+            stop = min(size, -(-stop // DIRTY_GRANULE) * DIRTY_GRANULE)
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], stop)
+            else:
+                ranges.append([start, stop])
+        return [(start, stop) for start, stop in ranges]
 
-        # Prepare extension bytes with optional SYS attribute
-        ext_bytes = ext.encode('ascii')
-        if sys_attr:
-            ext_bytes = bytes([ext_bytes[0], ext_bytes[1] | 0x80, ext_bytes[2]])
+    def commit(self):
+        """Write modified ranges back to the image file.
 
-        # Write file data to blocks first
-        for i in range(blocks_needed):
-            block_num = next_block + i
-            data_offset = i * self.BLOCK_SIZE
-            chunk = file_data[data_offset:data_offset + self.BLOCK_SIZE]
-            self.write_block(block_num, chunk)
-
-        # Create directory entries
-        # For SSSD: EXM=0, each extent = 128 records, 16 blocks max per entry
-        extent_num = 0
-        block_idx = 0
-
-        while block_idx < blocks_needed:
-            dir_entry_num = self.find_free_dir_entry()
-            if dir_entry_num is None:
-                print(f"No free directory entry for {filename} extent {extent_num}")
-                return False
-
-            entry = bytearray(32)
-            entry[0] = user  # User number
-            entry[1:9] = name.encode('ascii')
-            entry[9:12] = ext_bytes
-
-            # Get blocks for this extent (up to 16 for 8-bit pointers)
-            extent_blocks = []
-            for i in range(self.BLOCKS_PER_EXTENT):
-                if block_idx + i < blocks_needed:
-                    extent_blocks.append(next_block + block_idx + i)
-
-            # Calculate record count for this extent
-            if block_idx + len(extent_blocks) >= blocks_needed:
-                # Last extent - calculate remaining records
-                remaining_bytes = len(file_data) - (block_idx * self.BLOCK_SIZE)
-                extent_records = (remaining_bytes + 127) // 128
-            else:
-                # Full extent
-                extent_records = 128
+        Returns the number of bytes written.
+        """
+        written = 0
+        with stats_phase('commit'), memoryview(self._map) as view:
+            for start, stop in self.dirty_ranges():
+                self._file.seek(start)
+                self._file.write(view[start:stop])
+                written += stop - start
+            self._file.flush()
+        self._dirty = []
+        if STATS is not None:
+            STATS.commit_bytes += written
+        return written
+
+    def close(self):
+        """Release the mapping. Uncommitted changes are discarded."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._file.close()
+
+
+# ImageDisk (.IMD) sector record types: 0 means the sector could not be
+# read, odd types are followed by a full sector of data and even types by
+# the single byte every byte of the sector equals. Types 3-8 add the
+# deleted-data and read-error flags to those two forms.
+IMD_SIGNATURE = b'IMD '
+IMD_DELETED = (3, 4, 7, 8)
+IMD_ERROR = (5, 6, 7, 8)
+IMD_CYLINDER_MAP = 0x80  # head byte flag: sector cylinder map present
+IMD_HEAD_MAP = 0x40      # head byte flag: sector head map present
+
+# One track of an IMD file. header holds its bytes from the mode through
+# the sector maps (written back unchanged), size is the sector size, first
+# the index of its first sector in ImdImage's sector list, and order the
+# numbering map position of each sector in ascending sector ID order.
+ImdTrack = namedtuple('ImdTrack', 'header size first order')
+
+
+def is_imd_file(path):
+    """Return True if path starts with the ImageDisk signature."""
+    with open(path, 'rb') as f:
+        return f.read(len(IMD_SIGNATURE)) == IMD_SIGNATURE
+
+
+def parse_imd(data):
+    """Index an IMD file in one pass without expanding any sector data.
 
-            entry[12] = extent_num & 0x1F  # Extent low
-            entry[13] = 0  # S1
-            entry[14] = (extent_num >> 5) & 0x3F  # S2/EH
-            entry[15] = min(extent_records, 128)
+    Returns:
+        (header, tracks, sectors): the signature line and comment up to
+        and including the 0x1A terminator, a list of ImdTrack, and one
+        [record type, file offset] pair per sector in image order (tracks
+        in file order, sectors by ascending ID). The offset points at the
+        sector's data, or at the fill byte of a compressed sector.
+    """
+    if data[:len(IMD_SIGNATURE)] != IMD_SIGNATURE:
+        raise ValueError("not an ImageDisk (IMD) file")
+    end = data.find(b'\x1a')
+    if end < 0:
+        raise ValueError("IMD comment is not terminated by 0x1A")
+    header = data[:end + 1]
+    tracks = []
+    sectors = []
+    pos = end + 1
+    size = len(data)
+    while pos < size:
+        if pos + 5 > size:
+            raise ValueError(f"IMD track header truncated at offset {pos}")
+        mode, cyl, head, count, size_code = data[pos:pos + 5]
+        if size_code > 6:
+            raise ValueError(f"IMD cylinder {cyl} head {head & 1}: "
+                             f"unsupported sector size code {size_code:#x}")
+        maps = 1 + bool(head & IMD_CYLINDER_MAP) + bool(head & IMD_HEAD_MAP)
+        track_header = data[pos:pos + 5 + maps * count]
+        numbering = track_header[5:5 + count]
+        sector_size = 128 << size_code
+        pos += len(track_header)
+        records = []
+        for _ in range(count):
+            if pos >= size:
+                raise ValueError(f"IMD cylinder {cyl} head {head & 1}: sector data truncated")
+            record_type = data[pos]
+            if record_type > 8:
+                raise ValueError(f"IMD cylinder {cyl} head {head & 1}: "
+                                 f"unknown sector record type {record_type:#x}")
+            records.append([record_type, pos + 1])
+            if record_type == 0:
+                pos += 1
+            elif record_type & 1:
+                pos += 1 + sector_size
+            else:
+                pos += 2
+        if pos > size:
+            raise ValueError(f"IMD cylinder {cyl} head {head & 1}: sector data truncated")
+        order = sorted(range(count), key=numbering.__getitem__)
+        tracks.append(ImdTrack(track_header, sector_size, len(sectors), order))
+        sectors.extend(records[i] for i in order)
+    return header, tracks, sectors
 
-            # Store 8-bit block pointers
-            for i, block in enumerate(extent_blocks):
-                entry[16 + i] = block & 0xFF
 
-            self.write_dir_entry(dir_entry_num, entry)
+def imd_sector_record(data, record_type=1):
+    """Encode one IMD sector record, compressing it if all bytes are equal.
 
-            block_idx += len(extent_blocks)
-            extent_num += 1
+    The deleted-data and read-error flags of record_type are kept; only
+    the choice between the normal and compressed form is made here.
+    """
+    base = 1 + 2 * (record_type in IMD_DELETED) + 4 * (record_type in IMD_ERROR)
+    fill = data[0]
+    if data.count(fill) == len(data):
+        return bytes((base + 1, fill))
+    return bytes((base,)) + bytes(data)
 
-        return True
 
-    def list_files(self):
-        """List all files in the directory."""
-        files = {}
-        for i in range(self.DIR_ENTRIES):
-            entry = self.read_dir_entry(i)
-            user = entry[0]
-            if user != 0xE5 and user < 32:
-                # Mask off attribute bits from extension bytes
-                name_bytes = entry[1:9]
-                ext_bytes = bytes([b & 0x7F for b in entry[9:12]])
-                if not all(0x20 <= b <= 0x7E for b in name_bytes):
-                    continue
-                if not all(0x20 <= b <= 0x7E for b in ext_bytes):
-                    continue
+def raw_to_imd(disk_data, diskdef, comment=''):
+    """Encode a raw sector image of diskdef's format as an IMD file.
 
-                name = name_bytes.decode('ascii').rstrip()
-                ext = ext_bytes.decode('ascii').rstrip()
-                extent_lo = entry[12]
-                extent_hi = entry[14]
-                extent = extent_lo + (extent_hi << 5)
-                records = entry[15]
+    Each track is recorded single-sided with sectors numbered 1..sectrk in
+    image order, FM for 128-byte sectors and MFM otherwise (500 kbps).
 
-                fullname = f"{name}.{ext}" if ext else name
-                key = (user, fullname)
+    Returns:
+        The IMD file contents as bytes
+    """
+    seclen = diskdef.seclen
+    size_code = seclen.bit_length() - 8
+    if seclen & (seclen - 1) or not 0 <= size_code <= 6:
+        raise ValueError(f"{diskdef.name}: IMD cannot hold {seclen}-byte sectors")
+    mode = 0 if seclen == 128 else 3
+    stamp = time.strftime('%d/%m/%Y %H:%M:%S')
+    out = [f"IMD 1.18: {stamp}\r\n{comment}".encode('latin-1') + b'\x1a']
+    numbering = bytes(range(1, diskdef.sectrk + 1))
+    track_size = diskdef.track_size
+    for cyl in range(len(disk_data) // track_size):
+        out.append(bytes((mode, cyl, 0, diskdef.sectrk, size_code)) + numbering)
+        base = cyl * track_size
+        out.extend(imd_sector_record(disk_data[pos:pos + seclen])
+                   for pos in range(base, base + track_size, seclen))
+    return b''.join(out)
+
+
+def copy_range(fd_in, fd_out, offset_in, offset_out, length):
+    """Copy length bytes between file descriptors at explicit offsets.
+
+    Uses os.copy_file_range(), which lets the kernel copy (or reflink)
+    without the data passing through Python. Where that is unavailable or
+    refused (for example across filesystems on older kernels) it falls
+    back to os.sendfile(), still in-kernel, and then to pread()/pwrite().
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    while length > 0:
+        if copy_file_range is not None:
+            try:
+                copied = copy_file_range(fd_in, fd_out, length, offset_in, offset_out)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+                copy_file_range = None
+                continue
+        elif sendfile is not None:
+            # sendfile() writes at fd_out's file position
+            try:
+                os.lseek(fd_out, offset_out, os.SEEK_SET)
+                copied = sendfile(fd_out, fd_in, offset_in, length)
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                sendfile = None
+                continue
+        else:
+            data = os.pread(fd_in, min(length, 1 << 20), offset_in)
+            copied = os.pwrite(fd_out, data, offset_out) if data else 0
+        if copied == 0:
+            raise ValueError("unexpected end of file while copying")
+        offset_in += copied
+        offset_out += copied
+        length -= copied
 
-                if key not in files:
-                    files[key] = {'extents': 0, 'records': 0, 'blocks': []}
 
-                files[key]['extents'] = max(files[key]['extents'], extent + 1)
-                if extent == files[key]['extents'] - 1:
-                    files[key]['records'] = extent * 128 + records
+def data_extents(fd, size, start=0):
+    """Yield (start, end) byte ranges of fd holding data, skipping holes.
 
-                # 8-bit block pointers
-                for j in range(16):
-                    block = entry[16 + j]
-                    if block > 0:
-                        files[key]['blocks'].append(block)
+    Only the bytes from start up to size are considered. Without
+    SEEK_DATA support the whole range is one extent.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        yield start, size
+        return
+    pos = start
+    while pos < size:
+        try:
+            data = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:   # only a hole remains
+                return
+            if pos == start:             # filesystem without SEEK_DATA
+                yield start, size
+                return
+            raise
+        if data >= size:
+            return
+        end = min(size, os.lseek(fd, data, os.SEEK_HOLE))
+        yield data, end
+        pos = end
+
+
+def clone_file(src, dst):
+    """Copy src to dst with copy_range(), leaving src's holes sparse in dst.
 
-        return files
+    Returns:
+        Number of data bytes copied
+    """
+    copied = 0
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        size = os.fstat(fin.fileno()).st_size
+        fout.truncate(size)
+        for start, end in data_extents(fin.fileno(), size):
+            copy_range(fin.fileno(), fout.fileno(), start, start, end - start)
+            copied += end - start
+    return copied
 
-    def delete_file(self, filename, user=0):
-        """Delete a file from the disk image."""
-        name, ext = os.path.splitext(filename.upper())
-        name = name[:8].ljust(8)
-        ext = ext[1:4].ljust(3) if ext else '   '
-
-        deleted_count = 0
-        for i in range(self.DIR_ENTRIES):
-            entry = self.read_dir_entry(i)
-            entry_user = entry[0]
-            if entry_user == user:
-                entry_name = bytes(entry[1:9]).decode('ascii')
-                entry_ext_bytes = bytes([b & 0x7F for b in entry[9:12]])
-                entry_ext = entry_ext_bytes.decode('ascii')
-                if entry_name == name and entry_ext == ext:
-                    # Mark entry as deleted
-                    deleted_entry = bytearray(entry)
-                    deleted_entry[0] = 0xE5
-                    self.write_dir_entry(i, deleted_entry)
-                    deleted_count += 1
-
-        return deleted_count
 
-    def extract_file(self, filename, user=0):
-        """Extract a file from the disk image.
+def rewrite_file(path, write):
+    """Replace path with the contents write(f) produces, via a temporary file.
 
-        Returns the file data as bytes, or None if not found.
-        """
-        name, ext = os.path.splitext(filename.upper())
-        name = name[:8].ljust(8)
-        ext = ext[1:4].ljust(3) if ext else '   '
-
-        # Collect all extents for this file
-        extents = {}
-        for i in range(self.DIR_ENTRIES):
-            entry = self.read_dir_entry(i)
-            entry_user = entry[0]
-            if entry_user == user:
-                # Mask off attribute bits from name bytes too (high bit can be set)
-                entry_name_bytes = bytes([b & 0x7F for b in entry[1:9]])
-                entry_ext_bytes = bytes([b & 0x7F for b in entry[9:12]])
-                try:
-                    entry_name = entry_name_bytes.decode('ascii')
-                    entry_ext = entry_ext_bytes.decode('ascii')
-                except UnicodeDecodeError:
-                    continue
-                if entry_name == name and entry_ext == ext:
-                    extent_lo = entry[12]
-                    extent_hi = entry[14]
-                    extent_num = extent_lo + (extent_hi << 5)
-                    records = entry[15]
-                    blocks = []
-                    # 8-bit block pointers
-                    for j in range(16):
-                        block = entry[16 + j]
-                        if block > 0:
-                            blocks.append(block)
-                    extents[extent_num] = (records, blocks)
+    The original file is untouched if write() fails, and its permission
+    bits carry over to the new one.
 
-        if not extents:
-            return None
+    Returns:
+        Size of the new file in bytes
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as out:
+            write(out)
+            size = out.tell()
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return size
+
+
+class SliceView:
+    """Stand-in for DiskImage.view() on images that are not one buffer.
+
+    Slicing returns a memoryview over a copy of the bytes, so callers can
+    treat the result like a view into a DiskImage mapping.
+    """
 
-        # Read data from blocks in extent order
-        file_data = bytearray()
-        for ext_num in sorted(extents.keys()):
-            records, blocks = extents[ext_num]
-            for block in blocks:
-                file_data.extend(self.read_block(block))
+    def __init__(self, image):
+        self._image = image
 
-        # Trim to actual size
-        last_ext = max(extents.keys())
-        total_records = last_ext * 128 + extents[last_ext][0]
-        actual_size = total_records * 128
-        return bytes(file_data[:actual_size])
+    def __enter__(self):
+        return self
 
-    def read_boot_area(self):
-        """Read the boot area (first 2 tracks) from the disk.
+    def __exit__(self, exc_type, exc, tb):
+        pass
 
-        Boot tracks have no sector skew applied - they are read sequentially.
-        Returns 6656 bytes (2 tracks × 26 sectors × 128 bytes).
-        """
-        boot_size = self.BOOT_TRACKS * self.SECTORS_PER_TRACK * self.SECTOR_SIZE
-        result = bytearray()
-        for track in range(self.BOOT_TRACKS):
-            for sector in range(self.SECTORS_PER_TRACK):
-                result.extend(self.read_sector(track, sector))
-        return bytes(result)
+    def __getitem__(self, key):
+        return memoryview(self._image[key])
 
-    def write_boot_area(self, data):
-        """Write data to the boot area (first 2 tracks) of the disk.
 
-        Boot tracks have no sector skew applied - they are written sequentially.
-        Data is padded or truncated to exactly 6656 bytes.
-        """
-        boot_size = self.BOOT_TRACKS * self.SECTORS_PER_TRACK * self.SECTOR_SIZE
-        # Pad or truncate to boot area size
-        if len(data) < boot_size:
-            data = data + bytes(boot_size - len(data))
-        elif len(data) > boot_size:
-            data = data[:boot_size]
+class UnitImage:
+    """Base for images stored as separately addressed units (sectors, chunks, ...).
 
-        offset = 0
-        for track in range(self.BOOT_TRACKS):
-            for sector in range(self.SECTORS_PER_TRACK):
-                sector_data = data[offset:offset + self.SECTOR_SIZE]
-                self.write_sector(track, sector, sector_data)
-                offset += self.SECTOR_SIZE
+    Subclasses set path, writable and _size, and provide:
+      _unit_size      bytes per unit, or override _locate() when units vary
+      _read_unit(n)   the stored bytes of unit n
+      _write_units()  write the units in _written back and return the
+                      number of bytes written (only needed if writable)
 
+    Reads are assembled from whole units, with units changed since the
+    last commit() taken from _written. Writes copy each unit they touch
+    into _written (unit number -> bytearray) and change it there, so like
+    DiskImage the file is untouched until commit().
+    """
 
-class Hd1kDisk:
-    """Standard hd1k disk format (RomWBW compatible)."""
+    _unit_size = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return self._size
+
+    def _locate(self, pos):
+        """Return (unit number, offset in unit, unit length) of an image offset."""
+        n, within = divmod(pos, self._unit_size)
+        return n, within, min(self._unit_size, self._size - n * self._unit_size)
+
+    def _unit(self, n):
+        data = self._written.get(n)
+        return data if data is not None else self._read_unit(n)
+
+    def _ranges(self, start, stop):
+        """Yield (unit number, start, stop, unit length) pieces of an image range."""
+        while start < stop:
+            n, within, size = self._locate(start)
+            length = min(size - within, stop - start)
+            yield n, within, within + length, size
+            start += length
+
+    def _read(self, start, stop):
+        return b''.join([self._unit(n)[a:b] for n, a, b, _ in self._ranges(start, stop)])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._size)
+            if step != 1:
+                raise ValueError("extended slices not supported")
+            return self._read(start, stop) if start < stop else b''
+        pos = key + self._size if key < 0 else key
+        if not 0 <= pos < self._size:
+            raise IndexError("image index out of range")
+        return self._read(pos, pos + 1)[0]
+
+    def __setitem__(self, key, value):
+        if not self.writable:
+            raise TypeError(f"{self.path} is opened read-only")
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._size)
+            if step != 1:
+                raise ValueError("extended slice assignment not supported")
+            src = memoryview(value)
+        else:
+            start = key + self._size if key < 0 else key
+            stop = start + 1
+            src = memoryview(bytes((value,)))
+        # Like mmap, refuse size-changing assignments instead of growing
+        if not 0 <= start <= self._size or len(src) != stop - start:
+            raise IndexError("image assignment out of range")
+        pos = 0
+        for n, a, b, size in self._ranges(start, stop):
+            unit = self._written.get(n)
+            if unit is None:
+                unit = self._written[n] = bytearray(self._read_unit(n))
+            unit[a:b] = src[pos:pos + b - a]
+            pos += b - a
+
+    def view(self):
+        """Return a SliceView; units are read as slices touch them."""
+        return SliceView(self)
+
+    def commit(self):
+        """Write the changed units back with _write_units().
+
+        Returns the number of bytes written, or 0 if nothing changed.
+        """
+        if not self._written:
+            return 0
+        with stats_phase('commit'):
+            written = self._write_units()
+        self._written = {}
+        if STATS is not None:
+            STATS.commit_bytes += written
+        return written
+
+
+class ImdImage(UnitImage):
+    """ImageDisk (.IMD) file presented as a flat sector image.
+
+    Opening the file maps it and indexes every track and sector record in
+    one pass; no sector is copied or expanded until a read touches it.
+    Tracks appear in file order and each track's sectors in ascending ID
+    order, the layout of a raw .dsk image, so the disk classes apply their
+    usual skew on top and detect the format from the size as before.
+
+    The units are sectors, so writes land in a per-sector overlay.
+    commit() rewrites the file through a temporary copy, keeping the
+    comment, track modes and sector maps and compressing every sector
+    whose bytes are all equal.
+    """
 
-    SECTOR_SIZE = SECTOR_SIZE_HD  # 512 bytes
-    SECTORS_PER_TRACK = 16
-    DIR_ENTRIES = 1024
-    BOOT_TRACKS = 2
-    DIR_START = BOOT_TRACKS * SECTORS_PER_TRACK * SECTOR_SIZE_HD  # 0x4000 (16KB)
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        self._file = open(path, 'r+b' if writable else 'rb')
+        self._map = None
+        try:
+            self._load()
+        except (ValueError, OSError):
+            self.close()
+            raise
+
+    def _load(self):
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._header, self._tracks, self._sectors = parse_imd(self._map)
+        except ValueError as e:
+            raise ValueError(f"{self.path}: {e}") from None
+        self._track_starts = []
+        self._track_firsts = [track.first for track in self._tracks]
+        size = 0
+        for track in self._tracks:
+            self._track_starts.append(size)
+            size += track.size * len(track.order)
+        self._size = size
+        self._written = {}  # sector index -> bytearray of its new contents
+
+    def _locate(self, pos):
+        """Return (sector index, offset in sector, sector size) of an image offset."""
+        t = bisect.bisect_right(self._track_starts, pos) - 1
+        track = self._tracks[t]
+        sector, within = divmod(pos - self._track_starts[t], track.size)
+        return track.first + sector, within, track.size
+
+    def _read_unit(self, index):
+        """Return a sector's bytes, expanding it if it is compressed."""
+        record_type, offset = self._sectors[index]
+        size = self._tracks[bisect.bisect_right(self._track_firsts, index) - 1].size
+        if record_type == 0:
+            return bytes(size)
+        if record_type & 1:
+            return self._map[offset:offset + size]
+        return bytes((self._map[offset],)) * size
+
+    def _write_units(self):
+        """Rewrite the IMD file with the changes and re-index it.
+
+        Sectors that were written become plain data records; every other
+        sector keeps its record type. Either way a sector whose bytes are
+        all equal is stored compressed.
+        """
+        written = rewrite_file(self.path, self._write_tracks)
+        self._map.close()
+        self._file.close()
+        self._file = open(self.path, 'r+b')
+        self._load()
+        return written
+
+    def _write_tracks(self, out):
+        out.write(self._header)
+        for track in self._tracks:
+            records = [None] * len(track.order)
+            for i, pos in enumerate(track.order):
+                index = track.first + i
+                record_type = self._sectors[index][0]
+                if index in self._written:
+                    records[pos] = imd_sector_record(self._written[index])
+                elif record_type == 0:
+                    records[pos] = b'\x00'
+                else:
+                    records[pos] = imd_sector_record(self._read_unit(index), record_type)
+            out.write(track.header)
+            out.write(b''.join(records))
+
+    def close(self):
+        """Release the mapping. Uncommitted changes are discarded."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if not self._file.closed:
+            self._file.close()
+
+
+# Chunked compressed image container (.cpmz). The file is a header, the
+# compressed chunks, then an index with one (offset, length) entry per
+# chunk. A chunk whose bytes are all equal (typically 0x00 or 0xE5 fill)
+# is elided: its entry has length 0 and the fill byte as its offset.
+CPMZ_MAGIC = b'CPMZ'
+CPMZ_VERSION = 1
+CPMZ_HEADER = struct.Struct('<4sBBHIQQ')  # magic, version, codec, 0, chunk size, image size, index offset
+CPMZ_INDEX_ENTRY = struct.Struct('<QI')   # offset, compressed length
+CPMZ_CHUNK_SIZE = 65536
+CPMZ_CACHE_CHUNKS = 64   # decompressed chunks kept per open image (4MB)
+CPMZ_CODECS = {          # codec id -> (name, compress, decompress)
+    0: ('zlib', zlib.compress, zlib.decompress),
+    1: ('lzma', lzma.compress, lzma.decompress),
+}
+
+
+def cpmz_codec_id(name):
+    """Return the codec id for a codec name ('zlib' or 'lzma')."""
+    for codec_id, (codec_name, _, _) in CPMZ_CODECS.items():
+        if codec_name == name:
+            return codec_id
+    raise ValueError(f"unknown compression codec: {name} "
+                     f"(known: {', '.join(c[0] for c in CPMZ_CODECS.values())})")
+
+
+def is_cpmz_file(path):
+    """Return True if path starts with the compressed container signature."""
+    with open(path, 'rb') as f:
+        return f.read(len(CPMZ_MAGIC)) == CPMZ_MAGIC
+
+
+def encode_chunk(data, compress):
+    """Return the (fill, payload) record for one chunk; payload None if elided."""
+    fill = data[0]
+    if data.count(fill) == len(data):
+        return fill, None
+    return 0, compress(data)
+
+
+def write_cpmz(out, codec_id, chunk_size, image_size, records):
+    """Write a container to the file object out from (fill, payload) records."""
+    out.write(b'\0' * CPMZ_HEADER.size)
+    index = []
+    pos = CPMZ_HEADER.size
+    for fill, payload in records:
+        if payload is None:
+            index.append(CPMZ_INDEX_ENTRY.pack(fill, 0))
+        else:
+            index.append(CPMZ_INDEX_ENTRY.pack(pos, len(payload)))
+            out.write(payload)
+            pos += len(payload)
+    out.write(b''.join(index))
+    out.seek(0)
+    out.write(CPMZ_HEADER.pack(CPMZ_MAGIC, CPMZ_VERSION, codec_id, 0,
+                               chunk_size, image_size, pos))
+    out.seek(0, os.SEEK_END)
 
-    def __init__(self, disk_data):
-        self.data = disk_data
 
-    def find_free_dir_entry(self):
-        """Find first free directory entry (starts with 0xE5)."""
-        for i in range(self.DIR_ENTRIES):
-            offset = self.DIR_START + (i * 32)
-            if self.data[offset] == 0xE5:
-                return offset
-        return None
+def compress_image(disk_data, path, codec='zlib', chunk_size=CPMZ_CHUNK_SIZE):
+    """Write disk_data (any image object or buffer) to path as a container.
 
-    def find_max_block(self):
-        """Find highest used block number in directory.
+    Chunks are compressed on a thread pool, since zlib and lzma release
+    the GIL while they work.
 
-        Returns the highest block number in use, or 7 if no files exist
-        (blocks 0-7 are reserved for directory).
-        """
-        # Blocks 0-7 are reserved for directory (32KB = 8 blocks at 4KB each)
-        max_block = 7
-        for i in range(self.DIR_ENTRIES):
-            offset = self.DIR_START + (i * 32)
-            if self.data[offset] != 0xE5:
-                for j in range(8):
-                    block = struct.unpack('<H', self.data[offset+16+j*2:offset+18+j*2])[0]
-                    if block > max_block and block < 0xFFFF:
-                        max_block = block
-        return max_block
+    Returns:
+        Size of the container in bytes
+    """
+    codec_id = cpmz_codec_id(codec)
+    compress = CPMZ_CODECS[codec_id][1]
+    size = len(disk_data)
 
-    def add_file(self, filename, file_data, sys_attr=False, user=0):
-        """Add a file to the disk image.
+    def encode(start):
+        return encode_chunk(disk_data[start:start + chunk_size], compress)
 
-        Args:
-            filename: Name of the file to add
-            file_data: File contents as bytes
-            sys_attr: If True, set the SYS attribute (makes file visible from any user area)
-            user: User number (0-15)
-        """
-        # Parse filename (8.3 format)
-        name, ext = os.path.splitext(filename.upper())
-        name = name[:8].ljust(8)
-        ext = ext[1:4].ljust(3) if ext else '   '
+    with ThreadPoolExecutor() as pool, open(path, 'wb') as out:
+        records = pool.map(encode, range(0, size, chunk_size))
+        write_cpmz(out, codec_id, chunk_size, size, records)
+        return out.tell()
 
-        num_records = (len(file_data) + 127) // 128
-        records_per_block = BLOCK_SIZE // 128  # 32 records per 4KB block
-        blocks_needed = (num_records + records_per_block - 1) // records_per_block
 
-        next_block = self.find_max_block() + 1
+class CompressedImage(UnitImage):
+    """Chunked compressed container presented as a flat disk image.
 
-        sys_flag = " [SYS]" if sys_attr else ""
-        user_flag = f" [U{user}]" if user != 0 else ""
-        print(f"Adding {filename}{sys_flag}{user_flag}: {len(file_data)} bytes, {num_records} records, {blocks_needed} blocks starting at {next_block}")
+    Opening the file reads only the header and chunk index. A read
+    decompresses just the chunks it touches, and the most recently used
+    decompressed chunks are kept in an LRU, so listing a directory or
+    extracting one file costs only the chunks involved rather than the
+    whole image. Elided chunks are rebuilt from their fill byte.
 
-        # Prepare extension bytes with optional SYS attribute
-        ext_bytes = ext.encode('ascii')
-        if sys_attr:
-            ext_bytes = bytes([ext_bytes[0], ext_bytes[1] | 0x80, ext_bytes[2]])
+    Written chunks are held in memory until commit(), which rewrites the
+    container with those chunks recompressed and every other chunk copied
+    over still compressed.
+    """
 
-        # Write file data to blocks first
-        for i in range(blocks_needed):
-            block_num = next_block + i
-            block_offset = self.DIR_START + (block_num * BLOCK_SIZE)
-            data_offset = i * BLOCK_SIZE
-            chunk = file_data[data_offset:data_offset + BLOCK_SIZE]
-            if len(chunk) < BLOCK_SIZE:
-                chunk = chunk + bytes([0x1A] * (BLOCK_SIZE - len(chunk)))
-            self.data[block_offset:block_offset + BLOCK_SIZE] = chunk
-
-        # Create directory entries
-        # For hd1k with 4KB blocks and DSM > 255: EXM=1
-        # Each physical directory entry covers 2 logical extents = 256 records = 8 blocks
-        # EL field contains the last logical extent number within this physical extent
-        # RC field contains the record count in that last logical extent
-        exm = 1  # EXM=1 for hd1k format (4KB blocks, DSM > 255)
-        records_per_physical_extent = 128 * (exm + 1)  # 256 records
-        blocks_per_physical_extent = 8  # 8 block pointers per directory entry
-        physical_extent_num = 0
-        block_idx = 0
-
-        while block_idx < blocks_needed:
-            dir_offset = self.find_free_dir_entry()
-            if dir_offset is None:
-                print(f"No free directory entry for {filename} extent {physical_extent_num}")
-                return False
-
-            entry = bytearray(32)
-            entry[0] = user  # User number
-            entry[1:9] = name.encode('ascii')
-            entry[9:12] = ext_bytes
-
-            # Get blocks for this physical extent
-            extent_blocks = []
-            for i in range(blocks_per_physical_extent):
-                if block_idx + i < blocks_needed:
-                    extent_blocks.append(next_block + block_idx + i)
-
-            # Calculate which logical extent this ends on and the record count
-            records_before = block_idx * records_per_block
-            records_in_extent = len(extent_blocks) * records_per_block
-            records_covered = min(records_before + records_in_extent, num_records)
-            records_in_last_logical = ((records_covered - 1) % 128) + 1 if records_covered > 0 else 0
-
-            # Logical extent number within this physical extent (0 or 1 for EXM=1)
-            if records_covered > records_before + 128:
-                last_logical_extent = 1  # Extends into second logical extent
+    def __init__(self, path, writable=False, cache_chunks=CPMZ_CACHE_CHUNKS):
+        self.path = path
+        self.writable = writable
+        self.cache_chunks = cache_chunks
+        self._file = open(path, 'r+b' if writable else 'rb')
+        self._lock = threading.Lock()   # extract reads from a thread pool
+        try:
+            self._load()
+        except (ValueError, OSError):
+            self._file.close()
+            raise
+
+    def _load(self):
+        header = self._file.read(CPMZ_HEADER.size)
+        if len(header) < CPMZ_HEADER.size or header[:4] != CPMZ_MAGIC:
+            raise ValueError(f"{self.path}: not a compressed disk image")
+        magic, version, codec_id, _, chunk_size, size, index_offset = CPMZ_HEADER.unpack(header)
+        if version != CPMZ_VERSION or codec_id not in CPMZ_CODECS or not chunk_size:
+            raise ValueError(f"{self.path}: unsupported container version {version} "
+                             f"or codec {codec_id}")
+        count = -(-size // chunk_size)
+        raw_index = os.pread(self._file.fileno(), count * CPMZ_INDEX_ENTRY.size, index_offset)
+        if len(raw_index) != count * CPMZ_INDEX_ENTRY.size:
+            raise ValueError(f"{self.path}: chunk index truncated")
+        self.codec = CPMZ_CODECS[codec_id][0]
+        self._codec_id = codec_id
+        self._decompress = CPMZ_CODECS[codec_id][2]
+        self.chunk_size = self._unit_size = chunk_size
+        self._size = size
+        self._index = list(CPMZ_INDEX_ENTRY.iter_unpack(raw_index))
+        self._cache = OrderedDict()  # chunk number -> bytes, least recently used first
+        self._written = {}           # chunk number -> bytearray of its new contents
+
+    def _chunk_length(self, n):
+        return min(self.chunk_size, self._size - n * self.chunk_size)
+
+    def _read_unit(self, n):
+        """Return chunk n decompressed, through the LRU."""
+        with self._lock:
+            data = self._cache.get(n)
+            if data is not None:
+                self._cache.move_to_end(n)
+                return data
+            offset, length = self._index[n]
+            if length == 0:
+                data = bytes((offset,)) * self._chunk_length(n)
             else:
-                last_logical_extent = 0
+                data = self._decompress(os.pread(self._file.fileno(), length, offset))
+                if len(data) != self._chunk_length(n):
+                    raise ValueError(f"{self.path}: chunk {n} is corrupt")
+            self._cache[n] = data
+            if len(self._cache) > self.cache_chunks:
+                self._cache.popitem(last=False)
+            return data
+
+    def _records(self):
+        compress = CPMZ_CODECS[self._codec_id][1]
+        fd = self._file.fileno()
+        for n, (offset, length) in enumerate(self._index):
+            if n in self._written:
+                yield encode_chunk(self._written[n], compress)
+            elif length == 0:
+                yield offset, None
+            else:
+                yield 0, os.pread(fd, length, offset)
+
+    def _write_units(self):
+        """Rewrite the container with the changed chunks and re-read its index."""
+        written = rewrite_file(self.path, lambda out: write_cpmz(
+            out, self._codec_id, self.chunk_size, self._size, self._records()))
+        self._file.close()
+        self._file = open(self.path, 'r+b')
+        self._load()
+        return written
+
+    def close(self):
+        """Close the file. Uncommitted changes are discarded."""
+        self._file.close()
+        self._cache = OrderedDict()
+
+
+def open_image(path, writable=False):
+    """Open a disk image file as an ImdImage, CompressedImage, RecipeImage, OverlayImage or DiskImage."""
+    with stats_phase('open'):
+        return _open_image(path, writable)
+
+
+def _open_image(path, writable):
+    if is_imd_file(path):
+        return ImdImage(path, writable)
+    if is_cpmz_file(path):
+        return CompressedImage(path, writable)
+    if is_recipe_file(path):
+        return RecipeImage(path, writable)
+    if is_overlay_file(path):
+        return OverlayImage(path, writable)
+    return DiskImage(path, writable)
+
+
+class AllocationVector:
+    """Block allocation map built from the directory, like CP/M's ALV.
+
+    One byte per block holds the number of directory entries referencing
+    it (saturating at 255), so a block shared by two entries stays
+    allocated until both are gone. Free space is kept as a running count,
+    and first-fit searches run as bytearray.find() over the map.
+    """
 
-            # Full extent number = physical_extent * (exm+1) + last_logical_extent
-            full_extent_num = physical_extent_num * (exm + 1) + last_logical_extent
+    def __init__(self, total_blocks, reserved_blocks):
+        """Create a map of total_blocks (DSM + 1) with the directory blocks in use."""
+        self.total_blocks = total_blocks
+        self._refs = bytearray(total_blocks)
+        self._refs[:reserved_blocks] = b'\x01' * reserved_blocks
+        self.free_count = total_blocks - reserved_blocks
+
+    def mark_used_array(self, blocks):
+        """mark_used() for a NumPy array of block pointers, as one bincount."""
+        blocks = blocks[blocks < self.total_blocks]
+        counts = np.bincount(blocks, minlength=self.total_blocks)
+        refs = np.frombuffer(self._refs, dtype=np.uint8)
+        refs = np.minimum(refs + counts, 255).astype(np.uint8)
+        self._refs[:] = refs.tobytes()
+        self.free_count = self.total_blocks - int(np.count_nonzero(refs))
+
+    def is_used(self, block):
+        return 0 <= block < self.total_blocks and self._refs[block] != 0
+
+    def used_blocks(self):
+        """Return the set of allocated block numbers."""
+        refs = self._refs
+        return {b for b in range(self.total_blocks) if refs[b]}
+
+    def max_used(self):
+        """Highest allocated block number, or -1 if nothing is allocated."""
+        return len(self._refs.rstrip(b'\x00')) - 1
+
+    def mark_used(self, blocks):
+        """Add one reference to each block. Out-of-range pointers are ignored."""
+        refs = self._refs
+        for block in blocks:
+            if 0 <= block < self.total_blocks:
+                count = refs[block]
+                if count == 0:
+                    self.free_count -= 1
+                if count < 255:
+                    refs[block] = count + 1
+
+    def release(self, blocks):
+        """Drop one reference from each block, freeing it when none remain."""
+        refs = self._refs
+        for block in blocks:
+            if 0 <= block < self.total_blocks:
+                count = refs[block]
+                if count == 1:
+                    self.free_count += 1
+                if count and count < 255:
+                    refs[block] = count - 1
+
+    def allocate(self, count):
+        """Allocate count blocks, first fit.
+
+        Prefers the lowest contiguous run of count free blocks. When free
+        space is too fragmented for one run, takes the lowest free blocks.
+
+        Returns the list of block numbers, or None if the disk is full.
+        """
+        if count > self.free_count:
+            return None
+        if count == 0:
+            return []
+        if STATS is not None:
+            STATS.alloc_searches += 1
+        refs = self._refs
+        start = refs.find(bytes(count))
+        if start >= 0:
+            blocks = list(range(start, start + count))
+        else:
+            blocks = []
+            pos = refs.find(0)
+            while len(blocks) < count:
+                blocks.append(pos)
+                pos = refs.find(0, pos + 1)
+        self.mark_used(blocks)
+        return blocks
 
-            entry[12] = full_extent_num & 0x1F  # Extent low (bits 0-4)
-            entry[13] = 0  # S1
-            entry[14] = (full_extent_num >> 5) & 0x3F  # S2/EH (bits 5-10)
-            entry[15] = records_in_last_logical  # RC = records in last logical extent
 
-            # Store block pointers
-            for i, block in enumerate(extent_blocks):
-                struct.pack_into('<H', entry, 16 + i*2, block)
+def blocks_in_image(diskdef, size):
+    """Number of a format's blocks (at most DSM + 1) that lie wholly inside size bytes."""
+    runs = block_run_table(diskdef)
+    count = diskdef.dsm + 1
+    while count and max(start + length for start, length in runs[count - 1]) > size:
+        count -= 1
+    return count
 
-            self.data[dir_offset:dir_offset+32] = entry
 
-            block_idx += len(extent_blocks)
-            physical_extent_num += 1
+def buffer_view(data):
+    """Return a memoryview over a bytearray or DiskImage without copying."""
+    view = getattr(data, 'view', None)
+    return view() if view is not None else memoryview(data)
 
-        return True
 
-    def list_files(self):
-        """List all files in the directory."""
-        files = {}
-        for i in range(self.DIR_ENTRIES):
-            offset = self.DIR_START + (i * 32)
-            user = self.data[offset]
-            if user != 0xE5 and user < 32:
-                # Validate filename - must be printable ASCII (0x20-0x7E)
-                # Mask off attribute bits (high bit) from extension bytes
-                name_bytes = self.data[offset+1:offset+9]
-                ext_bytes = bytes([b & 0x7F for b in self.data[offset+9:offset+12]])
-                if not all(0x20 <= b <= 0x7E for b in name_bytes):
-                    continue
-                if not all(0x20 <= b <= 0x7E for b in ext_bytes):
-                    continue
+# One directory entry of a file: slot is the entry number in the directory,
+# extent the full extent number (EX + S2 << 5), records the RC byte.
+DirExtent = namedtuple('DirExtent', 'slot extent records blocks')
 
-                name = name_bytes.decode('ascii').rstrip()
-                ext = ext_bytes.decode('ascii').rstrip()
-                extent_lo = self.data[offset+12]
-                extent_hi = self.data[offset+14]
-                extent = extent_lo + (extent_hi << 5)
-                records = self.data[offset+15]
 
-                fullname = f"{name}.{ext}" if ext else name
-                key = (user, fullname)
+class DirectoryIndex:
+    """Parsed CP/M directory, built in one pass over the raw entries.
 
-                if key not in files:
-                    files[key] = {'extents': 0, 'records': 0, 'blocks': []}
+    Keeps three structures in step with the on-disk directory:
+      - files: (user, name_83) -> list of DirExtent, ordered by extent
+      - a heap of free slots, so the lowest free entry is found in O(log n)
+      - alv: AllocationVector of blocks referenced by live entries plus
+        the directory blocks themselves
 
-                files[key]['extents'] = max(files[key]['extents'], extent + 1)
-                if extent == files[key]['extents'] - 1:
-                    files[key]['records'] = extent * 128 + records
+    The owning disk object writes directory entries to the image and then
+    calls add_extent()/remove_file() so the index never has to be rebuilt.
+    Name and extension bytes are stored with attribute bits masked off.
+    """
 
-                for j in range(8):
-                    block = struct.unpack('<H', self.data[offset+16+j*2:offset+18+j*2])[0]
-                    if block > 0:
-                        files[key]['blocks'].append(block)
+    def __init__(self, raw_dir, ptr16, reserved_blocks, total_blocks):
+        """Build the index.
 
-        return files
+        Args:
+            raw_dir: Directory bytes (entries x 32), in entry order
+            ptr16: True for 16-bit block pointers (8 per entry), False for
+                   8-bit pointers (16 per entry)
+            reserved_blocks: Number of blocks occupied by the directory
+            total_blocks: Number of blocks on the disk (DSM + 1)
+        """
+        self.ptr16 = ptr16
+        self.files = {}
+        self.alv = AllocationVector(total_blocks, reserved_blocks)
+        self._free = []
+        if STATS is not None:
+            STATS.dir_entries_scanned += len(raw_dir) // 32
+
+        if np is not None:
+            self._parse_numpy(raw_dir, ptr16)
+        else:
+            self._parse(raw_dir, ptr16)
+
+    def _parse(self, raw_dir, ptr16):
+        """Decode the directory entry by entry."""
+        unpack_ptrs = struct.Struct('<8H').unpack_from if ptr16 else None
+        for slot in range(len(raw_dir) // 32):
+            offset = slot * 32
+            user = raw_dir[offset]
+            if user == 0xE5:
+                self._free.append(slot)
+                continue
+            if user >= 32:
+                # Disk labels, timestamps etc. - occupied but not a file
+                continue
+
+            if ptr16:
+                blocks = tuple(b for b in unpack_ptrs(raw_dir, offset + 16) if b)
+            else:
+                blocks = tuple(b for b in raw_dir[offset + 16:offset + 32] if b)
+            self.alv.mark_used(blocks)
 
-    def delete_file(self, filename, user=0):
-        """Delete a file from the disk image by marking its directory entries as empty."""
-        # Parse filename (8.3 format)
-        name, ext = os.path.splitext(filename.upper())
-        name = name[:8].ljust(8)
-        ext = ext[1:4].ljust(3) if ext else '   '
-
-        deleted_count = 0
-        for i in range(self.DIR_ENTRIES):
-            offset = self.DIR_START + (i * 32)
-            entry_user = self.data[offset]
-            if entry_user == user:
-                entry_name = bytes(self.data[offset+1:offset+9]).decode('ascii')
-                # Mask off attribute bits (high bit) from extension bytes
-                entry_ext_bytes = bytes([b & 0x7F for b in self.data[offset+9:offset+12]])
-                entry_ext = entry_ext_bytes.decode('ascii')
-                if entry_name == name and entry_ext == ext:
-                    # Mark entry as deleted
-                    self.data[offset] = 0xE5
-                    deleted_count += 1
-
-        return deleted_count
+            name_bytes = bytes(b & 0x7F for b in raw_dir[offset + 1:offset + 12])
+            if not all(0x20 <= b <= 0x7E for b in name_bytes):
+                continue
+            extent = (raw_dir[offset + 12] & 0x1F) + ((raw_dir[offset + 14] & 0x3F) << 5)
+            self._insert(user, name_bytes.decode('ascii'),
+                         DirExtent(slot, extent, raw_dir[offset + 15], blocks))
 
-    def extract_file(self, filename, user=0):
-        """Extract a file from the disk image.
+        # Slots were appended in ascending order, which is already a heap
 
-        Returns the file data as bytes, or None if not found.
-        """
-        # Parse filename (8.3 format)
-        name, ext = os.path.splitext(filename.upper())
-        name = name[:8].ljust(8)
-        ext = ext[1:4].ljust(3) if ext else '   '
-
-        # Collect all extents for this file
-        extents = {}  # extent_num -> (records, blocks)
-        for i in range(self.DIR_ENTRIES):
-            offset = self.DIR_START + (i * 32)
-            entry_user = self.data[offset]
-            if entry_user == user:
-                entry_name = bytes(self.data[offset+1:offset+9]).decode('ascii')
-                # Mask off attribute bits (high bit) from extension bytes
-                entry_ext_bytes = bytes([b & 0x7F for b in self.data[offset+9:offset+12]])
-                entry_ext = entry_ext_bytes.decode('ascii')
-                if entry_name == name and entry_ext == ext:
-                    extent_lo = self.data[offset+12]
-                    extent_hi = self.data[offset+14]
-                    extent_num = extent_lo + (extent_hi << 5)
-                    records = self.data[offset+15]
-                    blocks = []
-                    for j in range(8):
-                        block = struct.unpack('<H', self.data[offset+16+j*2:offset+18+j*2])[0]
-                        if block > 0:
-                            blocks.append(block)
-                    extents[extent_num] = (records, blocks)
+    def _parse_numpy(self, raw_dir, ptr16):
+        """Decode the directory as a structured array.
 
-        if not extents:
-            return None
+        Free slots, block references, attribute masking and name validation
+        are whole-array operations; only valid file entries are turned into
+        DirExtent tuples, inserted in extent order so no list needs sorting.
+        """
+        entries = np.frombuffer(raw_dir, dtype=dir_entry_dtype(ptr16),
+                                count=len(raw_dir) // 32)
+        users = entries['user']
+        # flatnonzero is ascending, which is already a heap
+        self._free = np.flatnonzero(users == 0xE5).tolist()
+
+        live = users < 32
+        ptrs = entries['al'][live]
+        self.alv.mark_used_array(ptrs[ptrs != 0])
+
+        names = np.concatenate((entries['name'], entries['ext']), axis=1) & 0x7F
+        valid = live & ((names >= 0x20) & (names <= 0x7E)).all(axis=1)
+        slots = np.flatnonzero(valid)
+        extent_nums = ((entries['ex'][slots] & 0x1F).astype(np.int64)
+                       + ((entries['s2'][slots] & 0x3F).astype(np.int64) << 5))
+        order = np.argsort(extent_nums, kind='stable').tolist()
+
+        name_text = names[slots].astype(np.uint8).tobytes().decode('ascii')
+        slots = slots.tolist()
+        extent_nums = extent_nums.tolist()
+        user_list = users[slots].tolist()
+        records = entries['rc'][slots].tolist()
+        ptr_rows = entries['al'][slots].tolist()
+        files = self.files
+        for i in order:
+            key = (user_list[i], name_text[i * 11:i * 11 + 11])
+            blocks = tuple(b for b in ptr_rows[i] if b)
+            files.setdefault(key, []).append(
+                DirExtent(slots[i], extent_nums[i], records[i], blocks))
+
+    def _insert(self, user, name_83, dir_extent):
+        extents = self.files.setdefault((user, name_83), [])
+        extents.append(dir_extent)
+        if len(extents) > 1 and extents[-2].extent > dir_extent.extent:
+            extents.sort(key=lambda e: e.extent)
+
+    @property
+    def free_count(self):
+        """Number of free directory entries."""
+        return len(self._free)
+
+    def first_free(self):
+        """Return the lowest free slot without claiming it, or None."""
+        return self._free[0] if self._free else None
+
+    def take_free_slot(self):
+        """Claim and return the lowest free slot, or None if the directory is full."""
+        return heapq.heappop(self._free) if self._free else None
+
+    @property
+    def used_blocks(self):
+        """Set of allocated blocks (directory blocks included)."""
+        return self.alv.used_blocks()
+
+    def max_block(self):
+        """Highest block referenced by the directory (or last directory block)."""
+        return self.alv.max_used()
+
+    def lookup(self, user, name_83):
+        """Return the file's extents ordered by extent number, or None."""
+        return self.files.get((user, name_83))
+
+    def match(self, pattern_83, user=None):
+        """Return the (user, name_83) keys matching a CP/M pattern.
+
+        Limited to one user area unless user is None.
+        """
+        keys = [key for key in self.files if user is None or key[0] == user]
+        hits = cpm_match_many(pattern_83, [name_83 for _, name_83 in keys])
+        return [key for key, hit in zip(keys, hits) if hit]
 
-        # Read data from blocks in extent order
-        file_data = bytearray()
-        for ext_num in sorted(extents.keys()):
-            records, blocks = extents[ext_num]
-            for block in blocks:
-                block_offset = self.DIR_START + (block * BLOCK_SIZE)
-                file_data.extend(self.data[block_offset:block_offset + BLOCK_SIZE])
+    def add_extent(self, slot, user, name_83, extent, records, blocks):
+        """Record a directory entry that was just written to slot.
 
-        # Trim to actual size based on last extent's record count
-        last_ext = max(extents.keys())
-        total_records = last_ext * 128 + extents[last_ext][0]
-        actual_size = total_records * 128
-        return bytes(file_data[:actual_size])
+        The blocks must already be marked in the ALV (see alv.allocate()).
+        """
+        blocks = tuple(b for b in blocks if b)
+        self._insert(user, name_83, DirExtent(slot, extent, records, blocks))
 
-    def read_boot_area(self):
-        """Read the boot area (first 2 tracks) from the disk.
+    def remove_file(self, user, name_83):
+        """Drop a file from the index.
 
-        Returns 16384 bytes (2 tracks × 16 sectors × 512 bytes).
-        No skew is applied to hard disk formats.
+        Returns the list of slots it occupied (empty if not found). The
+        caller is responsible for marking those entries 0xE5 on disk. The
+        file's blocks are released for reuse.
         """
-        boot_size = self.BOOT_TRACKS * self.SECTORS_PER_TRACK * SECTOR_SIZE_HD
-        return bytes(self.data[:boot_size])
+        extents = self.files.pop((user, name_83), None)
+        if not extents:
+            return []
+        for dir_extent in extents:
+            heapq.heappush(self._free, dir_extent.slot)
+            self.alv.release(dir_extent.blocks)
+        return [e.slot for e in extents]
 
-    def write_boot_area(self, data):
-        """Write data to the boot area (first 2 tracks) of the disk.
+    def file_table(self):
+        """Summarize files as returned by the disk classes' list_files().
 
-        Data is padded or truncated to exactly 16384 bytes.
-        No skew is applied to hard disk formats.
+        Returns dict mapping (user, "NAME.EXT") to a dict with 'extents',
+        'records' and 'blocks' (in extent order).
         """
-        boot_size = self.BOOT_TRACKS * self.SECTORS_PER_TRACK * SECTOR_SIZE_HD
-        # Pad or truncate to boot area size
-        if len(data) < boot_size:
-            data = data + bytes(boot_size - len(data))
-        elif len(data) > boot_size:
-            data = data[:boot_size]
-        self.data[:boot_size] = data
+        files = {}
+        for (user, name_83), extents in self.files.items():
+            last = extents[-1]
+            blocks = []
+            for dir_extent in extents:
+                blocks.extend(dir_extent.blocks)
+            files[(user, cpm_83_to_filename(name_83))] = {
+                'extents': last.extent + 1,
+                'records': last.extent * 128 + last.records,
+                'blocks': blocks,
+            }
+        return files
 
 
-class ComboDisk:
-    """Combo disk with 1MB prefix."""
+class CpmDisk:
+    """CP/M filesystem engine parameterized by a DiskDef.
 
-    SECTOR_SIZE = SECTOR_SIZE_HD  # 512 bytes
-    SECTORS_PER_TRACK = 16
-    TRACK_SIZE = SECTOR_SIZE_HD * SECTORS_PER_TRACK
-    DIR_ENTRIES = 1024
-    BOOT_TRACKS = 2
-    PREFIX_SIZE = 1048576  # 1MB
-    SLICE_SIZE = 8388608   # 8MB
+    Everything format specific comes from the disk definition: block and
+    directory-entry locations are looked up in tables precomputed once
+    per format (block_run_table()), the directory is parsed into a
+    DirectoryIndex, and directory entries are written with the format's
+    block pointer width and EXM. Any cpmtools-style format therefore runs
+    through the same code; SssdDisk, Hd1kDisk and ComboDisk only add
+    their traditional constants and return conventions.
+    """
 
-    def __init__(self, disk_data):
+    def __init__(self, disk_data, diskdef):
         self.data = disk_data
-        self.dir_offset = self.PREFIX_SIZE + (self.BOOT_TRACKS * self.TRACK_SIZE)
+        self.diskdef = diskdef
+        self.block_runs = block_run_table(diskdef)
+        # Never allocate past the end of a short (non-standard size) image
+        self.total_blocks = self._blocks_in_image(len(disk_data))
+        self.dir_entry_offsets = self._dir_entry_offsets()
+        self.directory = self.read_directory()
+
+    def _blocks_in_image(self, size):
+        """Number of blocks (at most DSM + 1) that lie wholly inside the image."""
+        return blocks_in_image(self.diskdef, size)
+
+    def _dir_entry_offsets(self):
+        """Image offset of each 32-byte directory entry."""
+        block_size = self.diskdef.blocksize
+        offsets = []
+        for entry_num in range(self.diskdef.maxdir):
+            block, pos = divmod(entry_num * 32, block_size)
+            for start, length in self.block_runs[block]:
+                if pos < length:
+                    offsets.append(start + pos)
+                    break
+                pos -= length
+        return offsets
+
+    def block_offset(self, block_num):
+        """Byte offset of a block in an unskewed format (block 0 starts the directory)."""
+        return self.diskdef.data_start + block_num * self.diskdef.blocksize
+
+    def block_spans(self, block_num):
+        """Return the (offset, length) byte ranges holding a block, in order."""
+        if block_num < len(self.block_runs):
+            return self.block_runs[block_num]
+        return ()
 
-    def find_free_dir_entry(self):
-        """Find first free directory entry (starts with 0xE5)."""
-        for i in range(self.DIR_ENTRIES):
-            entry_offset = self.dir_offset + (i * 32)
-            if self.data[entry_offset] == 0xE5:
-                return i
-        return -1
+    def read_block(self, block_num):
+        """Read one allocation block, gathering its sectors in logical order."""
+        runs = self.block_spans(block_num)
+        if STATS is not None:
+            STATS.count_read(1, self.diskdef.blocksize, self.diskdef.seclen)
+        if len(runs) == 1:
+            start, length = runs[0]
+            return bytes(self.data[start:start + length])
+        with buffer_view(self.data) as view:
+            return b''.join([view[start:start + length] for start, length in runs])
 
-    def get_used_blocks(self):
-        """Scan directory to find all used blocks."""
-        used = set(range(8))  # Directory blocks are always used
-        for i in range(self.DIR_ENTRIES):
-            entry_offset = self.dir_offset + (i * 32)
-            user = self.data[entry_offset]
-            if user != 0xE5 and user < 32:
-                for j in range(8):
-                    ptr_offset = entry_offset + 16 + (j * 2)
-                    block = struct.unpack('<H', self.data[ptr_offset:ptr_offset+2])[0]
-                    if block != 0:
-                        used.add(block)
-        return used
-
-    def find_free_block(self, used_blocks):
-        """Find first free block (skip blocks 0-7 used by directory)."""
-        for block in range(8, 2048):
-            if block not in used_blocks:
-                return block
-        return -1
+    def write_block(self, block_num, data):
+        """Write one allocation block, padding short data with ^Z."""
+        self.write_blocks([block_num], data)
 
-    def add_file(self, filename, file_data, user=0, sys_attr=False):
-        """Add a file to the disk image.
+    def write_blocks(self, blocks, file_data):
+        """Write file_data across blocks in order, padding the last block with ^Z.
 
-        Args:
-            filename: Name of the file to add
-            file_data: File contents as bytes
-            user: User number (0-15)
-            sys_attr: If True, set the SYS attribute (makes file visible from any user area)
+        Byte ranges that are adjacent in the image, such as consecutive
+        blocks of an unskewed format, are written with one slice
+        assignment straight from the caller's buffer.
         """
-        name, ext = os.path.splitext(filename.upper())
-        name = name[:8].ljust(8)
-        ext = ext[1:4].ljust(3) if ext else '   '
+        spans = []  # [image offset, source offset, length]
+        pos = 0
+        for block in blocks:
+            for start, length in self.block_spans(block):
+                if spans and spans[-1][0] + spans[-1][2] == start:
+                    spans[-1][2] += length
+                else:
+                    spans.append([start, pos, length])
+                pos += length
+
+        if STATS is not None:
+            STATS.count_write(len(blocks), pos, self.diskdef.seclen)
+        src = memoryview(file_data)
+        for start, pos, length in spans:
+            chunk = src[pos:pos + length]
+            if len(chunk) < length:
+                chunk = bytes(chunk) + b'\x1a' * (length - len(chunk))
+            self.data[start:start + length] = chunk
+
+    def write_block_stream(self, blocks, chunks):
+        """write_blocks() for data arriving as an iterable of buffers.
+
+        Only one chunk is held at a time. Data beyond the blocks is
+        ignored and a short stream is padded with ^Z.
+        """
+        spans = []  # [image offset, length]
+        for block in blocks:
+            for start, length in self.block_spans(block):
+                if spans and spans[-1][0] + spans[-1][1] == start:
+                    spans[-1][1] += length
+                else:
+                    spans.append([start, length])
+        if STATS is not None:
+            STATS.count_write(len(blocks), sum(length for _, length in spans), self.diskdef.seclen)
+
+        chunks = iter(chunks)
+        pending = memoryview(b'')
+        for start, length in spans:
+            end = start + length
+            while start < end:
+                if not pending:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        self.data[start:end] = b'\x1a' * (end - start)
+                        break
+                    pending = memoryview(chunk)
+                    continue
+                count = min(len(pending), end - start)
+                self.data[start:start + count] = pending[:count]
+                pending = pending[count:]
+                start += count
 
-        num_records = (len(file_data) + 127) // 128
-        num_blocks = (len(file_data) + BLOCK_SIZE - 1) // BLOCK_SIZE
-
-        used_blocks = self.get_used_blocks()
-
-        allocated_blocks = []
-        for _ in range(num_blocks):
-            block = self.find_free_block(used_blocks)
-            if block < 0:
-                print(f"Error: No free blocks for {filename}")
-                return False
-            allocated_blocks.append(block)
-            used_blocks.add(block)
-
-        # Write file data to blocks
-        for i, block in enumerate(allocated_blocks):
-            block_offset = self.PREFIX_SIZE + (block * BLOCK_SIZE)
-            start = i * BLOCK_SIZE
-            end = min(start + BLOCK_SIZE, len(file_data))
-            chunk = file_data[start:end]
-            if len(chunk) < BLOCK_SIZE:
-                chunk = chunk + bytes([0x1A] * (BLOCK_SIZE - len(chunk)))
-            self.data[block_offset:block_offset+BLOCK_SIZE] = chunk
-
-        # Create directory entries
-        blocks_per_extent = 8
-        extent_num = 0
-        block_idx = 0
-
-        # Prepare extension bytes with optional SYS attribute
-        ext_bytes = ext.encode('ascii')
-        if sys_attr:
-            ext_bytes = bytes([ext_bytes[0] | 0x80]) + ext_bytes[1:]
-
-        while block_idx < len(allocated_blocks):
-            dir_idx = self.find_free_dir_entry()
-            if dir_idx < 0:
-                print(f"Error: No free directory entry for {filename}")
-                return False
-
-            entry_offset = self.dir_offset + (dir_idx * 32)
-
-            entry = bytearray(32)
-            entry[0] = user
-            entry[1:9] = name.encode('ascii')
-            entry[9:12] = ext_bytes
-            entry[12] = extent_num & 0x1F
-            entry[13] = 0
-            entry[14] = (extent_num >> 5) & 0x3F
-
-            extent_blocks = allocated_blocks[block_idx:block_idx+blocks_per_extent]
-            if block_idx + blocks_per_extent >= len(allocated_blocks):
-                remaining = len(file_data) - (block_idx * BLOCK_SIZE)
-                extent_records = (remaining + 127) // 128
-            else:
-                extent_records = 128
-            entry[15] = min(extent_records, 128)
+    def read_dir_entry(self, entry_num):
+        """Read a directory entry (32 bytes) by entry number."""
+        # Entries never straddle a sector, so each is one contiguous slice
+        offset = self.dir_entry_offsets[entry_num]
+        return bytes(self.data[offset:offset + 32])
+
+    def write_dir_entry(self, entry_num, entry_data):
+        """Write a directory entry (32 bytes) in place by entry number."""
+        offset = self.dir_entry_offsets[entry_num]
+        self.data[offset:offset + 32] = entry_data[:32]
+        if STATS is not None:
+            STATS.dir_entries_written += 1
+            STATS.count_write(0, 32, self.diskdef.seclen)
+
+    def read_directory(self):
+        """Parse the directory blocks into a DirectoryIndex."""
+        d = self.diskdef
+        with stats_phase('directory'):
+            raw = b''.join(self.read_block(b) for b in range(d.dir_blocks))[:d.maxdir * 32]
+            return DirectoryIndex(raw, ptr16=d.ptr16, reserved_blocks=d.dir_blocks,
+                                  total_blocks=self.total_blocks)
 
-            for i, block in enumerate(extent_blocks):
-                struct.pack_into('<H', entry, 16 + i*2, block)
+    def find_free_dir_entry(self):
+        """Return the first free directory entry number, or None."""
+        return self.directory.first_free()
 
-            self.data[entry_offset:entry_offset+32] = entry
+    def find_max_block(self):
+        """Highest block in use (the last directory block on an empty disk)."""
+        return self.directory.max_block()
 
-            block_idx += blocks_per_extent
-            extent_num += 1
+    def iter_file_chunks(self, filename, user=0):
+        """Return an iterator over a file's contents, or None if not found.
 
-        sys_flag = " [SYS]" if sys_attr else ""
-        print(f"Added {filename}{sys_flag}: {len(file_data)} bytes, {num_blocks} blocks")
-        return True
+        The iterator yields memoryviews straight into the image buffer in
+        extent order, with adjacent byte ranges merged into one view and
+        the last view trimmed at the file's record count. Nothing is
+        copied; drop the views before closing a DiskImage.
+        """
+        extents = self.directory.lookup(user, cpm_filename_to_83(filename))
+        if not extents:
+            return None
+        last = extents[-1]
+        size = (last.extent * 128 + last.records) * 128
+        return self._iter_chunks(extents, size)
+
+    def _iter_chunks(self, extents, remaining):
+        if remaining <= 0:
+            return
+        if STATS is not None:
+            STATS.count_read(sum(len(e.blocks) for e in extents), remaining, self.diskdef.seclen)
+        with buffer_view(self.data) as view:
+            start = length = 0
+            for dir_extent in extents:
+                for block in dir_extent.blocks:
+                    for offset, span in self.block_spans(block):
+                        if offset == start + length:
+                            length += span
+                            continue
+                        if length:
+                            chunk = view[start:start + min(length, remaining)]
+                            remaining -= len(chunk)
+                            yield chunk
+                            if remaining <= 0:
+                                return
+                        start, length = offset, span
+            if length and remaining > 0:
+                yield view[start:start + min(length, remaining)]
+
+    def extract_file(self, filename, user=0):
+        """Extract a file from the disk image.
+
+        Returns the file data as bytes, or None if not found.
+        """
+        chunks = self.iter_file_chunks(filename, user)
+        if chunks is None:
+            return None
+        return b''.join(chunks)
 
     def list_files(self):
         """List all files in the directory."""
-        files = {}
-        for i in range(self.DIR_ENTRIES):
-            offset = self.dir_offset + (i * 32)
-            user = self.data[offset]
-            if user != 0xE5 and user < 32:
-                # Validate filename - must be printable ASCII (0x20-0x7E)
-                # Mask off attribute bits (high bit) from extension bytes
-                name_bytes = self.data[offset+1:offset+9]
-                ext_bytes = bytes([b & 0x7F for b in self.data[offset+9:offset+12]])
-                if not all(0x20 <= b <= 0x7E for b in name_bytes):
-                    continue
-                if not all(0x20 <= b <= 0x7E for b in ext_bytes):
-                    continue
+        return self.directory.file_table()
 
-                name = name_bytes.decode('ascii').rstrip()
-                ext = ext_bytes.decode('ascii').rstrip()
-                extent_lo = self.data[offset+12]
-                extent_hi = self.data[offset+14]
-                extent = extent_lo + (extent_hi << 5)
-                records = self.data[offset+15]
+    def add_file(self, filename, file_data, sys_attr=False, user=0):
+        """Add a file to the disk image.
 
-                fullname = f"{name}.{ext}" if ext else name
-                key = (user, fullname)
+        Args:
+            filename: Name of the file to add
+            file_data: File contents as bytes
+            sys_attr: If True, set the SYS attribute (makes file visible from any user area)
+            user: User number (0-15)
+        """
+        return self.add_files([(filename, file_data)], sys_attr=sys_attr, user=user)
 
-                if key not in files:
-                    files[key] = {'extents': 0, 'records': 0, 'blocks': []}
+    def add_files(self, files, sys_attr=False, user=0, quiet=False):
+        """Add a batch of files using a single allocation plan.
 
-                files[key]['extents'] = max(files[key]['extents'], extent + 1)
-                if extent == files[key]['extents'] - 1:
-                    files[key]['records'] = extent * 128 + records
+        Like add_batch(), but prints why a batch does not fit instead of
+        raising, and with quiet prints one summary line for the batch.
 
-                for j in range(8):
-                    block = struct.unpack('<H', self.data[offset+16+j*2:offset+18+j*2])[0]
-                    if block > 0:
-                        files[key]['blocks'].append(block)
+        Args:
+            files: Sequence of (filename, file_data) pairs
+            sys_attr: If True, set the SYS attribute on every file
+            user: User number (0-15)
+            quiet: If True, print one summary line instead of one per file
 
-        return files
+        Returns:
+            True on success, False if the batch does not fit
+        """
+        try:
+            total_bytes, total_blocks = self.add_batch(files, sys_attr, user, quiet)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return False
+        if quiet and files:
+            print(f"Added {len(files)} file(s): {total_bytes} bytes, {total_blocks} blocks")
+        return True
 
-    def delete_file(self, filename, user=0):
-        """Delete a file from the disk image by marking its directory entries as empty."""
-        # Parse filename (8.3 format)
-        name, ext = os.path.splitext(filename.upper())
-        name = name[:8].ljust(8)
-        ext = ext[1:4].ljust(3) if ext else '   '
-
-        deleted_count = 0
-        for i in range(self.DIR_ENTRIES):
-            offset = self.dir_offset + (i * 32)
-            entry_user = self.data[offset]
-            if entry_user == user:
-                entry_name = bytes(self.data[offset+1:offset+9]).decode('ascii')
-                # Mask off attribute bits (high bit) from extension bytes
-                entry_ext_bytes = bytes([b & 0x7F for b in self.data[offset+9:offset+12]])
-                entry_ext = entry_ext_bytes.decode('ascii')
-                if entry_name == name and entry_ext == ext:
-                    # Mark entry as deleted
-                    self.data[offset] = 0xE5
-                    deleted_count += 1
-
-        return deleted_count
+    def add_batch(self, files, sys_attr=False, user=0, quiet=True):
+        """Add a batch of files using a single allocation plan, or raise.
 
-    def extract_file(self, filename, user=0):
-        """Extract a file from the disk image.
+        Every file is sized first and the whole batch is checked against
+        free directory entries and free blocks, so nothing is written
+        unless all files fit. Blocks for the batch come from one first-fit
+        request, which on an unfragmented disk is one contiguous run that
+        is then written front to back.
 
-        Returns the file data as bytes, or None if not found.
+        Args:
+            files: Sequence of (filename, file_data) pairs
+            sys_attr: If True, set the SYS attribute on every file
+            user: User number (0-15)
+            quiet: If False, print a line for each file added
+
+        Returns:
+            (bytes, blocks) the batch took
+
+        Raises:
+            ValueError: The batch does not fit; nothing was written
+        """
+        block_size = self.diskdef.blocksize
+        per_entry = self.diskdef.blocks_per_entry
+        plan = []
+        total_blocks = 0
+        total_extents = 0
+        total_bytes = 0
+        for filename, file_data in files:
+            num_blocks = (len(file_data) + block_size - 1) // block_size
+            plan.append((filename, file_data, num_blocks))
+            total_blocks += num_blocks
+            # An empty file still takes one directory entry
+            total_extents += max(1, (num_blocks + per_entry - 1) // per_entry)
+            total_bytes += len(file_data)
+        if not plan:
+            return 0, 0
+
+        what = plan[0][0] if len(plan) == 1 else f"{len(plan)} files"
+        if total_extents > self.directory.free_count:
+            raise ValueError(f"No free directory entry for {what}: {total_extents} needed, "
+                             f"{self.directory.free_count} free")
+        allocated = self.directory.alv.allocate(total_blocks)
+        if allocated is None:
+            raise ValueError(f"No free blocks for {what}: {total_blocks} needed, "
+                             f"{self.directory.alv.free_count} free")
+
+        pos = 0
+        for filename, file_data, num_blocks in plan:
+            self._write_file(filename, file_data, allocated[pos:pos + num_blocks],
+                             sys_attr, user, quiet)
+            pos += num_blocks
+        return total_bytes, total_blocks
+
+    def _write_file(self, filename, file_data, allocated_blocks, sys_attr, user, quiet):
+        """Store one file in blocks and directory slots already reserved by add_files().
+
+        Each directory entry holds up to blocks_per_entry block pointers,
+        which is EXM + 1 logical 16KB extents. The entry's extent number
+        (EX + S2 << 5) is that of the last logical extent it covers and RC
+        the number of records in that logical extent.
         """
-        # Parse filename (8.3 format)
-        name, ext = os.path.splitext(filename.upper())
-        name = name[:8].ljust(8)
-        ext = ext[1:4].ljust(3) if ext else '   '
-
-        # Collect all extents for this file
-        extents = {}  # extent_num -> (records, blocks)
-        for i in range(self.DIR_ENTRIES):
-            offset = self.dir_offset + (i * 32)
-            entry_user = self.data[offset]
-            if entry_user == user:
-                entry_name = bytes(self.data[offset+1:offset+9]).decode('ascii')
-                # Mask off attribute bits (high bit) from extension bytes
-                entry_ext_bytes = bytes([b & 0x7F for b in self.data[offset+9:offset+12]])
-                entry_ext = entry_ext_bytes.decode('ascii')
-                if entry_name == name and entry_ext == ext:
-                    extent_lo = self.data[offset+12]
-                    extent_hi = self.data[offset+14]
-                    extent_num = extent_lo + (extent_hi << 5)
-                    records = self.data[offset+15]
-                    blocks = []
-                    for j in range(8):
-                        block = struct.unpack('<H', self.data[offset+16+j*2:offset+18+j*2])[0]
-                        if block > 0:
-                            blocks.append(block)
-                    extents[extent_num] = (records, blocks)
+        d = self.diskdef
+        name_83 = cpm_filename_to_83(filename)
+        num_records = (len(file_data) + 127) // 128
+        records_per_block = d.blocksize // 128
+        per_entry = d.blocks_per_entry
 
-        if not extents:
-            return None
+        if not quiet:
+            first_block = allocated_blocks[0] if allocated_blocks else None
+            sys_flag = " [SYS]" if sys_attr else ""
+            user_flag = f" [U{user}]" if user != 0 else ""
+            print(f"Adding {filename}{sys_flag}{user_flag}: {len(file_data)} bytes, {num_records} records, {len(allocated_blocks)} blocks starting at {first_block}")
 
-        # Read data from blocks in extent order
-        file_data = bytearray()
-        for ext_num in sorted(extents.keys()):
-            records, blocks = extents[ext_num]
-            for block in blocks:
-                block_offset = self.PREFIX_SIZE + (block * BLOCK_SIZE)
-                file_data.extend(self.data[block_offset:block_offset + BLOCK_SIZE])
+        # User number, name and extension; SYS is the high bit of T2
+        header = bytearray([user]) + name_83.encode('ascii')
+        if sys_attr:
+            header[10] |= 0x80
 
-        # Trim to actual size based on last extent's record count
-        last_ext = max(extents.keys())
-        total_records = last_ext * 128 + extents[last_ext][0]
-        actual_size = total_records * 128
-        return bytes(file_data[:actual_size])
+        # Write file data to blocks first
+        if isinstance(file_data, HostFile):
+            self.write_block_stream(allocated_blocks, file_data.chunks())
+        else:
+            self.write_blocks(allocated_blocks, file_data)
 
-    def read_boot_area(self):
-        """Read the boot area (first 2 tracks) from the first slice.
+        for block_idx in range(0, max(len(allocated_blocks), 1), per_entry):
+            extent_blocks = allocated_blocks[block_idx:block_idx + per_entry]
+            records = min(num_records, (block_idx + len(extent_blocks)) * records_per_block)
+            extent_num = (records - 1) // 128 if records else 0
+            extent_records = records - extent_num * 128
 
-        Returns 16384 bytes (2 tracks × 16 sectors × 512 bytes).
-        Boot area starts after the 1MB MBR prefix.
-        No skew is applied to hard disk formats.
+            if d.ptr16:
+                pointers = struct.pack(f'<{len(extent_blocks)}H', *extent_blocks)
+            else:
+                pointers = bytes(extent_blocks)
+            entry = (header
+                     + bytes([extent_num & 0x1F, 0, (extent_num >> 5) & 0x3F, extent_records])
+                     + pointers.ljust(16, b'\x00'))
+
+            dir_slot = self.directory.take_free_slot()
+            self.write_dir_entry(dir_slot, entry)
+            self.directory.add_extent(dir_slot, user, name_83, extent_num,
+                                      extent_records, extent_blocks)
+
+    def delete_file(self, filename, user=0):
+        """Delete a file by marking its directory entries as empty.
+
+        Returns the number of directory entries freed.
         """
-        boot_size = self.BOOT_TRACKS * self.TRACK_SIZE
-        start = self.PREFIX_SIZE
-        return bytes(self.data[start:start + boot_size])
+        slots = self.directory.remove_file(user, cpm_filename_to_83(filename))
+        for slot in slots:
+            self.data[self.dir_entry_offsets[slot]] = 0xE5
+        return len(slots)
+
+    def read_boot_area(self):
+        """Read the boot area (the reserved tracks). No skew is applied."""
+        start = self.diskdef.offset
+        if STATS is not None:
+            STATS.count_read(0, self.diskdef.boot_size, self.diskdef.seclen)
+        return bytes(self.data[start:start + self.diskdef.boot_size])
 
     def write_boot_area(self, data):
-        """Write data to the boot area (first 2 tracks) of the first slice.
+        """Write the boot area (the reserved tracks). No skew is applied.
 
-        Data is padded or truncated to exactly 16384 bytes.
-        Boot area starts after the 1MB MBR prefix.
-        No skew is applied to hard disk formats.
+        Data is padded or truncated to exactly the boot area size.
         """
-        boot_size = self.BOOT_TRACKS * self.TRACK_SIZE
+        boot_size = self.diskdef.boot_size
         # Pad or truncate to boot area size
         if len(data) < boot_size:
             data = data + bytes(boot_size - len(data))
         elif len(data) > boot_size:
             data = data[:boot_size]
-        start = self.PREFIX_SIZE
+        start = self.diskdef.offset
         self.data[start:start + boot_size] = data
+        if STATS is not None:
+            STATS.count_write(0, boot_size, self.diskdef.seclen)
+
+
+class SssdDisk(CpmDisk):
+    """SSSD (ibm-3740) 8" floppy disk format."""
+
+    SECTOR_SIZE = SSSD_SECTOR_SIZE  # 128 bytes
+    SECTORS_PER_TRACK = SSSD_SECTORS_PER_TRACK  # 26
+    BLOCK_SIZE = SSSD_BLOCK_SIZE  # 1024 bytes
+    DIR_ENTRIES = SSSD_DIR_ENTRIES  # 64
+    BOOT_TRACKS = SSSD_BOOT_TRACKS  # 2
+    DIR_START = SSSD_DIR_START  # 6656 bytes (2 tracks * 26 sectors * 128 bytes)
+    # With 1KB blocks and DSM < 256, block pointers are 8-bit
+    # EXM = 0 for 1KB blocks, so each extent = 128 records = 16KB = 16 blocks
+    BLOCKS_PER_EXTENT = 16
+    RECORDS_PER_BLOCK = BLOCK_SIZE // 128  # 8 records per 1KB block
+    # Data area = 75 tracks * 26 sectors * 128 bytes = 243 whole blocks (DSM = 242)
+    TOTAL_BLOCKS = ((SSSD_TRACKS - BOOT_TRACKS) * SECTORS_PER_TRACK * SECTOR_SIZE) // BLOCK_SIZE
+
+    def __init__(self, disk_data, use_skew=True):
+        self.use_skew = use_skew
+        self.skew_table = SSSD_SKEW_TABLE if use_skew else list(range(self.SECTORS_PER_TRACK))
+        super().__init__(disk_data, DISKDEFS['ibm-3740' if use_skew else 'ibm-3740-noskew'])
+
+    def logical_sector_to_offset(self, track, logical_sector):
+        """Convert (track, logical_sector) to byte offset in disk image.
+
+        Boot tracks (0-1) have no skew; data tracks use skew table.
+        logical_sector is 0-indexed.
+        """
+        if track < self.BOOT_TRACKS:
+            # Boot tracks: no skew
+            physical_sector = logical_sector
+        else:
+            # Data tracks: apply skew
+            physical_sector = self.skew_table[logical_sector]
+        return (track * self.SECTORS_PER_TRACK + physical_sector) * self.SECTOR_SIZE
+
+    def read_sector(self, track, logical_sector):
+        """Read a single logical sector from disk."""
+        offset = self.logical_sector_to_offset(track, logical_sector)
+        if STATS is not None:
+            STATS.count_read(0, self.SECTOR_SIZE, self.SECTOR_SIZE)
+        return bytes(self.data[offset:offset + self.SECTOR_SIZE])
+
+    def write_sector(self, track, logical_sector, data):
+        """Write a single logical sector to disk."""
+        offset = self.logical_sector_to_offset(track, logical_sector)
+        self.data[offset:offset + self.SECTOR_SIZE] = data[:self.SECTOR_SIZE]
+        if STATS is not None:
+            STATS.count_write(0, self.SECTOR_SIZE, self.SECTOR_SIZE)
+
+
+class Hd1kDisk(CpmDisk):
+    """Standard hd1k disk format (RomWBW compatible)."""
+
+    SECTOR_SIZE = SECTOR_SIZE_HD  # 512 bytes
+    SECTORS_PER_TRACK = 16
+    DIR_ENTRIES = 1024
+    BOOT_TRACKS = 2
+    DIR_START = BOOT_TRACKS * SECTORS_PER_TRACK * SECTOR_SIZE_HD  # 0x4000 (16KB)
+    BLOCK_SIZE = BLOCK_SIZE
+    BLOCKS_PER_EXTENT = 8  # 16-bit block pointers
+    # Data area = 1022 tracks * 8KB = 2044 blocks (DSM = 2043)
+    TOTAL_BLOCKS = (HD1K_SINGLE_SIZE - DIR_START) // BLOCK_SIZE
+
+    def __init__(self, disk_data):
+        super().__init__(disk_data, DISKDEFS['wbw_hd1k'])
+
+    def find_free_dir_entry(self):
+        """Find first free directory entry (starts with 0xE5).
+
+        Returns its byte offset in the image, or None.
+        """
+        slot = self.directory.first_free()
+        if slot is None:
+            return None
+        return self.DIR_START + (slot * 32)
+
+
+class ComboDisk(CpmDisk):
+    """Combo disk with 1MB prefix followed by 8MB hd1k slices.
+
+    Each ComboDisk object addresses one slice; open several objects over
+    the same image data to work on several slices.
+    """
+
+    SECTOR_SIZE = SECTOR_SIZE_HD  # 512 bytes
+    SECTORS_PER_TRACK = 16
+    TRACK_SIZE = SECTOR_SIZE_HD * SECTORS_PER_TRACK
+    DIR_ENTRIES = 1024
+    BOOT_TRACKS = 2
+    PREFIX_SIZE = 1048576  # 1MB
+    SLICE_SIZE = 8388608   # 8MB
+    BLOCK_SIZE = BLOCK_SIZE
+    BLOCKS_PER_EXTENT = 8  # 16-bit block pointers
+    # Each slice is laid out like hd1k: 2044 blocks (DSM = 2043)
+    TOTAL_BLOCKS = (SLICE_SIZE - BOOT_TRACKS * TRACK_SIZE) // BLOCK_SIZE
+
+    def __init__(self, disk_data, slice_num=0):
+        num_slices = combo_slice_count(disk_data)
+        if not 0 <= slice_num < num_slices:
+            raise ValueError(f"slice {slice_num} out of range (0-{num_slices - 1})")
+        self.slice_num = slice_num
+        self.slice_offset = self.PREFIX_SIZE + (slice_num * self.SLICE_SIZE)
+        # Within a slice the layout is hd1k: 2 boot tracks, then block 0
+        # (the directory) and the rest of the data area
+        self.dir_offset = self.slice_offset + (self.BOOT_TRACKS * self.TRACK_SIZE)
+        super().__init__(disk_data, DISKDEFS['wbw_hd1k']._replace(offset=self.slice_offset))
+
+    def find_free_dir_entry(self):
+        """Find first free directory entry (starts with 0xE5).
+
+        Returns the entry number, or -1 if the directory is full.
+        """
+        slot = self.directory.first_free()
+        return -1 if slot is None else slot
+
+    def get_used_blocks(self):
+        """Return the set of used blocks (directory blocks 0-7 included)."""
+        return self.directory.used_blocks
+
+    def add_file(self, filename, file_data, user=0, sys_attr=False):
+        """Add a file to the disk image.
+
+        Args:
+            filename: Name of the file to add
+            file_data: File contents as bytes
+            user: User number (0-15)
+            sys_attr: If True, set the SYS attribute (makes file visible from any user area)
+        """
+        return self.add_files([(filename, file_data)], sys_attr=sys_attr, user=user)
 
 
 def cmd_create(args):
@@ -1150,23 +2360,57 @@ def cmd_create(args):
         return 1
 
     # Determine format to create
-    if getattr(args, 'sssd', False):
-        disk_data = create_sssd_disk()
-        size_desc = f"{len(disk_data) // 1024}KB SSSD (ibm-3740)"
+    preallocate = getattr(args, 'preallocate', False)
+    diskdef = getattr(args, 'diskdef', None)
+    if diskdef:
+        size = create_image_file(args.disk, diskdef, preallocate)
+        size_desc = f"{size // 1024}KB {diskdef}"
+    elif getattr(args, 'sssd', False):
+        size = create_image_file(args.disk, 'sssd', preallocate)
+        size_desc = f"{size // 1024}KB SSSD (ibm-3740)"
     elif getattr(args, 'combo', False):
-        disk_data = create_hd1k_disk(combo=True)
-        size_desc = f"{len(disk_data) // 1048576}MB combo (6 slices)"
+        size = create_image_file(args.disk, 'combo', preallocate)
+        size_desc = f"{size // 1048576}MB combo (6 slices)"
     else:
-        disk_data = create_hd1k_disk(combo=False)
-        size_desc = f"{len(disk_data) // 1048576}MB hd1k"
-
-    with open(args.disk, 'wb') as f:
-        f.write(disk_data)
+        size = create_image_file(args.disk, 'hd1k', preallocate)
+        size_desc = f"{size // 1048576}MB hd1k"
 
     print(f"Created {size_desc} disk: {args.disk}")
     return 0
 
 
+def cmd_format(args):
+    """Re-initialize the directories of an existing disk image in place.
+
+    Only the directory regions are rewritten; file data is left on disk
+    but no longer referenced. Combo disks have every slice formatted
+    unless --slice is given.
+    """
+    with open_image(args.disk, writable=True) as image:
+        fmt = get_format_hint(args, image) or detect_disk_format(image)
+        slice_num = getattr(args, 'slice', None)
+        if slice_num is not None and fmt != 'combo':
+            raise ValueError(f"slice {slice_num} requested but disk is {fmt}, not combo")
+        if fmt == 'combo':
+            num_slices = combo_slice_count(image)
+            if slice_num is None:
+                slices = range(num_slices)
+            elif 0 <= slice_num < num_slices:
+                slices = [slice_num]
+            else:
+                raise ValueError(f"slice {slice_num} out of range (0-{num_slices - 1})")
+        else:
+            slices = [0]
+
+        regions = directory_regions(fmt, slices)
+        for offset, region in regions:
+            image[offset:offset + len(region)] = region
+        image.commit()
+
+    print(f"Formatted {len(regions)} directory area(s) on {args.disk} ({fmt})")
+    return 0
+
+
 def detect_disk_format(disk_data):
     """Auto-detect disk format based on size and signatures.
 
@@ -1198,7 +2442,7 @@ def detect_disk_format(disk_data):
         return 'sssd'
 
 
-def get_disk_object(disk_data, format_hint=None):
+def get_disk_object(disk_data, format_hint=None, slice_num=0):
     """Get appropriate disk object for the format.
 
     Args:
@@ -1208,23 +2452,31 @@ def get_disk_object(disk_data, format_hint=None):
             'sssd-noskew' - ibm-3740 without skew
             'hd1k' - standard hd1k format
             'combo' - combo disk with MBR
+            any other name - a DISKDEFS format (e.g. 'kpii', 'osborne1')
+        slice_num: Slice to open on a combo disk (other formats only have 0)
 
     Returns:
-        Disk object (SssdDisk, Hd1kDisk, or ComboDisk)
+        Disk object (SssdDisk, Hd1kDisk, ComboDisk, or CpmDisk for
+        other formats)
     """
     if format_hint:
         fmt = format_hint
     else:
         fmt = detect_disk_format(disk_data)
 
+    if slice_num and fmt != 'combo':
+        raise ValueError(f"slice {slice_num} requested but disk is {fmt}, not combo")
+
     if fmt == 'sssd':
         return SssdDisk(disk_data, use_skew=True)
     elif fmt == 'sssd-noskew':
         return SssdDisk(disk_data, use_skew=False)
     elif fmt == 'combo':
-        return ComboDisk(disk_data)
-    else:
+        return ComboDisk(disk_data, slice_num)
+    elif fmt == 'hd1k':
         return Hd1kDisk(disk_data)
+    else:
+        return CpmDisk(disk_data, lookup_diskdef(fmt))
 
 
 def is_combo_disk(disk_data):
@@ -1234,6 +2486,8 @@ def is_combo_disk(disk_data):
 
 def get_format_hint(args, disk_data):
     """Determine format hint from args and disk data."""
+    if getattr(args, 'diskdef', None):
+        return args.diskdef
     if getattr(args, 'sssd', False):
         return 'sssd-noskew' if getattr(args, 'no_skew', False) else 'sssd'
     elif getattr(args, 'combo', False):
@@ -1245,41 +2499,201 @@ def get_format_hint(args, disk_data):
     return None
 
 
-def cmd_add(args):
-    """Add files to a disk image."""
-    with open(args.disk, 'rb') as f:
-        disk_data = bytearray(f.read())
+def open_disk(args, writable=False):
+    """Open args.disk with open_image() and wrap it in the matching disk object.
 
-    disk = get_disk_object(disk_data, get_format_hint(args, disk_data))
+    Returns:
+        (image, disk) tuple. The caller commits and closes the image.
+    """
+    image = open_image(args.disk, writable=writable)
+    try:
+        disk = get_disk_object(image, get_format_hint(args, image), getattr(args, 'slice', 0))
+    except ValueError:
+        image.close()
+        raise
+    return image, disk
 
-    sys_attr = getattr(args, 'sys', False)
-    user = getattr(args, 'user', 0)
 
-    for filepath in args.files:
-        filename = os.path.basename(filepath)
-        with open(filepath, 'rb') as f:
-            file_data = f.read()
-        if not disk.add_file(filename, file_data, sys_attr=sys_attr, user=user):
-            return 1
+def select_slices(args, disk_data):
+    """Resolve the disk format and the slices a command should act on.
 
-    with open(args.disk, 'wb') as f:
-        f.write(disk_data)
+    --all-slices selects every slice of a combo disk, otherwise --slice N
+    (default 0) is used. Non-combo formats only have slice 0.
 
-    print(f"Successfully updated {args.disk}")
-    return 0
+    Returns:
+        (format name, list of slice numbers)
+    """
+    fmt = get_format_hint(args, disk_data) or detect_disk_format(disk_data)
+    if getattr(args, 'all_slices', False):
+        if fmt == 'combo':
+            return fmt, list(range(combo_slice_count(disk_data)))
+        return fmt, [0]
+    return fmt, [getattr(args, 'slice', 0)]
 
 
-def cmd_list(args):
-    """List files in a disk image."""
-    with open(args.disk, 'rb') as f:
-        disk_data = bytearray(f.read())
+def run_per_slice(func, slices, *args):
+    """Call func(slice_num, *args) for every slice and return the results in order.
+
+    With more than one slice the calls fan out across a process pool; each
+    worker maps the image itself, so nothing is copied between processes.
+    """
+    if len(slices) <= 1:
+        return [func(slice_num, *args) for slice_num in slices]
+    workers = min(len(slices), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(func, slice_num, *args) for slice_num in slices]
+        return [future.result() for future in futures]
 
-    disk = get_disk_object(disk_data, get_format_hint(args, disk_data))
-    files = disk.list_files()
 
+def list_slice(slice_num, path, fmt):
+    """Return the file table of one slice (process pool worker)."""
+    with open_image(path) as image:
+        return get_disk_object(image, fmt, slice_num).list_files()
+
+
+def write_chunks(f, chunks):
+    """Write an iterable of buffers to a binary file, returning the byte count.
+
+    Uses os.writev() on the file's descriptor where available so the
+    chunks go to the kernel without being joined first; otherwise falls
+    back to writelines().
+    """
+    chunks = list(chunks)
+    total = sum(len(c) for c in chunks)
+    if STATS is not None:
+        STATS.bytes_copied += total
+    try:
+        fd = f.fileno()
+    except (AttributeError, OSError, ValueError):
+        fd = None
+    if fd is None or not hasattr(os, 'writev'):
+        f.writelines(chunks)
+        return total
+
+    f.flush()
+    iov_max = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+    pos = 0
+    while pos < len(chunks):
+        written = os.writev(fd, chunks[pos:pos + iov_max])
+        # Skip what was written; a partial write leaves a trimmed chunk
+        while written and pos < len(chunks):
+            if written >= len(chunks[pos]):
+                written -= len(chunks[pos])
+                pos += 1
+            else:
+                chunks[pos] = chunks[pos][written:]
+                written = 0
+        while pos < len(chunks) and not len(chunks[pos]):
+            pos += 1
+    return total
+
+
+def write_file_chunks(out_path, chunks):
+    """Write one extracted file (thread pool worker); returns its size."""
+    with open(out_path, 'wb') as f:
+        return write_chunks(f, chunks)
+
+
+def extract_from_disk(disk, patterns, user, output_dir, all_users=False):
+    """Extract files matching CP/M patterns from a disk object.
+
+    Every pattern is resolved against the disk's directory index, so
+    '*.COM' or '*.*' work as well as exact names. Matching files are
+    written through a thread pool. With all_users, files from every user
+    area are extracted into output_dir/user<N>; otherwise only user's.
+
+    An output_dir of '-' writes the file contents to stdout instead, in
+    order.
+
+    Returns a list of (pattern, filename, out_path, size) tuples; a
+    pattern that matched nothing gives one tuple with out_path None.
+    """
+    results = []
+    jobs = []
+    seen = set()
+    for pattern in patterns:
+        keys = disk.directory.match(cpm_pattern_to_83(pattern),
+                                    None if all_users else user)
+        if not keys:
+            results.append((pattern, pattern, None, 0))
+            continue
+        for key in keys:
+            if key in seen:
+                continue
+            seen.add(key)
+            file_user, name_83 = key
+            filename = cpm_83_to_filename(name_83)
+            label = f"{filename} (user {file_user})" if all_users else filename
+            chunks = disk.iter_file_chunks(filename, user=file_user)
+
+            if output_dir == '-':
+                size = write_chunks(sys.stdout.buffer, chunks)
+                results.append((pattern, label, '-', size))
+                continue
+
+            out_dir = output_dir
+            if all_users:
+                out_dir = os.path.join(output_dir, f"user{file_user}")
+            os.makedirs(out_dir, exist_ok=True)
+            out_path = os.path.join(out_dir, os.path.basename(filename).lower())
+            jobs.append((pattern, label, out_path, chunks))
+
+    if len(jobs) == 1:
+        pattern, label, out_path, chunks = jobs[0]
+        results.append((pattern, label, out_path, write_file_chunks(out_path, chunks)))
+    elif jobs:
+        with ThreadPoolExecutor() as pool:
+            sizes = pool.map(write_file_chunks, [j[2] for j in jobs], [j[3] for j in jobs])
+            for (pattern, label, out_path, _), size in zip(jobs, sizes):
+                results.append((pattern, label, out_path, size))
+    return results
+
+
+def extract_slice(slice_num, path, fmt, patterns, user, output_dir,
+                  slice_subdir=False, all_users=False):
+    """Run extract_from_disk() on one slice of an image (process pool worker).
+
+    With slice_subdir, output_dir/slice<N> is used instead of output_dir,
+    since the same names usually exist on several slices.
+    """
+    if slice_subdir:
+        output_dir = os.path.join(output_dir, f"slice{slice_num}")
+    with open_image(path) as image:
+        disk = get_disk_object(image, fmt, slice_num)
+        return extract_from_disk(disk, patterns, user, output_dir, all_users)
+
+
+def cmd_add(args):
+    """Add files to a disk image."""
+    with open_image(args.disk, writable=True) as image:
+        fmt, slices = select_slices(args, image)
+        sys_attr = getattr(args, 'sys', False)
+        user = getattr(args, 'user', 0)
+        quiet = getattr(args, 'quiet', False)
+
+        batch = []
+        for filepath in args.files:
+            with open(filepath, 'rb') as f:
+                batch.append((os.path.basename(filepath), f.read()))
+
+        for slice_num in slices:
+            if len(slices) > 1:
+                print(f"Slice {slice_num}:")
+            disk = get_disk_object(image, fmt, slice_num)
+            if not disk.add_files(batch, sys_attr=sys_attr, user=user, quiet=quiet):
+                return 1
+
+        image.commit()
+
+    print(f"Successfully updated {args.disk}")
+    return 0
+
+
+def print_file_table(files):
+    """Print a list_files() result as a table."""
     if not files:
         print("No files found")
-        return 0
+        return
 
     print(f"{'User':<5} {'Filename':<12} {'Size':>8} {'Blocks':>6}")
     print("-" * 35)
@@ -1289,152 +2703,2148 @@ def cmd_list(args):
         blocks = len(info['blocks'])
         print(f"{user:<5} {name:<12} {size:>8} {blocks:>6}")
 
+
+def cmd_list(args):
+    """List files in a disk image."""
+    with open_image(args.disk) as image:
+        fmt, slices = select_slices(args, image)
+
+    tables = run_per_slice(list_slice, slices, args.disk, fmt)
+    for slice_num, files in zip(slices, tables):
+        if len(slices) > 1:
+            print(f"{chr(10) if slice_num else ''}Slice {slice_num}:")
+        print_file_table(files)
+
     return 0
 
 
-def cmd_delete(args):
-    """Delete files from a disk image."""
-    with open(args.disk, 'rb') as f:
-        disk_data = bytearray(f.read())
+def verify_volume(disk_data, diskdef):
+    """Check one CP/M filesystem for directory and allocation damage.
 
-    disk = get_disk_object(disk_data, get_format_hint(args, disk_data))
+    The directory is decoded once. Each block pointer is tallied in a
+    bytearray with one counter per block, and then checked for:
+      out-of-range     pointer past DSM or past the end of the image
+      reserved-block   pointer into the directory blocks
+      double-allocated block referenced by more than one pointer
+      orphaned         block held by an entry whose name is not readable,
+                       so no file owns it and it can never be freed
+      extent-gap       a file's directory entries skip an extent
+      extent-duplicate two entries claim the same extent of a file
+      rc-invalid       RC byte above 0x80
+      rc-mismatch      records counted by EX/RC need a different number of
+                       blocks than the entry points to (a full-size
+                       entry is expected before the last one)
 
-    # Get list of all files
-    files = disk.list_files()
+    Returns:
+        dict with 'files', 'entries', 'blocks_used', 'total_blocks' and
+        'problems', a list of dicts each with 'kind' and 'message', plus
+        'block' or 'file' where they apply
+    """
+    d = diskdef
+    runs = block_run_table(d)
+    size = len(disk_data)
+    total_blocks = blocks_in_image(d, size)
+    with buffer_view(disk_data) as view:
+        raw = b''.join([view[start:start + length]
+                        for block in range(min(d.dir_blocks, total_blocks))
+                        for start, length in runs[block]])[:d.maxdir * 32]
+    unpack_ptrs = struct.Struct('<8H' if d.ptr16 else '16B').unpack_from
+    records_per_entry = (d.exm + 1) * 128
+    records_per_block = d.blocksize // 128
+
+    owners = bytearray(d.dsm + 1)
+    problems = []
+    files = {}      # (user, name_83) -> [(slot, extent, rc, blocks)]
+    entries = []    # (slot, label, blocks) for every live entry
+    for slot in range(len(raw) // 32):
+        offset = slot * 32
+        user = raw[offset]
+        if user >= 32:
+            continue
+        blocks = [b for b in unpack_ptrs(raw, offset + 16) if b]
+        name_bytes = bytes(b & 0x7F for b in raw[offset + 1:offset + 12])
+        if all(0x20 <= b <= 0x7E for b in name_bytes):
+            name_83 = name_bytes.decode('ascii')
+            label = f"{user}:{cpm_83_to_filename(name_83)}"
+            extent = (raw[offset + 12] & 0x1F) + ((raw[offset + 14] & 0x3F) << 5)
+            files.setdefault((user, name_83), []).append((slot, extent, raw[offset + 15], blocks))
+        else:
+            label = None
+            for block in blocks:
+                problems.append({'kind': 'orphaned', 'block': block,
+                                 'message': f"block {block} held by unreadable entry {slot}"})
+        entries.append((slot, label, blocks))
+        for block in blocks:
+            if block > d.dsm:
+                problems.append({'kind': 'out-of-range', 'block': block, 'file': label,
+                                 'message': f"entry {slot} ({label}): block {block} > DSM {d.dsm}"})
+                continue
+            if block >= total_blocks:
+                problems.append({'kind': 'out-of-range', 'block': block, 'file': label,
+                                 'message': f"entry {slot} ({label}): block {block} is past the end of the image"})
+            elif block < d.dir_blocks:
+                problems.append({'kind': 'reserved-block', 'block': block, 'file': label,
+                                 'message': f"entry {slot} ({label}): block {block} is a directory block"})
+            if owners[block] < 255:
+                owners[block] += 1
+
+    shared = {block for block in range(len(owners)) if owners[block] > 1}
+    if shared:
+        holders = {}
+        for slot, label, blocks in entries:
+            for block in blocks:
+                if block in shared:
+                    holders.setdefault(block, []).append(label or f"entry {slot}")
+        for block in sorted(holders):
+            problems.append({'kind': 'double-allocated', 'block': block,
+                             'message': f"block {block} is used {len(holders[block])} times: "
+                                        f"{', '.join(holders[block])}"})
+
+    for (user, name_83), extents in files.items():
+        label = f"{user}:{cpm_83_to_filename(name_83)}"
+        extents.sort(key=lambda e: e[1])
+        seen = set()
+        last_index = extents[-1][1] // (d.exm + 1)
+        for slot, extent, rc, blocks in extents:
+            index = extent // (d.exm + 1)
+            if index in seen:
+                problems.append({'kind': 'extent-duplicate', 'file': label,
+                                 'message': f"{label}: entry {slot} repeats extent {extent}"})
+                continue
+            seen.add(index)
+            if rc > 0x80:
+                problems.append({'kind': 'rc-invalid', 'file': label,
+                                 'message': f"{label}: entry {slot} has RC {rc:#04x}"})
+                continue
+            records = extent * 128 + rc - index * records_per_entry
+            if index < last_index:
+                records = records_per_entry if records == records_per_entry else -1
+            expected = -(-max(records, 0) // records_per_block)
+            if records < 0 or len(blocks) != expected:
+                problems.append({'kind': 'rc-mismatch', 'file': label,
+                                 'message': f"{label}: entry {slot} (extent {extent}, RC {rc}) "
+                                            + ("is not full but is not the last entry" if records < 0 else
+                                               f"has {len(blocks)} blocks, expected {expected}")})
+        missing = sorted(set(range(last_index + 1)) - seen)
+        if missing:
+            problems.append({'kind': 'extent-gap', 'file': label,
+                             'message': f"{label}: missing directory entries for extent(s) "
+                                        f"{', '.join(str(i * (d.exm + 1)) for i in missing)}"})
+
+    return {'files': len(files), 'entries': len(entries),
+            'blocks_used': sum(1 for count in owners if count),
+            'total_blocks': total_blocks, 'problems': problems}
+
+
+def cmd_verify(args):
+    """Check every filesystem in an image for directory and allocation damage."""
+    start = time.perf_counter()
+    with open_image(args.disk) as image:
+        fmt = get_format_hint(args, image) or detect_disk_format(image)
+        diskdefs = format_diskdefs(fmt, len(image))
+        slices = range(len(diskdefs)) if args.slice is None else [args.slice]
+        volumes = []
+        for slice_num in slices:
+            if not 0 <= slice_num < len(diskdefs):
+                raise ValueError(f"slice {slice_num} out of range (image has {len(diskdefs)})")
+            report = verify_volume(image, diskdefs[slice_num])
+            report['slice'] = slice_num
+            volumes.append(report)
+    elapsed = time.perf_counter() - start
+    problems = sum(len(volume['problems']) for volume in volumes)
+
+    if args.json:
+        print(json.dumps({'image': args.disk, 'format': fmt, 'ok': not problems,
+                          'seconds': round(elapsed, 6), 'volumes': volumes}, indent=1))
+    else:
+        for volume in volumes:
+            where = f"slice {volume['slice']}" if fmt == 'combo' else fmt
+            print(f"{args.disk} {where}: {volume['files']} files, {volume['entries']} entries, "
+                  f"{volume['blocks_used']}/{volume['total_blocks']} blocks used, "
+                  f"{len(volume['problems'])} problem(s)")
+            for problem in volume['problems']:
+                print(f"  {problem['kind']}: {problem['message']}")
+        print(f"{'FAILED' if problems else 'OK'}: {problems} problem(s) in {len(volumes)} "
+              f"filesystem(s) ({elapsed * 1000:.1f} ms)")
+    return 1 if problems else 0
+
+
+def compact_plan(disk):
+    """Plan the block moves that defragment a CP/M filesystem.
+
+    Files are laid out one after another in directory order (by the slot
+    of their first entry), each in extent order, starting right after the
+    directory, so every file becomes contiguous and the free space ends
+    up at the end. Blocks already in their final place are not moved.
+
+    Moves are grouped into passes. Every move in a pass copies into a
+    block that is free before the pass starts, so after a pass's data is
+    written the old directory is still valid; once the directory is
+    updated the sources are free for the next pass. Blocks that only
+    swap places (cycles) are broken by parking one block in the free
+    space past the packed area, which costs one extra move per cycle.
+
+    Returns:
+        List of passes, each a list of (source, destination, count) runs
+        of consecutive blocks, sorted by source
+
+    Raises:
+        ValueError: if blocks have to swap places on a full disk
+    """
+    d = disk.diskdef
+    extent_lists = sorted(disk.directory.files.values(),
+                          key=lambda extents: min(e.slot for e in extents))
+    order = [block for extents in extent_lists for e in extents for block in e.blocks]
+    end = d.dir_blocks + len(order)
+    target = {block: d.dir_blocks + i for i, block in enumerate(order)}
+    occupant = {block: block for block in order}  # current block -> original block
+    where = {block: block for block in order}     # original block -> current block
+
+    ready = []
+    waiting = {}  # target block -> original block waiting for it to be freed
+    for block in order:
+        if target[block] == block:
+            continue
+        if target[block] in occupant:
+            waiting[target[block]] = block
+        else:
+            ready.append(block)
+
+    passes = []
+    spare = end
+    while ready or waiting:
+        if ready:
+            moves = [(where[block], target[block]) for block in ready]
+        else:
+            # Every remaining block waits on another, so they form cycles:
+            # park one block of each cycle outside the packed area
+            moves = []
+            state = {}  # target -> 1 while on the current walk, 2 when done
+            for start in sorted(waiting):
+                walk = []
+                t = start
+                while t in waiting and t not in state:
+                    state[t] = 1
+                    walk.append(t)
+                    t = target[occupant[t]]
+                if state.get(t) == 1:
+                    while spare < disk.total_blocks and spare in occupant:
+                        spare += 1
+                    if spare >= disk.total_blocks:
+                        raise ValueError("no free block to break a cycle of block moves (disk is full)")
+                    moves.append((t, spare))
+                    spare += 1
+                for t in walk:
+                    state[t] = 2
+        ready = []
+        for src, dst in moves:
+            block = occupant.pop(src)
+            occupant[dst] = block
+            where[block] = dst
+            if src in waiting:
+                ready.append(waiting.pop(src))
+
+        runs = []
+        for src, dst in sorted(moves):
+            if runs and runs[-1][0] + runs[-1][2] == src and runs[-1][1] + runs[-1][2] == dst:
+                runs[-1][2] += 1
+            else:
+                runs.append([src, dst, 1])
+        passes.append([tuple(run) for run in runs])
+    return passes
+
+
+def apply_compaction(disk, passes, commit=None):
+    """Carry out a compact_plan() on disk.
+
+    Each pass copies its runs block range by block range, then rewrites
+    the block pointers of the directory entries that referenced moved
+    blocks. commit (if given) is called after the data of each pass and
+    again after its directory update, so an image committed that way is
+    consistent at every step. The disk's DirectoryIndex is stale
+    afterwards; open the image again to use it.
+
+    Returns:
+        Number of blocks copied
+    """
+    d = disk.diskdef
+    pack_ptrs = struct.Struct('<8H' if d.ptr16 else '16B')
+    slot_of = {}
+    for extents in disk.directory.files.values():
+        for dir_extent in extents:
+            for block in dir_extent.blocks:
+                slot_of[block] = dir_extent.slot
+
+    copied = 0
+    for runs in passes:
+        moved = {}
+        for src, dst, count in runs:
+            data = b''.join([disk.read_block(src + i) for i in range(count)])
+            disk.write_blocks(list(range(dst, dst + count)), data)
+            moved.update((src + i, dst + i) for i in range(count))
+            copied += count
+        if commit is not None:
+            commit()
+
+        slots = set()
+        for src, dst in moved.items():
+            slot = slot_of.pop(src)
+            slots.add(slot)
+            slot_of[dst] = slot
+        for slot in sorted(slots):
+            offset = disk.dir_entry_offsets[slot]
+            entry = bytes(disk.data[offset:offset + 32])
+            pointers = [moved.get(block, block) for block in pack_ptrs.unpack_from(entry, 16)]
+            disk.write_dir_entry(slot, entry[:16] + pack_ptrs.pack(*pointers))
+        if commit is not None:
+            commit()
+    return copied
+
+
+def cmd_compact(args):
+    """Defragment a disk image so every file is contiguous."""
+    with open_image(args.disk, writable=not args.dry_run) as image:
+        fmt, slices = select_slices(args, image)
+        # Raw images are committed step by step; other containers rewrite
+        # the whole file on commit, which is atomic, so once at the end will do
+        commit = image.commit if isinstance(image, DiskImage) and not args.dry_run else None
+        for slice_num in slices:
+            prefix = f"Slice {slice_num}: " if len(slices) > 1 else ""
+            disk = get_disk_object(image, fmt, slice_num)
+            problems = verify_volume(image, disk.diskdef)['problems']
+            if problems:
+                raise ValueError(f"{prefix}{args.disk} has {len(problems)} directory problem(s); "
+                                 f"run verify and repair it before compacting")
+            passes = compact_plan(disk)
+            blocks = sum(count for runs in passes for _, _, count in runs)
+            runs = sum(len(runs) for runs in passes)
+            if not passes:
+                print(f"{prefix}{args.disk} is already compact")
+                continue
+            if not args.dry_run:
+                apply_compaction(disk, passes, commit)
+            verb = "Would move" if args.dry_run else "Moved"
+            print(f"{prefix}{verb} {blocks} blocks in {runs} runs over {len(passes)} passes")
+        if not args.dry_run:
+            image.commit()
+    return 0
+
+
+# Images are compared in chunks of this size before narrowing down to blocks
+DIFF_CHUNK_SIZE = 262144
+
+
+def changed_chunks(image_a, image_b, chunk_size=DIFF_CHUNK_SIZE):
+    """Return the set of chunk numbers whose bytes differ between two images."""
+    if len(image_a) != len(image_b):
+        raise ValueError(f"images differ in size ({len(image_a)} and {len(image_b)} bytes)")
+    return {start // chunk_size for start in range(0, len(image_a), chunk_size)
+            if image_a[start:start + chunk_size] != image_b[start:start + chunk_size]}
 
-    any_deleted = False
-    for pattern in args.files:
-        pattern_83 = cpm_pattern_to_83(pattern)
-        matched = False
 
-        for (user, fullname), info in list(files.items()):
-            # Convert filename to 8.3 format for matching
-            if '.' in fullname:
-                name, ext = fullname.rsplit('.', 1)
+def spans_differ(image_a, image_b, spans, chunks, chunk_size=DIFF_CHUNK_SIZE):
+    """True if any of the (offset, length) spans differs; only changed chunks are compared."""
+    for start, length in spans:
+        if any(n in chunks for n in range(start // chunk_size, (start + length - 1) // chunk_size + 1)):
+            if image_a[start:start + length] != image_b[start:start + length]:
+                return True
+    return False
+
+
+def file_digest(disk, user, name):
+    """Hash of a file's contents, read straight from the image."""
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in disk.iter_file_chunks(name, user) or ():
+        digest.update(chunk)
+    return digest.digest()
+
+
+def diff_volume(image_a, image_b, diskdef, chunks, open_disks):
+    """Map the changed blocks of one filesystem back to its files.
+
+    The changed blocks are found from the diskdef alone. open_disks() is
+    called for the (disk_a, disk_b) pair only if a block differs, so
+    unchanged filesystems never have their directories read.
+
+    Returns:
+        dict with 'boot' (True if the boot area differs), 'directory'
+        (True if a directory block differs), the 'added' and 'removed'
+        files, the 'modified' files (each with sizes and the number of
+        its blocks that differ), the 'moved' files (same contents in
+        other blocks) and 'free_blocks' (changed blocks no file owns)
+    """
+    d = diskdef
+    runs = block_run_table(d)
+    boot = spans_differ(image_a, image_b, [(d.offset, d.boot_size)], chunks) if d.boot_size else False
+    changed = {block for block in range(blocks_in_image(d, len(image_a)))
+               if spans_differ(image_a, image_b, runs[block], chunks)}
+    result = {'boot': boot, 'directory': any(block < d.dir_blocks for block in changed),
+              'added': [], 'removed': [], 'modified': [], 'moved': [], 'free_blocks': 0}
+    if not changed:
+        return result
+
+    disk_a, disk_b = open_disks()
+    files_a = disk_a.list_files()
+    files_b = disk_b.list_files()
+    owned = set(range(d.dir_blocks))
+    for (user, name), info in sorted(files_b.items()):
+        label = f"{user}:{name}"
+        owned.update(info['blocks'])
+        old = files_a.get((user, name))
+        if old is None:
+            result['added'].append({'file': label, 'size': info['records'] * 128})
+            continue
+        owned.update(old['blocks'])
+        if old['blocks'] == info['blocks']:
+            if old['records'] == info['records']:
+                differ = sum(1 for block in info['blocks'] if block in changed)
+                if not differ:
+                    continue
             else:
-                name, ext = fullname, ''
-            filename_83 = name.ljust(8) + ext.ljust(3)
+                differ = sum(1 for block in info['blocks'] if block in changed)
+        elif (old['records'] == info['records']
+              and file_digest(disk_a, user, name) == file_digest(disk_b, user, name)):
+            result['moved'].append({'file': label})
+            continue
+        else:
+            old_blocks = set(old['blocks'])
+            differ = sum(1 for block in info['blocks'] if block not in old_blocks or block in changed)
+        result['modified'].append({'file': label, 'old_size': old['records'] * 128,
+                                   'size': info['records'] * 128, 'blocks_changed': differ})
+    for (user, name), info in sorted(files_a.items()):
+        if (user, name) not in files_b:
+            owned.update(info['blocks'])
+            result['removed'].append({'file': f"{user}:{name}", 'size': info['records'] * 128})
+    result['free_blocks'] = len(changed - owned)
+    return result
+
+
+def cmd_diff(args):
+    """Show which files differ between two images of the same format."""
+    with open_image(args.disk) as image_a, open_image(args.other) as image_b:
+        fmt = get_format_hint(args, image_a) or detect_disk_format(image_a)
+        chunks = changed_chunks(image_a, image_b)
+        diskdefs = format_diskdefs(fmt, len(image_a))
+        slices = range(len(diskdefs)) if args.slice is None else [args.slice]
+        volumes = []
+        for slice_num in slices:
+            if not 0 <= slice_num < len(diskdefs):
+                raise ValueError(f"slice {slice_num} out of range (image has {len(diskdefs)})")
+            volume = diff_volume(image_a, image_b, diskdefs[slice_num], chunks,
+                                 lambda n=slice_num: (get_disk_object(image_a, fmt, n),
+                                                      get_disk_object(image_b, fmt, n)))
+            volume['slice'] = slice_num
+            volumes.append(volume)
+        # Bytes ahead of the first filesystem (the combo MBR prefix)
+        prefix = diskdefs[0].offset if diskdefs else 0
+        prefix_changed = bool(prefix) and spans_differ(image_a, image_b, [(0, prefix)], chunks)
+
+    if args.json:
+        print(json.dumps({'a': args.disk, 'b': args.other, 'format': fmt, 'identical': not chunks,
+                          'prefix_changed': prefix_changed, 'volumes': volumes}, indent=1))
+        return 1 if chunks else 0
+
+    if not chunks:
+        print(f"{args.disk} and {args.other} are identical")
+        return 0
+    if prefix_changed:
+        print("MBR prefix differs")
+    for volume in volumes:
+        lines = []
+        if volume['boot']:
+            lines.append("boot area differs")
+        lines += [f"+ {f['file']} ({f['size']} bytes)" for f in volume['added']]
+        lines += [f"- {f['file']} ({f['size']} bytes)" for f in volume['removed']]
+        lines += [f"M {f['file']} ({f['old_size']} -> {f['size']} bytes, {f['blocks_changed']} blocks changed)"
+                  for f in volume['modified']]
+        lines += [f"R {f['file']} (same contents in other blocks)" for f in volume['moved']]
+        if volume['free_blocks']:
+            lines.append(f"{volume['free_blocks']} free blocks differ")
+        if not lines and volume['directory']:
+            lines.append("directory differs (no file changes)")
+        if lines and fmt == 'combo':
+            print(f"Slice {volume['slice']}:")
+        for line in lines:
+            print(f"  {line}" if fmt == 'combo' else line)
+    return 1
+
+
+def delete_matching(disk, patterns, prefix=""):
+    """Delete every file on disk matching any of the CP/M wildcard patterns.
+
+    Returns the set of patterns that matched at least one file.
+    """
+    matched = set()
+    for pattern in patterns:
+        pattern_83 = cpm_pattern_to_83(pattern)
+
+        for user, name_83 in disk.directory.match(pattern_83):
+            fullname = cpm_83_to_filename(name_83)
+            deleted = disk.delete_file(fullname, user)
+            if deleted > 0:
+                print(f"Deleted {prefix}{fullname} ({deleted} extent(s))")
+                matched.add(pattern)
+
+    return matched
 
-            if cpm_match(pattern_83, filename_83):
-                deleted = disk.delete_file(fullname, user)
-                if deleted > 0:
-                    print(f"Deleted {fullname} ({deleted} extent(s))")
-                    any_deleted = True
-                    matched = True
-                    del files[(user, fullname)]
 
-        if not matched:
-            print(f"No files matching: {pattern}")
+def cmd_delete(args):
+    """Delete files from a disk image."""
+    with open_image(args.disk, writable=True) as image:
+        fmt, slices = select_slices(args, image)
+
+        matched = set()
+        for slice_num in slices:
+            disk = get_disk_object(image, fmt, slice_num)
+            prefix = f"slice {slice_num}: " if len(slices) > 1 else ""
+            matched |= delete_matching(disk, args.files, prefix)
+
+        for pattern in args.files:
+            if pattern not in matched:
+                print(f"No files matching: {pattern}")
 
-    if any_deleted:
-        with open(args.disk, 'wb') as f:
-            f.write(disk_data)
-        print(f"Successfully updated {args.disk}")
+        if matched:
+            image.commit()
+            print(f"Successfully updated {args.disk}")
 
     return 0
 
 
 def cmd_extract(args):
     """Extract files from a disk image."""
-    with open(args.disk, 'rb') as f:
-        disk_data = bytearray(f.read())
-
-    disk = get_disk_object(disk_data, get_format_hint(args, disk_data))
+    with open_image(args.disk) as image:
+        fmt, slices = select_slices(args, image)
 
     user = getattr(args, 'user', 0)
     output_dir = getattr(args, 'output', '.')
+    all_users = getattr(args, 'all_users', False)
+
+    if len(slices) == 1:
+        # Keep stdout clean for the data when extracting to a pipe
+        log = sys.stderr if output_dir == '-' else sys.stdout
+        results = extract_slice(slices[0], args.disk, fmt, args.files, user, output_dir,
+                                all_users=all_users)
+        status = 0
+        for pattern, filename, out_path, size in results:
+            if out_path is None:
+                print(f"File not found: {pattern}", file=log)
+                status = 1
+            else:
+                print(f"Extracted {filename} -> {out_path} ({size} bytes)", file=log)
+        return status
 
-    for filename in args.files:
-        file_data = disk.extract_file(filename, user=user)
-        if file_data is None:
-            print(f"File not found: {filename}")
-            return 1
+    if output_dir == '-':
+        raise ValueError("Extracting to stdout needs a single slice")
+
+    results = run_per_slice(extract_slice, slices, args.disk, fmt, args.files, user,
+                            output_dir, True, all_users)
+
+    found = set()
+    for slice_num, slice_results in zip(slices, results):
+        for pattern, filename, out_path, size in slice_results:
+            if out_path is not None:
+                found.add(pattern)
+                print(f"Extracted slice {slice_num}: {filename} -> {out_path} ({size} bytes)")
+    missing = [f for f in args.files if f not in found]
+    for filename in missing:
+        print(f"File not found on any slice: {filename}")
+    return 1 if missing else 0
+
+
+# Sidecar file next to an image holding the sync command's file hashes
+SYNC_CACHE_SUFFIX = '.sync.json'
+
+
+def record_padded(data):
+    """Pad data with ^Z to whole 128-byte records, as it reads back from disk."""
+    partial = len(data) % 128
+    return data + b'\x1a' * (128 - partial) if partial else data
+
+
+def content_digest(chunks):
+    """Hash an iterable of buffers."""
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_sync_cache(disk_path):
+    """Load the sync sidecar for an image.
+
+    The cached hashes describe the image as the last sync left it, so they
+    are only used while the image's mtime and size still match. Returns
+    a dict mapping "slice:user" to {filename: {'size', 'mtime_ns', 'digest'}}.
+    """
+    try:
+        with open(disk_path + SYNC_CACHE_SUFFIX) as f:
+            cache = json.load(f)
+        st = os.stat(disk_path)
+    except (OSError, ValueError):
+        return {}
+    if cache.get('mtime_ns') != st.st_mtime_ns or cache.get('size') != st.st_size:
+        return {}
+    return cache.get('areas', {})
+
+
+def save_sync_cache(disk_path, areas):
+    """Write the sync sidecar, keyed by the image's current mtime and size."""
+    st = os.stat(disk_path)
+    cache = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'areas': areas}
+    with open(disk_path + SYNC_CACHE_SUFFIX, 'w') as f:
+        json.dump(cache, f)
+
+
+def sync_disk(disk, host_dir, user=0, sys_attr=False, cached=None):
+    """Make one user area of disk mirror the regular files in host_dir.
+
+    A file is left alone when its cached size and mtime match the host
+    file. Otherwise its record-padded size and content hash are compared
+    with the image; only files that differ are replaced. Image files not
+    present in host_dir are deleted.
+
+    Args:
+        cached: This area's entry from load_sync_cache(), or None
+
+    Returns:
+        (changes, area) where changes maps 'added', 'replaced', 'deleted'
+        and 'unchanged' to lists of filenames and area is the new cache
+        entry; or None if the changed files do not fit on the disk.
+    """
+    cached = cached or {}
+    on_disk = {name: info for (file_user, name), info in disk.list_files().items()
+               if file_user == user}
+    changes = {'added': [], 'replaced': [], 'deleted': [], 'unchanged': []}
+    area = {}
+    batch = []
+
+    for entry in sorted(os.scandir(host_dir), key=lambda e: e.name):
+        if not entry.is_file():
+            continue
+        name = cpm_83_to_filename(cpm_filename_to_83(entry.name))
+        if name in area:
+            print(f"Warning: {entry.name} maps to {name} like an earlier file, skipped")
+            continue
+        st = entry.stat()
+        hit = cached.get(name)
+        if (name in on_disk and hit and hit['size'] == st.st_size
+                and hit['mtime_ns'] == st.st_mtime_ns):
+            area[name] = hit
+            changes['unchanged'].append(name)
+            continue
+
+        with open(entry.path, 'rb') as f:
+            data = f.read()
+        padded = record_padded(data)
+        digest = content_digest([padded])
+        area[name] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'digest': digest}
+
+        if name in on_disk:
+            if on_disk[name]['records'] * 128 == len(padded):
+                image_digest = hit['digest'] if hit else content_digest(
+                    disk.iter_file_chunks(name, user))
+                if image_digest == digest:
+                    changes['unchanged'].append(name)
+                    continue
+            changes['replaced'].append(name)
+        else:
+            changes['added'].append(name)
+        batch.append((name, data))
+
+    for name in on_disk:
+        if name not in area:
+            changes['deleted'].append(name)
+    for name in changes['deleted'] + changes['replaced']:
+        disk.delete_file(name, user)
+    if not disk.add_files(batch, sys_attr=sys_attr, user=user, quiet=True):
+        return None
+    return changes, area
+
+
+def cmd_sync(args):
+    """Mirror a host directory into a disk image, touching only changed files."""
+    if not os.path.isdir(args.directory):
+        print(f"Error: {args.directory} is not a directory")
+        return 1
+
+    user = getattr(args, 'user', 0)
+    sys_attr = getattr(args, 'sys', False)
+    areas = load_sync_cache(args.disk)
+    with open_image(args.disk, writable=True) as image:
+        fmt, slices = select_slices(args, image)
+        for slice_num in slices:
+            if len(slices) > 1:
+                print(f"Slice {slice_num}:")
+            key = f"{slice_num}:{user}"
+            disk = get_disk_object(image, fmt, slice_num)
+            result = sync_disk(disk, args.directory, user, sys_attr, areas.get(key))
+            if result is None:
+                return 1
+            changes, areas[key] = result
+            for action in ('added', 'replaced', 'deleted'):
+                for name in changes[action]:
+                    print(f"{action.capitalize()} {name}")
+            print(f"{len(changes['added'])} added, {len(changes['replaced'])} replaced, "
+                  f"{len(changes['deleted'])} deleted, {len(changes['unchanged'])} unchanged")
+        image.commit()
+
+    save_sync_cache(args.disk, areas)
+    return 0
+
+
+# Host files are read in chunks of this size when streamed into an image
+HOST_CHUNK_SIZE = 65536
+
+
+class HostFile:
+    """A host file to be added to an image, read only while it is written.
+
+    add_files() accepts a HostFile wherever it accepts bytes: len() gives
+    the size the file will have on the CP/M disk, and the data is streamed
+    into the allocated blocks one chunk at a time. A text file is read
+    the way cpmemu reads a text-mode file: it ends at the first ^Z, and
+    with eol conversion each \\n also becomes \\r\\n. Its size is found
+    with one counting pass over the file.
+    """
+
+    def __init__(self, path, text=False, eol=True, chunk_size=HOST_CHUNK_SIZE):
+        self.path = path
+        self.text = text
+        self.eol = text and eol
+        self.chunk_size = chunk_size
+        if text:
+            self._size = sum(len(chunk) + (chunk.count(b'\n') if self.eol else 0)
+                             for chunk in self._raw_chunks())
+        else:
+            self._size = os.path.getsize(path)
+
+    def __len__(self):
+        return self._size
+
+    def _raw_chunks(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    return
+                if self.text:
+                    eof = chunk.find(b'\x1a')
+                    if eof >= 0:
+                        yield chunk[:eof]
+                        return
+                yield chunk
+
+    def chunks(self):
+        """Yield the file's contents as they go on the CP/M disk."""
+        for chunk in self._raw_chunks():
+            yield chunk.replace(b'\n', b'\r\n') if self.eol else chunk
+
+
+# cpmemu .cfg settings that do not describe files
+CFG_SETTINGS = {'program', 'cd', 'chdir', 'default_mode', 'debug', 'eol_convert',
+                'printer', 'aux_input', 'aux_output', 'args'}
+CFG_MODES = ('text', 'binary', 'auto')
+# Extensions cpmemu treats as text in auto mode (everything else is binary)
+CFG_TEXT_EXTS = ('.BAS', '.MAC', '.ASM', '.TXT', '.DOC', '.LST', '.PRN')
+
+# One file mapping line of a .cfg: pattern as written, resolved host path
+# (None for a mode-only line such as '*.C = text'), mode and eol_convert
+CfgMapping = namedtuple('CfgMapping', 'pattern path mode eol')
+
+
+def expand_cfg_vars(value, environ=None):
+    """Expand $VAR and ${VAR} as cpmemu does; unset variables become ''."""
+    environ = os.environ if environ is None else environ
+    return re.sub(r'\$(?:\{([^}]*)\}?|([A-Za-z0-9_]*))',
+                  lambda m: environ.get(m.group(1) if m.group(1) is not None else m.group(2), ''),
+                  value)
+
+
+def parse_cpmemu_cfg(path, environ=None, cwd=None):
+    """Parse a cpmemu .cfg file the way cpmemu's load_config_file() does.
+
+    Lines are 'key = value' with # comments, values get ${VAR}
+    expansion, and relative paths resolve against the working directory
+    as changed by any earlier 'cd' line. A mapping's mode comes from a
+    trailing 'text' or 'binary' word, otherwise from the default_mode and
+    eol_convert in effect at that line. A value that is just a mode
+    ('*.C = text') sets the mode for matching files, as the examples
+    document.
+
+    Returns:
+        dict with 'program' (host path or None), 'drives' (letter -> host
+        directory), 'mappings' (list of CfgMapping), and the final
+        'default_mode' and 'eol_convert'
+    """
+    cwd = cwd or os.getcwd()
+    config = {'program': None, 'drives': {}, 'mappings': [],
+              'default_mode': 'auto', 'eol_convert': True}
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            key, sep, value = line.partition('=')
+            if not sep:
+                raise ValueError(f"{path}:{lineno}: invalid format (missing =)")
+            key = key.strip()
+            value = expand_cfg_vars(value.strip(), environ)
+
+            if key in ('cd', 'chdir'):
+                cwd = os.path.join(cwd, value)
+            elif key == 'program':
+                config['program'] = os.path.join(cwd, value)
+            elif key == 'default_mode':
+                config['default_mode'] = value if value in CFG_MODES else 'auto'
+            elif key == 'eol_convert':
+                config['eol_convert'] = value in ('true', '1', 'yes')
+            elif key in CFG_SETTINGS:
+                continue
+            elif re.fullmatch(r'drive_[A-Pa-p]', key):
+                config['drives'][key[-1].upper()] = os.path.join(cwd, value)
+            else:
+                mode, eol = config['default_mode'], config['eol_convert']
+                target, _, word = value.rpartition(' ')
+                if value in CFG_MODES:
+                    target, mode = None, value
+                elif target and word in ('text', 'binary'):
+                    mode = word
+                else:
+                    target = value
+                if mode == 'binary':
+                    eol = False
+                if target is not None:
+                    target = os.path.join(cwd, target.strip())
+                config['mappings'].append(CfgMapping(key, target, mode, eol))
+    return config
+
+
+def is_cpm_filename(name):
+    """True if a host file name fits CP/M's 8.3 form unchanged."""
+    return re.fullmatch(r'[A-Za-z0-9$#@!%&()\-_{}~^\']{1,8}(\.[A-Za-z0-9$#@!%&()\-_{}~^\']{1,3})?',
+                        name) is not None
+
+
+def cfg_file_mode(config, name):
+    """Return (text, eol) for a file, from the first mapping that matches it."""
+    name_83 = cpm_filename_to_83(name)
+    for mapping in config['mappings']:
+        if mapping.path is None or os.path.isdir(mapping.path):
+            if cpm_match(cpm_pattern_to_83(mapping.pattern), name_83):
+                mode, eol = mapping.mode, mapping.eol
+                break
+    else:
+        mode, eol = config['default_mode'], config['eol_convert']
+    if mode == 'auto':
+        mode = 'text' if os.path.splitext(name.upper())[1] in CFG_TEXT_EXTS else 'binary'
+    return mode == 'text', eol and mode == 'text'
+
+
+def cfg_drive_files(config):
+    """Work out which host files go on which drive.
+
+    Every 8.3-named file in a drive's directory goes on that drive.
+    cpmemu finds mapped names (exact 'NAME.EXT = file' lines, directory
+    mappings such as '*.MAC = /src text') and the program on any drive,
+    so they go on drive A.
+
+    Returns:
+        (drives, skipped): drive letter -> list of (CP/M name, host path,
+        text, eol) sorted by name, and the host paths left out
+    """
+    drives = {letter: {} for letter in config['drives']}
+    skipped = []
+
+    def place(letter, name, host_path, mode_from):
+        text, eol = cfg_file_mode(config, mode_from)
+        drives.setdefault(letter, {})[name.upper()] = (name.upper(), host_path, text, eol)
+
+    for letter, directory in sorted(config['drives'].items()):
+        if not os.path.isdir(directory):
+            raise ValueError(f"drive {letter}: {directory} is not a directory")
+        for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+            if not entry.is_file():
+                continue
+            if is_cpm_filename(entry.name):
+                place(letter, entry.name, entry.path, entry.name)
+            else:
+                skipped.append(entry.path)
+
+    for mapping in config['mappings']:
+        if mapping.path is None:
+            continue
+        if os.path.isdir(mapping.path):
+            pattern_83 = cpm_pattern_to_83(mapping.pattern)
+            for entry in sorted(os.scandir(mapping.path), key=lambda e: e.name):
+                if (entry.is_file() and is_cpm_filename(entry.name)
+                        and cpm_match(pattern_83, cpm_filename_to_83(entry.name))):
+                    place('A', entry.name, entry.path, entry.name)
+        elif os.path.isfile(mapping.path) and is_cpm_filename(mapping.pattern):
+            name = mapping.pattern.upper()
+            text = mapping.mode == 'text' or (mapping.mode == 'auto' and cfg_file_mode(config, name)[0])
+            drives.setdefault('A', {})[name] = (name, mapping.path, text, text and mapping.eol)
+        else:
+            skipped.append(mapping.path)
+
+    program = config['program']
+    if program:
+        if os.path.isfile(program) and is_cpm_filename(os.path.basename(program)):
+            name = os.path.basename(program).upper()
+            drives.setdefault('A', {})[name] = (name, program, False, False)
+        else:
+            skipped.append(program)
+
+    return {letter: [files[name] for name in sorted(files)]
+            for letter, files in sorted(drives.items())}, skipped
+
+
+def cmd_from_cfg(args):
+    """Build one disk image per drive described by a cpmemu .cfg file."""
+    config = parse_cpmemu_cfg(args.config)
+    drives, skipped = cfg_drive_files(config)
+    for path in skipped:
+        print(f"Skipped {path} (missing, or not an 8.3 file name)")
+    if not drives:
+        print(f"Error: {args.config} maps no drives or files")
+        return 1
+
+    fmt = args.diskdef or ('combo' if args.combo else 'sssd' if args.sssd else 'hd1k')
+    stem = os.path.splitext(os.path.basename(args.config))[0]
+    os.makedirs(args.output, exist_ok=True)
+    status = 0
+    for letter, files in drives.items():
+        path = os.path.join(args.output, f"{stem}_{letter}.img")
+        if os.path.exists(path) and not args.force:
+            print(f"Error: {path} already exists (use --force to overwrite)")
+            status = 1
+            continue
+        create_image_file(path, fmt)
+        batch = [(name, HostFile(host_path, text, eol)) for name, host_path, text, eol in files]
+        with open_image(path, writable=True) as image:
+            disk = get_disk_object(image, 'sssd-noskew' if fmt == 'sssd' and args.no_skew else fmt)
+            ok = disk.add_files(batch, sys_attr=args.sys, quiet=True)
+            if ok:
+                image.commit()
+        if not ok:
+            os.unlink(path)
+            print(f"Error: drive {letter} does not fit in a {fmt} image")
+            status = 1
+            continue
+        text_count = sum(1 for _, _, text, _ in files if text)
+        print(f"Drive {letter}: {path} ({len(files)} files, {text_count} converted as text)")
+    return status
+
+
+# Keys allowed in a build-many manifest [[image]] table (and [defaults]),
+# with the type and description of each value
+MANIFEST_KEYS = {
+    'output': (str, "a string"),
+    'format': (str, "a string"),
+    'boot': (str, "a string"),
+    'files': (list, "a list of strings"),
+    'user': (int, "an integer"),
+    'sys': (bool, "true or false"),
+    'slice': (int, "an integer"),
+}
+
+
+def load_manifest(path):
+    """Read a build-many manifest and return its image entries.
+
+    Each [[image]] table is merged over [defaults]. Relative paths
+    (output, boot and the file globs) are resolved against the manifest's
+    directory, and files is expanded to the sorted list of matches.
+    """
+    if tomllib is None:
+        raise ValueError("build-many needs Python 3.11 or later (tomllib)")
+    with open(path, 'rb') as f:
+        try:
+            manifest = tomllib.load(f)
+        except tomllib.TOMLDecodeError as e:
+            raise ValueError(f"{path}: {e}") from None
+    base = os.path.dirname(os.path.abspath(path))
+    defaults = manifest.get('defaults', {})
+    images = manifest.get('image', [])
+    if not isinstance(defaults, dict):
+        raise ValueError(f"{path}: defaults must be a table")
+    if not isinstance(images, list) or not all(isinstance(image, dict) for image in images):
+        raise ValueError(f"{path}: image must be an array of tables ([[image]])")
+    entries = []
+    for n, image in enumerate(images):
+        entry = {'format': 'hd1k', 'boot': None, 'files': [], 'user': 0, 'sys': False, 'slice': 0}
+        entry.update(defaults)
+        entry.update(image)
+        unknown = set(entry) - set(MANIFEST_KEYS)
+        if unknown:
+            raise ValueError(f"{path}: image {n}: unknown keys {', '.join(sorted(unknown))}")
+        if 'output' not in entry:
+            raise ValueError(f"{path}: image {n}: no output given")
+        for key, value in entry.items():
+            kind, description = MANIFEST_KEYS[key]
+            if value is None and key == 'boot':
+                continue
+            # bool is an int subclass, so true must not pass as user 1
+            if (not isinstance(value, kind) or (kind is int and isinstance(value, bool))
+                    or (kind is list and not all(isinstance(v, str) for v in value))):
+                raise ValueError(f"{path}: image {n}: {key} must be {description}")
+        entry['output'] = os.path.join(base, entry['output'])
+        if entry['boot']:
+            entry['boot'] = os.path.join(base, entry['boot'])
+        files = []
+        for pattern in entry['files']:
+            matches = sorted(glob.glob(os.path.join(base, pattern)))
+            if not matches:
+                raise ValueError(f"{path}: image {n}: no files match {pattern}")
+            files.extend(m for m in matches if os.path.isfile(m))
+        entry['files'] = files
+        entries.append(entry)
+    if not entries:
+        raise ValueError(f"{path}: no [[image]] entries")
+    return entries
+
+
+def build_template(path, fmt, boot):
+    """Create a formatted image of fmt, with boot written to its boot area."""
+    create_image_file(path, 'sssd' if fmt == 'sssd-noskew' else fmt)
+    if boot:
+        with open(boot, 'rb') as f:
+            boot_data = f.read()
+        with open_image(path, writable=True) as image:
+            get_disk_object(image, fmt).write_boot_area(boot_data)
+            image.commit()
+
+
+def build_image(entry, template, force=False):
+    """Build one manifest image from its template (process pool worker).
+
+    Returns:
+        (output, error, file count, file bytes); error is None on success
+        or the reason the image could not be built, in which case no
+        output is left behind.
+    """
+    output = entry['output']
+    if os.path.exists(output) and not force:
+        return output, "already exists (use --force to overwrite)", 0, 0
+    try:
+        batch = []
+        for path in entry['files']:
+            with open(path, 'rb') as f:
+                batch.append((os.path.basename(path), f.read()))
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        clone_file(template, output)
+        with open_image(output, writable=True) as image:
+            disk = get_disk_object(image, entry['format'], entry['slice'])
+            disk.add_batch(batch, sys_attr=entry['sys'], user=entry['user'])
+            image.commit()
+    except (OSError, ValueError) as e:
+        if os.path.exists(output):
+            os.unlink(output)
+        return output, str(e), 0, 0
+    return output, None, len(batch), sum(len(data) for _, data in batch)
+
+
+def cmd_build_many(args):
+    """Build every image in a manifest on a process pool."""
+    started = time.perf_counter()
+    entries = load_manifest(args.manifest)
+    for entry in entries:
+        if entry['format'] not in ('sssd', 'sssd-noskew', 'hd1k', 'combo'):
+            lookup_diskdef(entry['format'])
+
+    # One template per (format, boot image), next to the first output so
+    # copy_file_range can stay on one filesystem
+    out_dir = os.path.dirname(entries[0]['output'])
+    os.makedirs(out_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix='.cpm_disk-templates-', dir=out_dir) as tmpdir:
+        templates = {}
+        for entry in entries:
+            key = (entry['format'], entry['boot'])
+            if key not in templates:
+                templates[key] = os.path.join(tmpdir, f"template{len(templates)}.img")
+                build_template(templates[key], *key)
+
+        workers = args.jobs or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(build_image, entry,
+                                   templates[(entry['format'], entry['boot'])], args.force)
+                       for entry in entries]
+            results = [future.result() for future in futures]
+
+    elapsed = time.perf_counter() - started
+    failures = 0
+    total_files = total_bytes = 0
+    for (output, error, count, size), entry in zip(results, entries):
+        if error:
+            failures += 1
+            print(f"FAILED {output}: {error}")
+        else:
+            total_files += count
+            total_bytes += size
+            if not args.quiet:
+                print(f"Built {output} ({entry['format']}): {count} files, {size} bytes")
+    built = len(results) - failures
+    print(f"Built {built} of {len(results)} image(s) in {elapsed:.2f}s "
+          f"({built / elapsed:.1f} images/s, {total_files} files, "
+          f"{total_bytes / 1048576 / elapsed:.1f} MB/s of file data)")
+    if failures:
+        print(f"{failures} image(s) failed")
+        return 1
+    return 0
 
-        # Determine output path
-        out_name = os.path.basename(filename).lower()
-        out_path = os.path.join(output_dir, out_name)
 
-        with open(out_path, 'wb') as f:
-            f.write(file_data)
-        print(f"Extracted {filename} -> {out_path} ({len(file_data)} bytes)")
+# Deduplicating block store. Images are split into CP/M allocation blocks,
+# each unique block is stored once under its hash, and an image becomes a
+# small JSON recipe: its format, size and the run-length encoded list of
+# block hashes. The recipe names its store relative to itself.
+RECIPE_MAGIC = b'{"cpm_disk_recipe":'
+RECIPE_VERSION = 1
+RECIPE_SUFFIX = '.recipe'
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+RECIPE_CACHE_BLOCKS = 256  # blocks kept per mounted recipe
 
+
+def block_digest(data):
+    """Content address of one block."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def format_diskdefs(fmt, size):
+    """Return the DiskDef of each filesystem in an image of a format and size."""
+    if fmt == 'combo':
+        count = max(0, (size - HD1K_MBR_PREFIX) // HD1K_SLICE_SIZE)
+        return [DISKDEFS['wbw_hd1k']._replace(offset=HD1K_MBR_PREFIX + n * HD1K_SLICE_SIZE)
+                for n in range(count)]
+    names = {'sssd': 'ibm-3740', 'sssd-noskew': 'ibm-3740-noskew', 'hd1k': 'wbw_hd1k'}
+    return [lookup_diskdef(names.get(fmt, fmt))]
+
+
+@functools.lru_cache(maxsize=16)
+def block_segments(fmt, size):
+    """Split an image into the pieces the block store hashes.
+
+    Each segment is a tuple of (offset, length) spans read in order: one
+    per allocation block of each filesystem in the image, gathered in
+    logical (deskewed) order so a file's blocks hash the same in every
+    image holding them. Bytes outside any block (boot tracks, the combo
+    MBR prefix, a partial tail) are cut into block-sized segments.
+
+    Returns:
+        Tuple of segments, sorted by the offset of their first span
+    """
+    diskdefs = format_diskdefs(fmt, size)
+    segments = []
+    for diskdef in diskdefs:
+        for runs in block_run_table(diskdef)[:diskdef.dsm + 1]:
+            if all(start + length <= size for start, length in runs):
+                segments.append(runs)
+
+    block_size = diskdefs[0].blocksize if diskdefs else BLOCK_SIZE
+    pos = 0
+    gaps = []
+    for start, length in sorted(span for runs in segments for span in runs) + [(size, 0)]:
+        if start > pos:
+            gaps.append((pos, start))
+        pos = max(pos, start + length)
+    for start, end in gaps:
+        segments.extend(((offset, min(block_size, end - offset)),)
+                        for offset in range(start, end, block_size))
+    segments.sort(key=lambda runs: runs[0][0])
+    return tuple(segments)
+
+
+class DirBlockStore:
+    """Block store kept as one file per block under root/blocks/<xx>/."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'blocks'), exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _path(self, digest):
+        return os.path.join(self.root, 'blocks', digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self._path(digest))
+
+    def get(self, digest):
+        try:
+            with open(self._path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise ValueError(f"block {digest} missing from store {self.root}") from None
+
+    def put(self, digest, data):
+        """Store a block unless present; returns True if it was new."""
+        path = self._path(digest)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+
+    def stats(self):
+        """Return (block count, stored bytes)."""
+        count = size = 0
+        blocks = os.path.join(self.root, 'blocks')
+        for prefix in os.scandir(blocks):
+            for entry in os.scandir(prefix.path):
+                count += 1
+                size += entry.stat().st_size
+        return count, size
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteBlockStore:
+    """Block store packed into one sqlite database file."""
+
+    def __init__(self, path):
+        self.root = path
+        # Extract reads blocks from a thread pool; one lock serializes them
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute('CREATE TABLE IF NOT EXISTS blocks '
+                         '(digest TEXT PRIMARY KEY, data BLOB NOT NULL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def has(self, digest):
+        with self._lock:
+            row = self._db.execute('SELECT 1 FROM blocks WHERE digest = ?', (digest,)).fetchone()
+        return row is not None
+
+    def get(self, digest):
+        with self._lock:
+            row = self._db.execute('SELECT data FROM blocks WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            raise ValueError(f"block {digest} missing from store {self.root}")
+        return row[0]
+
+    def put(self, digest, data):
+        """Store a block unless present; returns True if it was new."""
+        with self._lock:
+            cursor = self._db.execute('INSERT OR IGNORE INTO blocks VALUES (?, ?)',
+                                      (digest, bytes(data)))
+        return cursor.rowcount == 1
+
+    def stats(self):
+        """Return (block count, stored bytes)."""
+        with self._lock:
+            count, size = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM blocks').fetchone()
+        return count, size
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self.commit()
+            self._db.close()
+            self._db = None
+
+
+def open_block_store(path):
+    """Open a block store: sqlite for a file or a .db/.sqlite name, else a directory."""
+    if os.path.isfile(path) or (not os.path.isdir(path) and path.endswith(SQLITE_SUFFIXES)):
+        return SqliteBlockStore(path)
+    return DirBlockStore(path)
+
+
+def is_recipe_file(path):
+    """Return True if path is a block store recipe."""
+    with open(path, 'rb') as f:
+        return f.read(len(RECIPE_MAGIC)) == RECIPE_MAGIC
+
+
+def store_image(store, disk_data, fmt):
+    """Add an image's blocks to a store.
+
+    Returns:
+        (recipe, new blocks, new bytes). The recipe lacks its 'store'
+        entry, which write_recipe() fills in.
+    """
+    runs = []
+    new_blocks = new_bytes = 0
+    with buffer_view(disk_data) as view:
+        for segment in block_segments(fmt, len(disk_data)):
+            data = b''.join([view[start:start + length] for start, length in segment])
+            digest = block_digest(data)
+            if store.put(digest, data):
+                new_blocks += 1
+                new_bytes += len(data)
+            if runs and runs[-1][0] == digest:
+                runs[-1][1] += 1
+            else:
+                runs.append([digest, 1])
+    store.commit()
+    recipe = {'cpm_disk_recipe': RECIPE_VERSION, 'format': fmt,
+              'size': len(disk_data), 'blocks': runs}
+    return recipe, new_blocks, new_bytes
+
+
+def write_recipe(path, recipe, store_path):
+    """Write a recipe to path, naming store_path relative to it."""
+    recipe = dict(recipe, store=os.path.relpath(store_path, os.path.dirname(os.path.abspath(path))))
+    with open(path, 'w') as f:
+        json.dump(recipe, f, separators=(',', ':'))
+
+
+def load_recipe(path):
+    """Read a recipe, resolving its store path."""
+    with open(path) as f:
+        recipe = json.load(f)
+    if recipe.get('cpm_disk_recipe') != RECIPE_VERSION:
+        raise ValueError(f"{path}: unsupported recipe version {recipe.get('cpm_disk_recipe')}")
+    recipe['store'] = os.path.join(os.path.dirname(os.path.abspath(path)), recipe['store'])
+    return recipe
+
+
+class RecipeImage(UnitImage):
+    """A recipe mounted as a read-only flat disk image.
+
+    Blocks are fetched from the store as reads touch them and kept in an
+    LRU keyed by hash, so the image is never materialized and a block
+    repeated across the image (all-zero space, say) is loaded once. The
+    units are the spans of each segment in image order.
+    """
+
+    def __init__(self, path, writable=False, cache_blocks=RECIPE_CACHE_BLOCKS):
+        if writable:
+            raise PermissionError(f"{path}: recipes are read-only (decompress one to change it)")
+        recipe = load_recipe(path)
+        if not os.path.exists(recipe['store']):
+            raise ValueError(f"{path}: block store {recipe['store']} not found")
+        self.path = path
+        self.writable = False
+        self.format = recipe['format']
+        self.cache_blocks = cache_blocks
+        self._size = recipe['size']
+        self._digests = [digest for digest, count in recipe['blocks'] for _ in range(count)]
+        segments = block_segments(self.format, self._size)
+        if len(self._digests) != len(segments):
+            raise ValueError(f"{path}: recipe does not match a {self.format} image "
+                             f"of {self._size} bytes")
+        # Every span of every segment, by image offset: (offset, length, segment, pos in segment)
+        spans = []
+        for n, segment in enumerate(segments):
+            pos = 0
+            for start, length in segment:
+                spans.append((start, length, n, pos))
+                pos += length
+        spans.sort()
+        self._spans = spans
+        self._span_starts = [span[0] for span in spans]
+        self._store = open_block_store(recipe['store'])
+        self._cache = OrderedDict()  # digest -> block, least recently used first
+        self._lock = threading.Lock()
+        self._written = {}
+
+    def _block(self, n):
+        digest = self._digests[n]
+        with self._lock:
+            data = self._cache.get(digest)
+            if data is not None:
+                self._cache.move_to_end(digest)
+                return data
+        data = self._store.get(digest)
+        with self._lock:
+            self._cache[digest] = data
+            if len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last=False)
+        return data
+
+    def _locate(self, pos):
+        """Return (span number, offset in span, span length) of an image offset."""
+        i = bisect.bisect_right(self._span_starts, pos) - 1
+        offset, length, _, _ = self._spans[i]
+        return i, pos - offset, length
+
+    def _read_unit(self, i):
+        _, length, n, pos = self._spans[i]
+        return self._block(n)[pos:pos + length]
+
+    def close(self):
+        """Close the block store."""
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+            self._cache = OrderedDict()
+
+
+def cmd_dedup_add(args):
+    """Add disk images to a block store, writing a recipe for each."""
+    total_blocks = total_bytes = 0
+    with open_block_store(args.store) as store:
+        for path in args.disks:
+            with open_image(path) as image:
+                fmt = get_format_hint(args, image) or detect_disk_format(image)
+                recipe, new_blocks, new_bytes = store_image(store, image, fmt)
+            out_dir = args.output or os.path.dirname(path)
+            recipe_path = os.path.join(out_dir, os.path.basename(path) + RECIPE_SUFFIX)
+            write_recipe(recipe_path, recipe, args.store)
+            total_blocks += new_blocks
+            total_bytes += new_bytes
+            print(f"Stored {path} ({fmt}): {new_blocks} new blocks, "
+                  f"{new_bytes} bytes -> {recipe_path}")
+        count, size = store.stats()
+    print(f"{total_blocks} new blocks ({total_bytes} bytes); "
+          f"store holds {count} blocks ({size} bytes)")
+    return 0
+
+
+def cmd_dedup_info(args):
+    """Report how much a block store holds."""
+    if not os.path.exists(args.store):
+        print(f"Error: {args.store} not found")
+        return 1
+    with open_block_store(args.store) as store:
+        count, size = store.stats()
+    print(f"{args.store}: {count} blocks, {size} bytes")
+    return 0
+
+
+# Copy-on-write overlay (.cow): a header naming a read-only base image,
+# a bitmap with one bit per granule of the image, then a data area where
+# granule n, once written, lives at data offset + n * granule size. The
+# data area is left sparse, so the file only takes space for the
+# granules that were changed.
+OVERLAY_MAGIC = b'CPMO'
+OVERLAY_VERSION = 1
+# magic, version, 0, 0, granule size, image size, base file size,
+# base mtime (ns), length of the base path that follows
+OVERLAY_HEADER = struct.Struct('<4sBBHIQQqI')
+OVERLAY_GRANULE = 4096
+
+
+def is_overlay_file(path):
+    """Return True if path starts with the overlay signature."""
+    with open(path, 'rb') as f:
+        return f.read(len(OVERLAY_MAGIC)) == OVERLAY_MAGIC
+
+
+def overlay_layout(path_length, granule, size):
+    """Return (bitmap offset, bitmap length, data offset) of an overlay."""
+    bitmap_offset = OVERLAY_HEADER.size + path_length
+    bitmap_length = (-(-size // granule) + 7) // 8
+    data_offset = -(-(bitmap_offset + bitmap_length) // granule) * granule
+    return bitmap_offset, bitmap_length, data_offset
+
+
+def create_overlay(base, path, granule=OVERLAY_GRANULE):
+    """Write an empty overlay on base to path, replacing any file there.
+
+    The base is named relative to the overlay and identified by its size
+    and modification time, so an overlay refuses to open once its base
+    has changed underneath it.
+
+    Returns:
+        Size of the overlay file in bytes
+    """
+    if not 0 < granule < 1 << 32:
+        raise ValueError(f"granule size out of range: {granule}")
+    with open_image(base) as image:
+        size = len(image)
+    st = os.stat(base)
+    name = os.path.relpath(os.path.abspath(base), os.path.dirname(os.path.abspath(path))).encode()
+    _, bitmap_length, data_offset = overlay_layout(len(name), granule, size)
+    with open(path, 'wb') as f:
+        f.write(OVERLAY_HEADER.pack(OVERLAY_MAGIC, OVERLAY_VERSION, 0, 0, granule,
+                                    size, st.st_size, st.st_mtime_ns, len(name)))
+        f.write(name)
+        f.write(bytes(bitmap_length))
+        f.truncate(data_offset)
+    return data_offset
+
+
+def read_overlay_header(path):
+    """Read an overlay's header.
+
+    Returns:
+        dict with 'base' (resolved path), 'granule', 'size', 'base_size',
+        'base_mtime_ns', 'bitmap_offset', 'bitmap' (bytes) and 'data_offset'
+    """
+    with open(path, 'rb') as f:
+        header = f.read(OVERLAY_HEADER.size)
+        if len(header) < OVERLAY_HEADER.size or header[:4] != OVERLAY_MAGIC:
+            raise ValueError(f"{path}: not an overlay image")
+        _, version, _, _, granule, size, base_size, base_mtime_ns, name_length = \
+            OVERLAY_HEADER.unpack(header)
+        if version != OVERLAY_VERSION or not granule:
+            raise ValueError(f"{path}: unsupported overlay version {version}")
+        name = f.read(name_length).decode()
+        bitmap_offset, bitmap_length, data_offset = overlay_layout(name_length, granule, size)
+        bitmap = f.read(bitmap_length)
+    if len(bitmap) != bitmap_length:
+        raise ValueError(f"{path}: overlay bitmap truncated")
+    return {'base': os.path.join(os.path.dirname(os.path.abspath(path)), name),
+            'granule': granule, 'size': size, 'base_size': base_size,
+            'base_mtime_ns': base_mtime_ns, 'bitmap_offset': bitmap_offset,
+            'bitmap': bitmap, 'data_offset': data_offset}
+
+
+class OverlayImage(UnitImage):
+    """Copy-on-write overlay presented as a flat disk image.
+
+    Reads come from the overlay for granules it holds and from the base
+    image for everything else; a read that touches no stored granule is
+    a plain slice of the base. The base is only ever opened read-only, so
+    any number of overlays can share one base image (and, for a raw
+    image, its pages in the page cache).
+
+    Written granules are held in memory until commit(), which writes them
+    to the overlay's data area and then sets their bits in the bitmap.
+    The base is never modified; see cmd_overlay_commit() for that.
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        header = read_overlay_header(path)
+        base = header['base']
+        if not os.path.exists(base):
+            raise ValueError(f"{path}: base image {base} not found")
+        st = os.stat(base)
+        if (st.st_size, st.st_mtime_ns) != (header['base_size'], header['base_mtime_ns']):
+            raise ValueError(f"{path}: base image {base} has changed since the overlay was created")
+        self.base_path = base
+        self.granule = self._unit_size = header['granule']
+        self._size = header['size']
+        self._bitmap_offset = header['bitmap_offset']
+        self._bitmap = bytearray(header['bitmap'])
+        self._data_offset = header['data_offset']
+        self._stored = {byte_num * 8 + bit for byte_num, byte in enumerate(self._bitmap) if byte
+                        for bit in range(8) if byte >> bit & 1}
+        self._written = {}  # granule number -> bytearray of its new contents
+        self._base = open_image(base)
+        try:
+            if len(self._base) != self._size:
+                raise ValueError(f"{path}: base image {base} is not {self._size} bytes")
+            self._file = open(path, 'r+b' if writable else 'rb')
+        except (ValueError, OSError):
+            self._base.close()
+            raise
+
+    def stored_granules(self):
+        """Sorted numbers of the granules the overlay file holds."""
+        return sorted(self._stored)
+
+    def _read_unit(self, n):
+        start = n * self.granule
+        length = min(self.granule, self._size - start)
+        if n in self._stored:
+            return os.pread(self._file.fileno(), length, self._data_offset + start)
+        return self._base[start:start + length]
+
+    def _read(self, start, stop):
+        first, last = start // self.granule, (stop - 1) // self.granule
+        if not (self._stored or self._written) or not any(
+                n in self._stored or n in self._written for n in range(first, last + 1)):
+            return self._base[start:stop]
+        return super()._read(start, stop)
+
+    def _write_units(self):
+        """Write changed granules to the overlay, then mark them in the bitmap."""
+        written = 0
+        fd = self._file.fileno()
+        for n in sorted(self._written):
+            data = self._written[n]
+            os.pwrite(fd, data, self._data_offset + n * self.granule)
+            self._bitmap[n // 8] |= 1 << (n % 8)
+            written += len(data)
+        os.pwrite(fd, self._bitmap, self._bitmap_offset)
+        self._stored.update(self._written)
+        return written + len(self._bitmap)
+
+    def close(self):
+        """Close the overlay and its base. Uncommitted changes are discarded."""
+        if self._base is not None:
+            self._base.close()
+            self._base = None
+            self._file.close()
+
+
+def cmd_overlay_create(args):
+    """Create an empty copy-on-write overlay on a base image."""
+    if os.path.exists(args.overlay) and not args.force:
+        print(f"Error: {args.overlay} already exists (use --force to overwrite)")
+        return 1
+    size = create_overlay(args.base, args.overlay, parse_size(args.granule))
+    print(f"Created overlay {args.overlay} on {args.base} ({size} bytes)")
+    return 0
+
+
+def cmd_overlay_commit(args):
+    """Write an overlay's changes into its base image and empty the overlay."""
+    with OverlayImage(args.overlay) as overlay:
+        base = overlay.base_path
+        granules = overlay.stored_granules()
+        if granules:
+            with open_image(base, writable=True) as image:
+                for n in granules:
+                    start = n * overlay.granule
+                    data = overlay[start:start + overlay.granule]
+                    image[start:start + len(data)] = data
+                image.commit()
+        granule = overlay.granule
+    create_overlay(base, args.overlay, granule)
+    print(f"Committed {len(granules)} granules from {args.overlay} into {base}")
+    return 0
+
+
+def cmd_overlay_discard(args):
+    """Drop every change held in an overlay."""
+    header = read_overlay_header(args.overlay)
+    count = sum(bin(byte).count('1') for byte in header['bitmap'])
+    create_overlay(header['base'], args.overlay, header['granule'])
+    print(f"Discarded {count} granules from {args.overlay}")
+    return 0
+
+
+def cmd_overlay_info(args):
+    """Report an overlay's base and how much it holds."""
+    header = read_overlay_header(args.overlay)
+    count = sum(bin(byte).count('1') for byte in header['bitmap'])
+    st = os.stat(args.overlay)
+    print(f"{args.overlay}: base {header['base']} ({header['size']} bytes), "
+          f"{count} of {-(-header['size'] // header['granule'])} granules of "
+          f"{header['granule']} bytes changed, {st.st_blocks * 512} bytes on disk")
+    return 0
+
+
+def slice_offset(disk_data, slice_num, path):
+    """Byte offset of an 8MB hd1k filesystem: a combo slice, or a standalone hd1k image (slice 0)."""
+    fmt = detect_disk_format(disk_data)
+    if fmt == 'combo':
+        count = combo_slice_count(disk_data)
+        if not 0 <= slice_num < count:
+            raise ValueError(f"slice {slice_num} out of range ({path} has {count} slices)")
+        return HD1K_MBR_PREFIX + slice_num * HD1K_SLICE_SIZE
+    if fmt != 'hd1k' or len(disk_data) < HD1K_SLICE_SIZE:
+        raise ValueError(f"{path} is not an hd1k or combo image")
+    if slice_num != 0:
+        raise ValueError(f"slice {slice_num} requested but {path} is hd1k, not combo")
+    return 0
+
+
+def check_slice(disk_data, offset, what):
+    """Raise ValueError if verify_volume() finds problems in the slice at offset."""
+    problems = verify_volume(disk_data, DISKDEFS['wbw_hd1k']._replace(offset=offset))['problems']
+    if problems:
+        raise ValueError(f"{what} has {len(problems)} directory problem(s) "
+                         f"(first: {problems[0]['message']}); run verify")
+
+
+def copy_slice_data(src, src_offset, dst, dst_offset, sparse=False):
+    """Copy HD1K_SLICE_SIZE bytes from src at src_offset to dst at dst_offset.
+
+    Between raw image files the bytes move with copy_range(), in the
+    kernel, and with sparse only the source's data extents are copied, so
+    its holes stay holes in a freshly truncated dst. Other containers
+    (IMD, CPMZ, overlays) are copied through their image objects.
+
+    Returns:
+        Number of bytes copied
+    """
+    with open_image(src) as image_in, open_image(dst) as image_out:
+        raw = isinstance(image_in, DiskImage) and isinstance(image_out, DiskImage)
+    copied = 0
+    if raw:
+        with open(src, 'rb') as fin, open(dst, 'r+b') as fout:
+            end = src_offset + HD1K_SLICE_SIZE
+            extents = (data_extents(fin.fileno(), end, src_offset) if sparse
+                       else [(src_offset, end)])
+            for start, stop in extents:
+                copy_range(fin.fileno(), fout.fileno(), start,
+                           dst_offset + start - src_offset, stop - start)
+                copied += stop - start
+    else:
+        with open_image(src) as image_in, open_image(dst, writable=True) as image_out:
+            for start in range(0, HD1K_SLICE_SIZE, CPMZ_CHUNK_SIZE):
+                chunk = image_in[src_offset + start:src_offset + start + CPMZ_CHUNK_SIZE]
+                image_out[dst_offset + start:dst_offset + start + len(chunk)] = chunk
+                copied += len(chunk)
+            image_out.commit()
+    return copied
+
+
+def copy_slice(src, src_slice, dst, dst_slice, create=False):
+    """Copy an 8MB hd1k filesystem between combo slices and hd1k images.
+
+    The source slice's directory is checked before anything is written
+    and the destination's after the copy. An existing destination slice
+    is first saved to a temporary file beside dst and put back if the
+    copy or the check fails; a created dst is removed instead.
+
+    Args:
+        src, src_slice: Source image and slice (0 for an hd1k image)
+        dst, dst_slice: Destination image and slice
+        create: Create dst as a new hd1k image holding just the slice
+
+    Returns:
+        Number of bytes copied
+    """
+    with open_image(src) as image:
+        src_offset = slice_offset(image, src_slice, src)
+        check_slice(image, src_offset, f"{src} slice {src_slice}")
+    if create:
+        with open(dst, 'wb') as f:
+            f.truncate(HD1K_SINGLE_SIZE)
+        dst_offset = 0
+    else:
+        with open_image(dst) as image:
+            dst_offset = slice_offset(image, dst_slice, dst)
+        if os.path.samefile(src, dst) and src_offset == dst_offset:
+            raise ValueError("source and destination are the same slice")
+
+    backup = None if create else f"{dst}.{os.getpid()}.slice"
+    try:
+        if backup:
+            with open(backup, 'wb') as f:
+                f.truncate(HD1K_SLICE_SIZE)
+            copy_slice_data(dst, dst_offset, backup, 0, sparse=True)
+        try:
+            copied = copy_slice_data(src, src_offset, dst, dst_offset, sparse=create)
+            with open_image(dst) as image:
+                check_slice(image, dst_offset, f"{dst} slice {dst_slice} after the copy")
+        except BaseException:
+            if create:
+                os.unlink(dst)
+            else:
+                copy_slice_data(backup, 0, dst, dst_offset)
+            raise
+    finally:
+        if backup and os.path.exists(backup):
+            os.unlink(backup)
+    return copied
+
+
+def cmd_slice_export(args):
+    """Write one combo slice out as a standalone hd1k image."""
+    if os.path.exists(args.output) and not args.force:
+        print(f"Error: {args.output} already exists (use --force to overwrite)")
+        return 1
+    copied = copy_slice(args.disk, args.slice, args.output, 0, create=True)
+    print(f"Exported {args.disk} slice {args.slice} -> {args.output} ({copied} data bytes)")
+    return 0
+
+
+def cmd_slice_import(args):
+    """Replace one combo slice with a standalone hd1k image."""
+    copied = copy_slice(args.input, 0, args.disk, args.slice)
+    print(f"Imported {args.input} -> {args.disk} slice {args.slice} ({copied} bytes)")
+    return 0
+
+
+def cmd_slice_copy(args):
+    """Copy a slice between combo images (or within one)."""
+    copied = copy_slice(args.src, args.src_slice, args.dst, args.dst_slice)
+    print(f"Copied {args.src} slice {args.src_slice} -> {args.dst} slice {args.dst_slice} "
+          f"({copied} bytes)")
+    return 0
+
+
+def write_raw_image(disk_data, path, chunk_size=CPMZ_CHUNK_SIZE):
+    """Write any image object to path as a raw image, leaving zero runs sparse.
+
+    Returns:
+        Size of the image in bytes
+    """
+    size = len(disk_data)
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        for start in range(0, size, chunk_size):
+            chunk = disk_data[start:start + chunk_size]
+            if chunk.count(0) != len(chunk):
+                f.seek(start)
+                f.write(chunk)
+    return size
+
+
+def cmd_compress(args):
+    """Pack a disk image into a chunked compressed container."""
+    if os.path.exists(args.output) and not args.force:
+        print(f"Error: {args.output} already exists (use --force to overwrite)")
+        return 1
+    chunk_size = parse_size(args.chunk_size)
+    if not 0 < chunk_size < 1 << 32:
+        raise ValueError(f"chunk size out of range: {args.chunk_size}")
+    with open_image(args.disk) as image:
+        image_size = len(image)
+        size = compress_image(image, args.output, args.codec, chunk_size)
+    print(f"Compressed {args.disk} ({image_size} bytes) -> {args.output} "
+          f"({size} bytes, {args.codec})")
+    return 0
+
+
+def cmd_decompress(args):
+    """Expand a compressed container, IMD file or recipe into a raw disk image."""
+    if os.path.exists(args.output) and not args.force:
+        print(f"Error: {args.output} already exists (use --force to overwrite)")
+        return 1
+    with open_image(args.disk) as image:
+        size = write_raw_image(image, args.output, getattr(image, 'chunk_size', CPMZ_CHUNK_SIZE))
+    print(f"Expanded {args.disk} -> {args.output} ({size} bytes)")
     return 0
 
 
 def cmd_read_boot(args):
     """Read boot area from disk image to a file."""
-    with open(args.disk, 'rb') as f:
-        disk_data = bytearray(f.read())
-
-    disk = get_disk_object(disk_data, get_format_hint(args, disk_data))
-    boot_data = disk.read_boot_area()
+    image, disk = open_disk(args)
+    with image:
+        boot_data = disk.read_boot_area()
+        fmt = get_format_hint(args, image) or detect_disk_format(image)
 
     with open(args.output, 'wb') as f:
         f.write(boot_data)
 
-    fmt = detect_disk_format(disk_data)
     print(f"Read {len(boot_data)} bytes boot area from {args.disk} ({fmt}) -> {args.output}")
     return 0
 
 
 def cmd_write_boot(args):
     """Write boot area to disk image from a file."""
-    with open(args.disk, 'rb') as f:
-        disk_data = bytearray(f.read())
+    image, disk = open_disk(args, writable=True)
+    with image:
+        fmt = get_format_hint(args, image) or detect_disk_format(image)
 
-    disk = get_disk_object(disk_data, get_format_hint(args, disk_data))
-    fmt = detect_disk_format(disk_data)
+        with open(args.input, 'rb') as f:
+            file_data = f.read()
 
-    with open(args.input, 'rb') as f:
-        file_data = f.read()
+        sector_size = disk.diskdef.seclen
+        total_boot_sectors = disk.diskdef.boottrk * disk.diskdef.sectrk
+        start_sector = getattr(args, 'sector', 0) or 0
+        length_sectors = getattr(args, 'length', None)
 
-    sector_size = disk.SECTOR_SIZE
-    total_boot_sectors = disk.BOOT_TRACKS * disk.SECTORS_PER_TRACK
-    start_sector = getattr(args, 'sector', 0) or 0
-    length_sectors = getattr(args, 'length', None)
+        # Validate start sector
+        if start_sector < 0 or start_sector >= total_boot_sectors:
+            print(f"Error: sector {start_sector} out of range (0-{total_boot_sectors - 1})")
+            return 1
 
-    # Validate start sector
-    if start_sector < 0 or start_sector >= total_boot_sectors:
-        print(f"Error: sector {start_sector} out of range (0-{total_boot_sectors - 1})")
-        return 1
+        # Calculate how many sectors the file needs
+        file_sectors = (len(file_data) + sector_size - 1) // sector_size
+
+        # If length specified, pad or check bounds
+        if length_sectors is not None:
+            if length_sectors < file_sectors:
+                print(f"Error: file needs {file_sectors} sectors but length is only {length_sectors}")
+                return 1
+            # Pad file to specified length
+            target_size = length_sectors * sector_size
+            file_data = file_data + bytes(target_size - len(file_data))
+            file_sectors = length_sectors
+
+        # Check if it fits in boot area
+        if start_sector + file_sectors > total_boot_sectors:
+            print(f"Error: {file_sectors} sector(s) at sector {start_sector} exceeds boot area ({total_boot_sectors} sectors)")
+            return 1
 
-    # Calculate how many sectors the file needs
-    file_sectors = (len(file_data) + sector_size - 1) // sector_size
+        # Read current boot area, overlay file data, write back
+        boot_area = bytearray(disk.read_boot_area())
+        offset = start_sector * sector_size
+        # Pad file_data to sector boundary
+        if len(file_data) % sector_size != 0:
+            file_data = file_data + bytes(sector_size - (len(file_data) % sector_size))
+        boot_area[offset:offset + len(file_data)] = file_data
+        disk.write_boot_area(bytes(boot_area))
 
-    # If length specified, pad or check bounds
-    if length_sectors is not None:
-        if length_sectors < file_sectors:
-            print(f"Error: file needs {file_sectors} sectors but length is only {length_sectors}")
-            return 1
-        # Pad file to specified length
-        target_size = length_sectors * sector_size
-        file_data = file_data + bytes(target_size - len(file_data))
-        file_sectors = length_sectors
-
-    # Check if it fits in boot area
-    if start_sector + file_sectors > total_boot_sectors:
-        print(f"Error: {file_sectors} sector(s) at sector {start_sector} exceeds boot area ({total_boot_sectors} sectors)")
-        return 1
+        image.commit()
+
+        if length_sectors is not None:
+            print(f"Wrote {len(file_data)} bytes ({file_sectors} sectors) to sector {start_sector} of {args.disk} ({fmt})")
+        else:
+            print(f"Wrote {len(file_data)} bytes to sector {start_sector} of {args.disk} ({fmt})")
+        return 0
 
-    # Read current boot area, overlay file data, write back
-    boot_area = bytearray(disk.read_boot_area())
-    offset = start_sector * sector_size
-    # Pad file_data to sector boundary
-    if len(file_data) % sector_size != 0:
-        file_data = file_data + bytes(sector_size - (len(file_data) % sector_size))
-    boot_area[offset:offset + len(file_data)] = file_data
-    disk.write_boot_area(bytes(boot_area))
 
-    with open(args.disk, 'wb') as f:
-        f.write(disk_data)
+def default_socket_path():
+    """Unix socket used by serve and cpm_disk_client.py when none is given."""
+    return os.environ.get('CPM_DISK_SOCKET') or f"/tmp/cpm_disk-{os.getuid()}.sock"
 
-    if length_sectors is not None:
-        print(f"Wrote {len(file_data)} bytes ({file_sectors} sectors) to sector {start_sector} of {args.disk} ({fmt})")
-    else:
-        print(f"Wrote {len(file_data)} bytes to sector {start_sector} of {args.disk} ({fmt})")
+
+# Request keys that select the format, as the command line options do
+SERVE_FORMAT_OPTIONS = ('sssd', 'combo', 'no_skew', 'diskdef')
+
+
+class ServedImage:
+    """A disk image held open by the server, with its disk objects and lock.
+
+    The image is mapped once; disk objects (and their directory indexes)
+    are kept per (format hint, slice) so repeated requests skip both the
+    image load and the directory scan. Changes accumulate in the private
+    mapping until flush() commits them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.image = open_image(path, writable=True)
+        except PermissionError:
+            self.image = open_image(path)
+        self.lock = asyncio.Lock()
+        self.disks = {}
+        self.dirty = False
+        self.last_used = time.monotonic()
+
+    def disk(self, req):
+        """Return the disk object a request addresses."""
+        options = argparse.Namespace(**{name: req.get(name) for name in SERVE_FORMAT_OPTIONS})
+        key = (req.get('format') or get_format_hint(options, self.image), req.get('slice', 0))
+        disk = self.disks.get(key)
+        if disk is None:
+            disk = self.disks[key] = get_disk_object(self.image, *key)
+        return disk
+
+    def modified(self, disk):
+        """Note a change made through disk; other cached views may be stale."""
+        if not self.image.writable:
+            raise ValueError(f"{self.path} is read-only")
+        self.disks = {key: d for key, d in self.disks.items() if d is disk}
+        self.dirty = True
+
+    def flush(self):
+        """Write changes back to the image file. Returns bytes written."""
+        if not self.dirty:
+            return 0
+        self.dirty = False
+        return self.image.commit()
+
+
+def serve_list(served, req):
+    files = served.disk(req).list_files()
+    return {'files': [{'user': user, 'name': name, 'size': info['records'] * 128,
+                       'blocks': len(info['blocks'])}
+                      for (user, name), info in sorted(files.items())]}
+
+
+def serve_add(served, req):
+    """Add host files (paths) or inline files ({'name', 'data'} in base64)."""
+    batch = []
+    for item in req.get('files', []):
+        if isinstance(item, str):
+            with open(item, 'rb') as f:
+                batch.append((os.path.basename(item), f.read()))
+        else:
+            batch.append((item['name'], base64.b64decode(item['data'])))
+    disk = served.disk(req)
+    served.modified(disk)   # raises for a read-only image before anything is written
+    if not disk.add_files(batch, sys_attr=req.get('sys', False), user=req.get('user', 0),
+                          quiet=True):
+        raise ValueError("files do not fit on the disk")
+    return {'added': [name.upper() for name, _ in batch]}
+
+
+def serve_delete(served, req):
+    disk = served.disk(req)
+    deleted = []
+    for pattern in req.get('files', []):
+        for user, name_83 in disk.directory.match(cpm_pattern_to_83(pattern), req.get('user', 0)):
+            if not deleted:
+                served.modified(disk)
+            filename = cpm_83_to_filename(name_83)
+            disk.delete_file(filename, user)
+            deleted.append(filename)
+    return {'deleted': deleted}
+
+
+def serve_extract(served, req):
+    """Extract into req['output'] on the server's host, or inline as base64."""
+    disk = served.disk(req)
+    user = req.get('user', 0)
+    all_users = req.get('all_users', False)
+    if req.get('output'):
+        results = extract_from_disk(disk, req.get('files', []), user, req['output'], all_users)
+        return {'files': [{'pattern': p, 'name': n, 'path': path, 'size': size}
+                          for p, n, path, size in results]}
+    files = []
+    for pattern in req.get('files', []):
+        keys = disk.directory.match(cpm_pattern_to_83(pattern), None if all_users else user)
+        if not keys:
+            files.append({'pattern': pattern, 'name': pattern, 'path': None, 'size': 0})
+        for file_user, name_83 in keys:
+            data = disk.extract_file(cpm_83_to_filename(name_83), file_user)
+            files.append({'pattern': pattern, 'name': cpm_83_to_filename(name_83),
+                          'user': file_user, 'size': len(data),
+                          'data': base64.b64encode(data).decode('ascii')})
+    return {'files': files}
+
+
+def serve_read_boot(served, req):
+    boot_data = served.disk(req).read_boot_area()
+    if req.get('output'):
+        with open(req['output'], 'wb') as f:
+            f.write(boot_data)
+        return {'path': req['output'], 'size': len(boot_data)}
+    return {'size': len(boot_data), 'data': base64.b64encode(boot_data).decode('ascii')}
+
+
+def serve_flush(served, req):
+    return {'written': served.flush()}
+
+
+SERVE_OPS = {
+    'list': serve_list,
+    'add': serve_add,
+    'delete': serve_delete,
+    'extract': serve_extract,
+    'read-boot': serve_read_boot,
+    'flush': serve_flush,
+}
+
+
+class ImageServer:
+    """JSON-lines request server on a Unix socket.
+
+    Each request is one JSON object per line with an 'op' (see SERVE_OPS,
+    plus 'ping' and 'shutdown'), the 'disk' path and the same options as
+    the command line ('sssd', 'combo', 'no_skew', 'diskdef', 'slice',
+    'user', 'files', 'output', ...); 'format' names a format hint directly.
+    Each response is one line with 'ok' and either the result fields or
+    'error'; a request 'id' is echoed back.
+
+    Requests for one image are serialized by its lock and run in a worker
+    thread, so different images are served concurrently. Dirty images are
+    committed once they have been idle for idle_flush seconds, and on
+    shutdown.
+    """
+
+    def __init__(self, socket_path, idle_flush=2.0):
+        self.socket_path = socket_path
+        self.idle_flush = idle_flush
+        self.images = {}
+        self.stopping = None
+        self.socket_ino = None
+
+    def remove_stale_socket(self):
+        """Remove a socket left behind by a server that is gone.
+
+        Raises ValueError if a server still answers on the socket, or if
+        something other than a socket is in the way.
+        """
+        try:
+            st = os.stat(self.socket_path)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(st.st_mode):
+            raise ValueError(f"{self.socket_path} exists and is not a socket")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(self.socket_path)
+            except ConnectionRefusedError:
+                os.unlink(self.socket_path)
+                return
+        raise ValueError(f"a server is already running on {self.socket_path}")
+
+    async def run(self):
+        self.remove_stale_socket()
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        self.socket_ino = os.stat(self.socket_path).st_ino
+        flusher = asyncio.create_task(self.flush_idle())
+        try:
+            async with server:
+                await self.stopping.wait()
+        finally:
+            flusher.cancel()
+            for served in self.images.values():
+                async with served.lock:
+                    served.flush()
+                    served.disks.clear()
+                    served.image.close()
+            self.images.clear()
+            # Leave the socket alone if it has been replaced since we bound it
+            try:
+                if os.stat(self.socket_path).st_ino == self.socket_ino:
+                    os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+
+    async def flush_idle(self):
+        while True:
+            await asyncio.sleep(self.idle_flush / 2)
+            now = time.monotonic()
+            for served in list(self.images.values()):
+                if served.dirty and now - served.last_used >= self.idle_flush:
+                    async with served.lock:
+                        await asyncio.to_thread(served.flush)
+
+    async def handle(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                req = {}
+                try:
+                    req = json.loads(line)
+                    resp = await self.dispatch(req)
+                except (ValueError, KeyError, TypeError, AttributeError, OSError) as e:
+                    resp = {'ok': False, 'error': str(e)}
+                if isinstance(req, dict) and 'id' in req:
+                    resp['id'] = req['id']
+                writer.write(json.dumps(resp).encode() + b'\n')
+                await writer.drain()
+        except asyncio.CancelledError:
+            pass    # server is shutting down
+        finally:
+            writer.close()
+
+    async def dispatch(self, req):
+        req = dict(req)
+        op = req.get('op')
+        if op == 'ping':
+            return {'ok': True}
+        if op == 'shutdown':
+            self.stopping.set()
+            return {'ok': True}
+        handler = SERVE_OPS.get(op)
+        if handler is None:
+            raise ValueError(f"unknown op: {op}")
+
+        path = os.path.realpath(req['disk'])
+        served = self.images.get(path)
+        if served is None:
+            served = self.images[path] = ServedImage(path)
+        async with served.lock:
+            result = await asyncio.to_thread(handler, served, req)
+            served.last_used = time.monotonic()
+        return {'ok': True, **result}
+
+
+def cmd_serve(args):
+    """Serve disk image requests on a Unix socket until interrupted."""
+    socket_path = args.socket or default_socket_path()
+    print(f"Serving on {socket_path}")
+    asyncio.run(ImageServer(socket_path, args.idle_flush).run())
     return 0
 
 
+def add_slice_arguments(parser):
+    """Add the --slice/--all-slices options used by the file commands."""
+    slice_group = parser.add_mutually_exclusive_group()
+    slice_group.add_argument('--slice', type=int, default=0,
+                             help='Combo disk slice to use (default 0)')
+    slice_group.add_argument('--all-slices', action='store_true',
+                             help='Operate on every slice of a combo disk')
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='CP/M disk image utility',
@@ -1442,6 +4852,12 @@ def main():
         epilog=__doc__
     )
 
+    parser.add_argument('--diskdefs', metavar='FILE',
+                        help='Load extra formats from a cpmtools diskdefs file')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print I/O counters and phase times to stderr (or set CPM_DISK_STATS=1)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Run the command under cProfile and write the profile to FILE')
     subparsers = parser.add_subparsers(dest='command', required=True)
 
     # Create command
@@ -1455,9 +4871,23 @@ def main():
                                help='SSSD: create without sector interleave (for emulators)')
     create_parser.add_argument('--force', '-f', action='store_true',
                                help='Overwrite existing file')
+    create_parser.add_argument('--preallocate', action='store_true',
+                               help='Reserve disk space for the whole image (default: sparse file)')
     create_parser.add_argument('disk', help='Disk image file to create')
     create_parser.set_defaults(func=cmd_create)
 
+    # Format command
+    format_parser = subparsers.add_parser('format', help='Erase the directories of an existing disk image')
+    format_type = format_parser.add_mutually_exclusive_group()
+    format_type.add_argument('--sssd', action='store_true',
+                             help='Disk is SSSD (ibm-3740) format')
+    format_type.add_argument('--combo', action='store_true',
+                             help='Disk is combo format (1MB prefix)')
+    format_parser.add_argument('--slice', type=int, default=None,
+                               help='Combo disk slice to format (default: every slice)')
+    format_parser.add_argument('disk', help='Disk image file')
+    format_parser.set_defaults(func=cmd_format)
+
     # Add command
     add_parser = subparsers.add_parser('add', help='Add files to disk image')
     add_format = add_parser.add_mutually_exclusive_group()
@@ -1471,6 +4901,9 @@ def main():
                            help='Set SYS attribute on files (makes visible from any user area)')
     add_parser.add_argument('--user', '-u', type=int, default=0,
                            help='User number for files (0-15, default 0)')
+    add_parser.add_argument('--quiet', '-q', action='store_true',
+                           help='Print one summary line instead of one line per file')
+    add_slice_arguments(add_parser)
     add_parser.add_argument('disk', help='Disk image file')
     add_parser.add_argument('files', nargs='+', help='Files to add')
     add_parser.set_defaults(func=cmd_add)
@@ -1484,9 +4917,58 @@ def main():
                              help='Disk is combo format (1MB prefix)')
     list_parser.add_argument('--no-skew', action='store_true',
                              help='Disable sector skew (SSSD only)')
+    add_slice_arguments(list_parser)
     list_parser.add_argument('disk', help='Disk image file')
     list_parser.set_defaults(func=cmd_list)
 
+    # Verify command
+    verify_parser = subparsers.add_parser('verify', help='Check an image for directory and allocation damage')
+    verify_format = verify_parser.add_mutually_exclusive_group()
+    verify_format.add_argument('--sssd', action='store_true',
+                               help='Disk is SSSD (ibm-3740) format')
+    verify_format.add_argument('--combo', action='store_true',
+                               help='Disk is combo format (1MB prefix)')
+    verify_parser.add_argument('--no-skew', action='store_true',
+                               help='Disable sector skew (SSSD only)')
+    verify_parser.add_argument('--slice', type=int, default=None,
+                               help='Check only this combo slice (default: every slice)')
+    verify_parser.add_argument('--json', action='store_true',
+                               help='Print the report as JSON')
+    verify_parser.add_argument('disk', help='Disk image file')
+    verify_parser.set_defaults(func=cmd_verify)
+
+    # Compact command
+    compact_parser = subparsers.add_parser('compact', help='Defragment a disk image')
+    compact_format = compact_parser.add_mutually_exclusive_group()
+    compact_format.add_argument('--sssd', action='store_true',
+                                help='Disk is SSSD (ibm-3740) format')
+    compact_format.add_argument('--combo', action='store_true',
+                                help='Disk is combo format (1MB prefix)')
+    compact_parser.add_argument('--no-skew', action='store_true',
+                                help='Disable sector skew (SSSD only)')
+    add_slice_arguments(compact_parser)
+    compact_parser.add_argument('--dry-run', '-n', action='store_true',
+                                help='Show how many blocks would move without changing the image')
+    compact_parser.add_argument('disk', help='Disk image file')
+    compact_parser.set_defaults(func=cmd_compact)
+
+    # Diff command
+    diff_parser = subparsers.add_parser('diff', help='Show which files differ between two images')
+    diff_format = diff_parser.add_mutually_exclusive_group()
+    diff_format.add_argument('--sssd', action='store_true',
+                             help='Disks are SSSD (ibm-3740) format')
+    diff_format.add_argument('--combo', action='store_true',
+                             help='Disks are combo format (1MB prefix)')
+    diff_parser.add_argument('--no-skew', action='store_true',
+                             help='Disable sector skew (SSSD only)')
+    diff_parser.add_argument('--slice', type=int, default=None,
+                             help='Compare only this combo slice (default: every slice)')
+    diff_parser.add_argument('--json', action='store_true',
+                             help='Print the differences as JSON')
+    diff_parser.add_argument('disk', help='Original disk image')
+    diff_parser.add_argument('other', help='Changed disk image')
+    diff_parser.set_defaults(func=cmd_diff)
+
     # Delete command
     delete_parser = subparsers.add_parser('delete', help='Delete files from disk image')
     delete_format = delete_parser.add_mutually_exclusive_group()
@@ -1496,6 +4978,7 @@ def main():
                                help='Disk is combo format (1MB prefix)')
     delete_parser.add_argument('--no-skew', action='store_true',
                                help='Disable sector skew (SSSD only)')
+    add_slice_arguments(delete_parser)
     delete_parser.add_argument('disk', help='Disk image file')
     delete_parser.add_argument('files', nargs='+', help='Files to delete')
     delete_parser.set_defaults(func=cmd_delete)
@@ -1509,14 +4992,37 @@ def main():
                                 help='Disk is combo format (1MB prefix)')
     extract_parser.add_argument('--no-skew', action='store_true',
                                 help='Disable sector skew (SSSD only)')
-    extract_parser.add_argument('--user', '-u', type=int, default=0,
-                                help='User number to extract from (0-15, default 0)')
+    extract_user = extract_parser.add_mutually_exclusive_group()
+    extract_user.add_argument('--user', '-u', type=int, default=0,
+                              help='User number to extract from (0-15, default 0)')
+    extract_user.add_argument('--all-users', action='store_true',
+                              help='Extract from every user area into user<N> subdirectories')
     extract_parser.add_argument('--output', '-o', default='.',
-                                help='Output directory (default: current directory)')
+                                help="Output directory, or '-' for stdout (default: current directory)")
+    add_slice_arguments(extract_parser)
     extract_parser.add_argument('disk', help='Disk image file')
-    extract_parser.add_argument('files', nargs='+', help='Files to extract')
+    extract_parser.add_argument('files', nargs='+',
+                                help="Files to extract; CP/M wildcards such as '*.COM' allowed")
     extract_parser.set_defaults(func=cmd_extract)
 
+    # Sync command
+    sync_parser = subparsers.add_parser('sync', help='Mirror a host directory into a disk image')
+    sync_format = sync_parser.add_mutually_exclusive_group()
+    sync_format.add_argument('--sssd', action='store_true',
+                             help='Disk is SSSD (ibm-3740) format')
+    sync_format.add_argument('--combo', action='store_true',
+                             help='Disk is combo format (1MB prefix)')
+    sync_parser.add_argument('--no-skew', action='store_true',
+                             help='Disable sector skew (SSSD only)')
+    sync_parser.add_argument('--sys', '-s', action='store_true',
+                             help='Set SYS attribute on files that are added or replaced')
+    sync_parser.add_argument('--user', '-u', type=int, default=0,
+                             help='User area to mirror into (0-15, default 0)')
+    add_slice_arguments(sync_parser)
+    sync_parser.add_argument('disk', help='Disk image file')
+    sync_parser.add_argument('directory', help='Host directory to mirror')
+    sync_parser.set_defaults(func=cmd_sync)
+
     # Read-boot command
     read_boot_parser = subparsers.add_parser('read-boot', help='Read boot area from disk image')
     read_boot_format = read_boot_parser.add_mutually_exclusive_group()
@@ -1547,12 +5053,157 @@ def main():
                                    help='Length in sectors (pads with zeros if file is shorter)')
     write_boot_parser.set_defaults(func=cmd_write_boot)
 
+    # Compress command
+    compress_parser = subparsers.add_parser('compress', help='Pack a disk image into a compressed container')
+    compress_parser.add_argument('--codec', choices=[c[0] for c in CPMZ_CODECS.values()],
+                                 default='zlib', help='Compression codec (default zlib)')
+    compress_parser.add_argument('--chunk-size', default='64K',
+                                 help='Uncompressed chunk size, e.g. 16K or 1M (default 64K)')
+    compress_parser.add_argument('--force', '-f', action='store_true',
+                                 help='Overwrite existing file')
+    compress_parser.add_argument('disk', help='Disk image file')
+    compress_parser.add_argument('output', help='Compressed container to create')
+    compress_parser.set_defaults(func=cmd_compress)
+
+    # Decompress command
+    decompress_parser = subparsers.add_parser('decompress', help='Expand a compressed, IMD or recipe image to a raw image')
+    decompress_parser.add_argument('--force', '-f', action='store_true',
+                                   help='Overwrite existing file')
+    decompress_parser.add_argument('disk', help='Compressed container, IMD file or recipe')
+    decompress_parser.add_argument('output', help='Raw disk image to create')
+    decompress_parser.set_defaults(func=cmd_decompress)
+
+    # From-cfg command
+    from_cfg_parser = subparsers.add_parser('from-cfg', help='Build one image per drive of a cpmemu .cfg file')
+    from_cfg_format = from_cfg_parser.add_mutually_exclusive_group()
+    from_cfg_format.add_argument('--sssd', action='store_true',
+                                 help='Create SSSD (ibm-3740) images (250KB)')
+    from_cfg_format.add_argument('--combo', action='store_true',
+                                 help='Create combo images (51MB), using slice 0')
+    from_cfg_parser.add_argument('--no-skew', action='store_true',
+                                 help='SSSD: write without sector interleave')
+    from_cfg_parser.add_argument('--sys', '-s', action='store_true',
+                                 help='Set SYS attribute on every file')
+    from_cfg_parser.add_argument('--output', '-o', default='.',
+                                 help='Directory for the <cfg>_<drive>.img images (default: current directory)')
+    from_cfg_parser.add_argument('--force', '-f', action='store_true',
+                                 help='Overwrite existing images')
+    from_cfg_parser.add_argument('config', help='cpmemu .cfg file')
+    from_cfg_parser.set_defaults(func=cmd_from_cfg)
+
+    # Build-many command
+    build_parser = subparsers.add_parser('build-many', help='Build the images listed in a TOML manifest in parallel')
+    build_parser.add_argument('--jobs', '-j', type=int, default=None,
+                              help='Worker processes (default: one per CPU)')
+    build_parser.add_argument('--force', '-f', action='store_true',
+                              help='Overwrite existing images')
+    build_parser.add_argument('--quiet', '-q', action='store_true',
+                              help='Only report failures and the summary')
+    build_parser.add_argument('manifest', help='Manifest file (TOML)')
+    build_parser.set_defaults(func=cmd_build_many)
+
+    # Dedup-store command
+    dedup_parser = subparsers.add_parser('dedup-store', help='Store images as blocks shared between them')
+    dedup_actions = dedup_parser.add_subparsers(dest='action', required=True)
+    dedup_add = dedup_actions.add_parser('add', help='Add images to a store, writing <image>.recipe for each')
+    dedup_add_format = dedup_add.add_mutually_exclusive_group()
+    dedup_add_format.add_argument('--sssd', action='store_true',
+                                  help='Disks are SSSD (ibm-3740) format')
+    dedup_add_format.add_argument('--combo', action='store_true',
+                                  help='Disks are combo format (1MB prefix)')
+    dedup_add.add_argument('--no-skew', action='store_true',
+                           help='Disable sector skew (SSSD only)')
+    dedup_add.add_argument('--diskdef', metavar='NAME',
+                           help='Disk format from the diskdefs registry (e.g. kpii)')
+    dedup_add.add_argument('--output', '-o', default=None,
+                           help='Directory for the recipes (default: next to each image)')
+    dedup_add.add_argument('store', help='Store directory, or a .db/.sqlite file')
+    dedup_add.add_argument('disks', nargs='+', help='Disk image files')
+    dedup_add.set_defaults(func=cmd_dedup_add)
+    dedup_info = dedup_actions.add_parser('info', help='Show block store size')
+    dedup_info.add_argument('store', help='Store directory or sqlite file')
+    dedup_info.set_defaults(func=cmd_dedup_info)
+
+    # Slice commands
+    slice_export = subparsers.add_parser('slice-export', help='Write a combo slice out as an hd1k image')
+    slice_export.add_argument('--force', '-f', action='store_true',
+                              help='Overwrite an existing output image')
+    slice_export.add_argument('disk', help='Combo disk image')
+    slice_export.add_argument('slice', type=int, help='Slice number')
+    slice_export.add_argument('output', help='hd1k image to create')
+    slice_export.set_defaults(func=cmd_slice_export)
+    slice_import = subparsers.add_parser('slice-import', help='Replace a combo slice with an hd1k image')
+    slice_import.add_argument('input', help='hd1k disk image')
+    slice_import.add_argument('disk', help='Combo disk image')
+    slice_import.add_argument('slice', type=int, help='Slice number to overwrite')
+    slice_import.set_defaults(func=cmd_slice_import)
+    slice_copy = subparsers.add_parser('slice-copy', help='Copy a slice between combo images')
+    slice_copy.add_argument('src', help='Source combo (or hd1k) image')
+    slice_copy.add_argument('src_slice', type=int, help='Source slice number')
+    slice_copy.add_argument('dst', help='Destination combo (or hd1k) image')
+    slice_copy.add_argument('dst_slice', type=int, help='Destination slice number')
+    slice_copy.set_defaults(func=cmd_slice_copy)
+
+    # Overlay command
+    overlay_parser = subparsers.add_parser('overlay', help='Copy-on-write overlays on a read-only base image')
+    overlay_actions = overlay_parser.add_subparsers(dest='action', required=True)
+    overlay_create = overlay_actions.add_parser('create', help='Create an empty overlay on a base image')
+    overlay_create.add_argument('--granule', default=str(OVERLAY_GRANULE),
+                                help=f'Bytes copied per changed piece (default {OVERLAY_GRANULE})')
+    overlay_create.add_argument('--force', '-f', action='store_true',
+                                help='Overwrite an existing overlay file')
+    overlay_create.add_argument('base', help='Base disk image (never modified)')
+    overlay_create.add_argument('overlay', help='Overlay file to create')
+    overlay_create.set_defaults(func=cmd_overlay_create)
+    overlay_commit = overlay_actions.add_parser('commit', help='Write the changes into the base and empty the overlay')
+    overlay_commit.add_argument('overlay', help='Overlay file')
+    overlay_commit.set_defaults(func=cmd_overlay_commit)
+    overlay_discard = overlay_actions.add_parser('discard', help='Drop every change in the overlay')
+    overlay_discard.add_argument('overlay', help='Overlay file')
+    overlay_discard.set_defaults(func=cmd_overlay_discard)
+    overlay_info = overlay_actions.add_parser('info', help='Show the base and size of an overlay')
+    overlay_info.add_argument('overlay', help='Overlay file')
+    overlay_info.set_defaults(func=cmd_overlay_info)
+
+    # Serve command
+    serve_parser = subparsers.add_parser('serve', help='Serve requests from cpm_disk_client.py')
+    serve_parser.add_argument('--socket', default=None,
+                              help='Unix socket path (default: $CPM_DISK_SOCKET or /tmp/cpm_disk-<uid>.sock)')
+    serve_parser.add_argument('--idle-flush', type=float, default=2.0,
+                              help='Write changes back after this many idle seconds (default 2)')
+    serve_parser.set_defaults(func=cmd_serve)
+
+    for name, subparser in subparsers.choices.items():
+        if name not in ('serve', 'compress', 'decompress', 'dedup-store', 'build-many', 'overlay',
+                        'slice-export', 'slice-import', 'slice-copy'):
+            subparser.add_argument('--diskdef', metavar='NAME',
+                                   help='Disk format from the diskdefs registry (e.g. kpii)')
+
     if len(sys.argv) == 1:
         parser.print_help()
         return 0
 
     args = parser.parse_args()
-    return args.func(args)
+    stats = None
+    if args.stats or os.environ.get('CPM_DISK_STATS', '') not in ('', '0'):
+        stats = enable_stats()
+    try:
+        if args.diskdefs:
+            load_diskdefs(args.diskdefs)
+        if args.profile:
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(args.func, args)
+            finally:
+                profiler.dump_stats(args.profile)
+                print(f"Profile written to {args.profile}", file=sys.stderr)
+        return args.func(args)
+    except (ValueError, PermissionError) as e:
+        print(f"Error: {e}")
+        return 1
+    finally:
+        if stats is not None:
+            stats.report(args.command)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""Thin client for a running `cpm_disk.py serve`.
+
+Sends one JSON-lines request per invocation and prints the result in the
+same form as cpm_disk.py. Only the standard library modules needed to
+talk to the socket are imported, so starting the client is much cheaper
+than running cpm_disk.py itself.
+
+Usage:
+  cpm_disk_client.py list <disk.img>                    # List files in disk
+  cpm_disk_client.py add <disk.img> <file1.com> [...]   # Add files to disk
+  cpm_disk_client.py delete <disk.img> <file1.com> [...]  # Delete files from disk
+  cpm_disk_client.py extract <disk.img> <file1.com> [...] # Extract files from disk
+  cpm_disk_client.py extract -o - <disk.img> <file.txt> # Extract a file to stdout
+  cpm_disk_client.py read-boot <disk.img> <output.bin>  # Read boot area to file
+  cpm_disk_client.py flush <disk.img>                   # Write changes back now
+  cpm_disk_client.py shutdown                           # Stop the server
+
+The list, add, delete and extract commands take --slice N and --user N
+like cpm_disk.py, and they and read-boot take its format options
+(--sssd, --combo, --no-skew, --diskdef NAME); a --diskdef name from a
+diskdefs file must have been loaded by the server
+(cpm_disk.py --diskdefs FILE serve).
+The server writes changes back to an image after it has been idle for a
+moment; use flush when a file must be on disk now.
+"""
+
+import argparse
+import base64
+import json
+import os
+import socket
+import sys
+
+
+def default_socket_path():
+    """Socket used when none is given (matches cpm_disk.default_socket_path)."""
+    return os.environ.get('CPM_DISK_SOCKET') or f"/tmp/cpm_disk-{os.getuid()}.sock"
+
+
+def request(socket_path, req):
+    """Send one request to the server and return the decoded response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(req).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        return {'ok': False, 'error': 'server closed the connection'}
+    return json.loads(line)
+
+
+def build_request(args):
+    """Turn parsed arguments into a server request."""
+    req = {'op': args.command}
+    if args.command == 'shutdown':
+        return req
+    req['disk'] = os.path.abspath(args.disk)
+    if args.command == 'flush':
+        return req
+
+    req['sssd'] = args.sssd
+    req['combo'] = args.combo
+    req['no_skew'] = args.no_skew
+    req['diskdef'] = args.diskdef
+    if args.command == 'read-boot':
+        req['output'] = os.path.abspath(args.output)
+        return req
+
+    req['slice'] = args.slice
+    req['user'] = args.user
+    if args.command == 'add':
+        req['files'] = [os.path.abspath(path) for path in args.files]
+        req['sys'] = args.sys
+    elif args.command in ('delete', 'extract'):
+        req['files'] = args.files
+    if args.command == 'extract':
+        req['all_users'] = args.all_users
+        if args.output != '-':
+            req['output'] = os.path.abspath(args.output)
+    return req
+
+
+def add_format_arguments(parser):
+    """Add cpm_disk.py's format options (sent to the server with each request)."""
+    format_group = parser.add_mutually_exclusive_group()
+    format_group.add_argument('--sssd', action='store_true',
+                              help='Disk is SSSD (ibm-3740) format')
+    format_group.add_argument('--combo', action='store_true',
+                              help='Disk is combo format (1MB prefix)')
+    parser.add_argument('--no-skew', action='store_true',
+                        help='Disable sector skew (SSSD only)')
+    parser.add_argument('--diskdef', metavar='NAME',
+                        help='Disk format from the diskdefs registry (e.g. kpii)')
+
+
+def print_response(args, resp):
+    """Print a successful response; returns the exit status."""
+    if args.command == 'list':
+        files = resp['files']
+        if not files:
+            print("No files found")
+            return 0
+        print(f"{'User':<5} {'Filename':<12} {'Size':>8} {'Blocks':>6}")
+        print("-" * 35)
+        for info in files:
+            print(f"{info['user']:<5} {info['name']:<12} {info['size']:>8} {info['blocks']:>6}")
+    elif args.command == 'add':
+        for name in resp['added']:
+            print(f"Added {name}")
+    elif args.command == 'delete':
+        if not resp['deleted']:
+            print(f"No files matching: {' '.join(args.files)}")
+            return 1
+        for name in resp['deleted']:
+            print(f"Deleted {name}")
+    elif args.command == 'extract':
+        status = 0
+        log = sys.stderr if args.output == '-' else sys.stdout
+        for info in resp['files']:
+            if info.get('path') is None and 'data' not in info:
+                print(f"File not found: {info['pattern']}", file=log)
+                status = 1
+            elif 'data' in info:
+                sys.stdout.buffer.write(base64.b64decode(info['data']))
+                print(f"Extracted {info['name']} -> - ({info['size']} bytes)", file=log)
+            else:
+                print(f"Extracted {info['name']} -> {info['path']} ({info['size']} bytes)")
+        return status
+    elif args.command == 'read-boot':
+        print(f"Read {resp['size']} bytes boot area from {args.disk} -> {args.output}")
+    elif args.command == 'flush':
+        print(f"Wrote {resp['written']} bytes to {args.disk}")
+    return 0
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Client for cpm_disk.py serve',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--socket', default=None,
+                        help='Unix socket path (default: $CPM_DISK_SOCKET or /tmp/cpm_disk-<uid>.sock)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for name in ('list', 'add', 'delete', 'extract'):
+        sub = subparsers.add_parser(name)
+        add_format_arguments(sub)
+        sub.add_argument('--slice', type=int, default=0,
+                         help='Combo disk slice to use (default 0)')
+        sub.add_argument('--user', '-u', type=int, default=0,
+                         help='User number (0-15, default 0)')
+        sub.add_argument('disk', help='Disk image file')
+        if name == 'add':
+            sub.add_argument('--sys', '-s', action='store_true',
+                             help='Set SYS attribute on files')
+        if name == 'extract':
+            sub.add_argument('--all-users', action='store_true',
+                             help='Extract from every user area into user<N> subdirectories')
+            sub.add_argument('--output', '-o', default='.',
+                             help="Output directory, or '-' for stdout (default: current directory)")
+        if name != 'list':
+            sub.add_argument('files', nargs='+', help='Files or CP/M patterns')
+
+    read_boot = subparsers.add_parser('read-boot')
+    add_format_arguments(read_boot)
+    read_boot.add_argument('disk', help='Disk image file')
+    read_boot.add_argument('output', help='Output file for boot area')
+    flush = subparsers.add_parser('flush')
+    flush.add_argument('disk', help='Disk image file')
+    subparsers.add_parser('shutdown')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    socket_path = args.socket or default_socket_path()
+    try:
+        resp = request(socket_path, build_request(args))
+    except OSError as e:
+        print(f"Error: cannot reach server at {socket_path}: {e}")
+        return 1
+    if not resp.get('ok'):
+        print(f"Error: {resp.get('error')}")
+        return 1
+    return print_response(args, resp)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
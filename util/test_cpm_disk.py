@@ -1,13 +1,70 @@
 #!/usr/bin/env python3
 """Unit tests for cpm_disk.py"""
 
+import argparse
+import asyncio
+import base64
+import io
+import os
+import socket
 import struct
+import tempfile
 import unittest
+from unittest import mock
 
+import bench_cpm_disk
+import cpm_disk
+import cpm_disk_client
 from cpm_disk import (
+    AllocationVector,
+    CompressedImage,
+    CpmDisk,
+    DISKDEFS,
+    DirectoryIndex,
+    DiskImage,
+    HostFile,
+    ImdImage,
+    ImageServer,
+    SssdDisk,
     Hd1kDisk,
     ComboDisk,
     create_hd1k_disk,
+    create_image_file,
+    create_overlay,
+    create_sssd_disk,
+    diff_volume,
+    directory_regions,
+    expand_cfg_vars,
+    block_segments,
+    clone_file,
+    apply_compaction,
+    changed_chunks,
+    cmd_build_many,
+    cmd_diff,
+    cmd_from_cfg,
+    cmd_format,
+    cmd_overlay_commit,
+    cmd_overlay_discard,
+    cmd_verify,
+    compact_plan,
+    compress_image,
+    copy_slice,
+    cpm_match,
+    cpm_match_many,
+    extract_slice,
+    get_disk_object,
+    load_manifest,
+    open_block_store,
+    open_image,
+    parse_cpmemu_cfg,
+    parse_diskdefs,
+    raw_to_imd,
+    store_image,
+    sync_disk,
+    verify_volume,
+    write_recipe,
+    write_raw_image,
+    write_chunks,
     BLOCK_SIZE,
 )
 
@@ -117,5 +174,1315 @@ class TestDiskAllocation(unittest.TestCase):
         self.assertEqual(files[(0, "FILE3.COM")]['blocks'], [10])
 
 
+class TestComboSlices(unittest.TestCase):
+    """Tests for addressing every slice of a combo disk."""
+
+    def test_slices_are_independent(self):
+        disk_data = create_hd1k_disk(combo=True)
+        ComboDisk(disk_data, 0).add_file("ZERO.COM", b"0" * 100)
+        ComboDisk(disk_data, 5).add_file("FIVE.COM", b"5" * 100)
+
+        self.assertEqual(list(ComboDisk(disk_data, 0).list_files()), [(0, "ZERO.COM")])
+        self.assertEqual(list(ComboDisk(disk_data, 5).list_files()), [(0, "FIVE.COM")])
+        for slice_num in range(1, 5):
+            self.assertEqual(ComboDisk(disk_data, slice_num).list_files(), {})
+
+    def test_slice_layout_matches_hd1k(self):
+        """A combo slice holds the same bytes as a standalone hd1k image."""
+        combo_data = create_hd1k_disk(combo=True)
+        hd1k_data = create_hd1k_disk(combo=False)
+        ComboDisk(combo_data, 2).add_file("TEST.COM", b"X" * 5000)
+        Hd1kDisk(hd1k_data).add_file("TEST.COM", b"X" * 5000)
+
+        start = ComboDisk.PREFIX_SIZE + 2 * ComboDisk.SLICE_SIZE
+        self.assertEqual(combo_data[start:start + ComboDisk.SLICE_SIZE], hd1k_data)
+
+    def test_slice_out_of_range(self):
+        with self.assertRaises(ValueError):
+            ComboDisk(create_hd1k_disk(combo=True), 6)
+
+
+class TestDirectoryIndex(unittest.TestCase):
+    """Tests for the in-memory directory index kept by each disk class."""
+
+    def check_index_matches_disk(self, make_disk, disk_data):
+        disk = make_disk(disk_data)
+        disk.add_file("FILE1.COM", b"A" * 100)
+        disk.add_file("FILE2.COM", b"B" * 40000)
+        disk.add_file("FILE3.COM", b"C" * 100, user=3)
+        self.assertEqual(disk.delete_file("FILE1.COM"), 1)
+
+        reparsed = make_disk(disk_data)
+        self.assertEqual(disk.list_files(), reparsed.list_files())
+        self.assertEqual(disk.directory.used_blocks, reparsed.directory.used_blocks)
+        self.assertEqual(disk.extract_file("FILE3.COM", user=3),
+                         b"C" * 100 + b"\x1a" * 28)
+
+    def test_sssd_index_matches_disk(self):
+        self.check_index_matches_disk(SssdDisk, create_sssd_disk())
+
+    def test_hd1k_index_matches_disk(self):
+        self.check_index_matches_disk(Hd1kDisk, create_hd1k_disk(combo=False))
+
+    def test_combo_index_matches_disk(self):
+        self.check_index_matches_disk(ComboDisk, create_hd1k_disk(combo=True))
+
+    def test_deleted_slot_is_reused(self):
+        """The lowest free directory slot is handed out first."""
+        disk = Hd1kDisk(create_hd1k_disk(combo=False))
+        disk.add_file("FILE1.COM", b"A")
+        disk.add_file("FILE2.COM", b"B")
+        disk.delete_file("FILE1.COM")
+        self.assertEqual(disk.find_free_dir_entry(), disk.DIR_START)
+        self.assertEqual(disk.directory.free_count, disk.DIR_ENTRIES - 1)
+        disk.add_file("FILE3.COM", b"C")
+        self.assertEqual(disk.directory.lookup(0, "FILE3   COM")[0].slot, 0)
+
+
+@unittest.skipIf(cpm_disk.np is None, "NumPy not installed")
+class TestNumpyDirectory(unittest.TestCase):
+    """The NumPy directory decoder must agree with the pure-Python one."""
+
+    def make_raw_dir(self, ptr16):
+        raw = bytearray(b"\xe5" * 32 * 16)
+
+        def entry(slot, user, name, ex, s2, rc, blocks):
+            ptrs = (struct.pack("<%dH" % len(blocks), *blocks) if ptr16 else bytes(blocks)).ljust(16, b"\0")
+            raw[slot * 32:slot * 32 + 32] = bytes([user]) + name + bytes([ex, 0, s2, rc]) + ptrs
+
+        # Extents stored out of order, with R/O and SYS attribute bits set
+        entry(0, 0, b"BIG     DA\xd4", 1, 0, 0x20, [6, 7])
+        entry(1, 0, b"BIG     DA\xd4", 0, 0, 0x80, [4, 5])
+        entry(3, 5, b"SMALL   TXT", 0, 0, 3, [5])            # shares block 5
+        entry(4, 0x21, b"LABEL      ", 0, 0, 0, [9])          # label: not a file
+        entry(5, 0, b"BAD\x01    COM", 0, 0, 1, [10])         # unprintable name
+        entry(6, 1, b"HUGE    BIN", 3, 1, 0x10, [11, 200])   # extent 35, bad pointer
+        return bytes(raw)
+
+    def check_parsers_agree(self, ptr16):
+        raw = self.make_raw_dir(ptr16)
+        fast = DirectoryIndex(raw, ptr16, 2, 64)
+        with mock.patch.object(cpm_disk, "np", None):
+            slow = DirectoryIndex(raw, ptr16, 2, 64)
+        self.assertEqual(fast.files, slow.files)
+        self.assertEqual(fast._free, slow._free)
+        self.assertEqual(fast.alv._refs, slow.alv._refs)
+        self.assertEqual(fast.alv.free_count, slow.alv.free_count)
+        self.assertEqual([e.extent for e in fast.lookup(0, "BIG     DAT")], [0, 1])
+        self.assertEqual(fast.lookup(1, "HUGE    BIN")[0].extent, 35)
+
+    def test_8bit_pointers(self):
+        self.check_parsers_agree(ptr16=False)
+
+    def test_16bit_pointers(self):
+        self.check_parsers_agree(ptr16=True)
+
+    def test_match_many(self):
+        names = ["TEST    COM", "TEST    TXT", "TESTING COM", "A       B  "]
+        for pattern in ["TEST    COM", "TEST    ???", "????????COM", "???????????", "X"]:
+            self.assertEqual(cpm_match_many(pattern, names),
+                             [cpm_match(pattern, n) for n in names])
+
+
+class TestDiskDefs(unittest.TestCase):
+    """Tests for the DPB-driven engine and the diskdefs registry."""
+
+    DISKDEFS_TEXT = """
+    # 8" single density with 2KB blocks and an explicit sector table
+    diskdef test8
+      seclen 128
+      tracks 77
+      sectrk 26
+      blocksize 2048
+      maxdir 128
+      skewtab 0,6,12,18,24,4,10,16,22,2,8,14,20,1,7,13,19,25,5,11,17,23,3,9,15,21
+      boottrk 2
+      os 2.2
+    end
+    """
+
+    def test_dpb_values(self):
+        sssd, hd1k = DISKDEFS["ibm-3740"], DISKDEFS["wbw_hd1k"]
+        self.assertEqual((sssd.spt, sssd.bsh, sssd.exm, sssd.dsm, sssd.drm), (26, 3, 0, 242, 63))
+        self.assertEqual((hd1k.spt, hd1k.bsh, hd1k.exm, hd1k.dsm, hd1k.drm), (64, 5, 1, 2043, 1023))
+        self.assertEqual(hd1k.image_size, 8388608)
+
+    def test_parse_diskdefs(self):
+        test8 = parse_diskdefs(self.DISKDEFS_TEXT)["test8"]
+        self.assertEqual((test8.exm, test8.dsm, test8.dir_blocks), (1, 120, 2))
+        self.assertEqual(test8.sector_table(), DISKDEFS["ibm-3740"].sector_table())
+        with self.assertRaises(ValueError):
+            parse_diskdefs("diskdef bad\n  seclen 128\nend\n")
+        with self.assertRaisesRegex(ValueError, "at most 256"):
+            parse_diskdefs("diskdef big1k\n  seclen 512\n  tracks 160\n  sectrk 9\n"
+                           "  blocksize 1024\n  maxdir 64\n  boottrk 2\nend\n")
+
+    def test_round_trip_on_registered_formats(self):
+        data = os.urandom(70000)
+        with mock.patch.dict(DISKDEFS, parse_diskdefs(self.DISKDEFS_TEXT)):
+            for name in ("kpii", "osborne1", "test8"):
+                diskdef = DISKDEFS[name]
+                disk_data = bytearray(diskdef.image_size)
+                for start, region in directory_regions(name):
+                    disk_data[start:start + len(region)] = region
+                disk = CpmDisk(disk_data, diskdef)
+                self.assertEqual(disk.directory.free_count, diskdef.maxdir)
+                self.assertTrue(disk.add_file("DATA.BIN", data))
+                reparsed = CpmDisk(disk_data, diskdef)
+                self.assertEqual(reparsed.extract_file("DATA.BIN")[:len(data)], data, name)
+
+    def test_combo_large_file_uses_exm(self):
+        """Combo slices share the hd1k EXM=1 entry layout."""
+        data = os.urandom(40000)
+        disks = [Hd1kDisk(create_hd1k_disk(combo=False)), ComboDisk(create_hd1k_disk(combo=True))]
+        for disk in disks:
+            disk.add_file("BIG.DAT", data, sys_attr=True)
+            self.assertEqual(disk.extract_file("BIG.DAT")[:len(data)], data)
+        self.assertEqual(disks[0].read_dir_entry(0), disks[1].read_dir_entry(0))
+        self.assertEqual(disks[1].read_dir_entry(0)[10], ord("A") | 0x80)
+
+    def test_empty_file_gets_an_entry(self):
+        disk = Hd1kDisk(create_hd1k_disk(combo=False))
+        disk.add_file("EMPTY.TXT", b"")
+        self.assertEqual(disk.list_files()[(0, "EMPTY.TXT")]["records"], 0)
+        self.assertEqual(disk.extract_file("EMPTY.TXT"), b"")
+
+
+class TestAllocationVector(unittest.TestCase):
+    """Tests for the ALV-style block allocator."""
+
+    def test_first_fit_prefers_contiguous_run(self):
+        alv = AllocationVector(20, 2)
+        alv.mark_used([4, 7])
+        # 2-3 is too short for three blocks; 8-10 is the first run that fits
+        self.assertEqual(alv.allocate(3), [8, 9, 10])
+        self.assertEqual(alv.allocate(2), [2, 3])
+        self.assertEqual(alv.free_count, 20 - 9)
+
+    def test_fragmented_allocation_uses_lowest_free_blocks(self):
+        alv = AllocationVector(8, 0)
+        alv.mark_used([1, 3, 5, 7])
+        self.assertEqual(alv.allocate(3), [0, 2, 4])
+        self.assertIsNone(alv.allocate(2))
+
+    def test_shared_block_stays_allocated(self):
+        alv = AllocationVector(8, 0)
+        alv.mark_used([3])
+        alv.mark_used([3])
+        alv.release([3])
+        self.assertTrue(alv.is_used(3))
+        alv.release([3])
+        self.assertFalse(alv.is_used(3))
+
+    def test_deleted_blocks_are_reused(self):
+        """Add/delete cycles must not creep towards the end of the disk."""
+        disk = Hd1kDisk(create_hd1k_disk(combo=False))
+        disk.add_file("KEEP.COM", b"K" * 100)
+        for _ in range(3):
+            disk.add_file("TEMP.DAT", b"T" * (BLOCK_SIZE * 3))
+            self.assertEqual(disk.list_files()[(0, "TEMP.DAT")]['blocks'], [9, 10, 11])
+            disk.delete_file("TEMP.DAT")
+        self.assertEqual(disk.find_max_block(), 8)
+
+    def test_full_disk_rejected_before_writing(self):
+        disk = SssdDisk(create_sssd_disk())
+        free = disk.directory.alv.free_count
+        self.assertFalse(disk.add_file("HUGE.DAT", b"X" * (free + 1) * disk.BLOCK_SIZE))
+        self.assertEqual(disk.list_files(), {})
+        self.assertEqual(disk.directory.alv.free_count, free)
+
+
+class TestSssdSectorTables(unittest.TestCase):
+    """The precomputed SSSD tables must agree with the sector arithmetic."""
+
+    def check_block_layout(self, use_skew):
+        disk = SssdDisk(create_sssd_disk(), use_skew=use_skew)
+        for block in range(disk.TOTAL_BLOCKS):
+            data = bytes((block + i) & 0xFF for i in range(disk.BLOCK_SIZE))
+            disk.write_block(block, data)
+            self.assertEqual(disk.read_block(block), data)
+            for i in range(8):
+                sector_num = block * 8 + i
+                track = disk.BOOT_TRACKS + sector_num // disk.SECTORS_PER_TRACK
+                sector = sector_num % disk.SECTORS_PER_TRACK
+                self.assertEqual(disk.read_sector(track, sector), data[i * 128:(i + 1) * 128])
+
+    def test_skewed_blocks_match_sector_arithmetic(self):
+        self.check_block_layout(use_skew=True)
+
+    def test_unskewed_blocks_are_single_runs(self):
+        self.check_block_layout(use_skew=False)
+        disk = SssdDisk(create_sssd_disk(), use_skew=False)
+        self.assertTrue(all(len(runs) == 1 for runs in disk.block_runs))
+
+    def test_dir_entry_written_in_place(self):
+        disk = SssdDisk(create_sssd_disk())
+        entry = bytes(range(32))
+        disk.write_dir_entry(37, entry)
+        self.assertEqual(disk.read_dir_entry(37), entry)
+        self.assertEqual(disk.read_block(1)[5 * 32:6 * 32], entry)
+
+
+class TestBatchAdd(unittest.TestCase):
+    """Tests for add_files()."""
+
+    def test_batch_is_allocated_contiguously(self):
+        disk = Hd1kDisk(create_hd1k_disk(combo=False))
+        disk.add_file("OLD.COM", b"O")
+        disk.delete_file("OLD.COM")
+        batch = [("A.C", b"a" * 100), ("B.C", b"b" * (BLOCK_SIZE + 1)), ("C.C", b"c")]
+        self.assertTrue(disk.add_files(batch, quiet=True))
+        files = disk.list_files()
+        self.assertEqual(files[(0, "A.C")]['blocks'], [8])
+        self.assertEqual(files[(0, "B.C")]['blocks'], [9, 10])
+        self.assertEqual(files[(0, "C.C")]['blocks'], [11])
+        self.assertEqual(disk.extract_file("B.C")[:BLOCK_SIZE + 1], b"b" * (BLOCK_SIZE + 1))
+
+    def test_batch_that_does_not_fit_writes_nothing(self):
+        disk_data = create_sssd_disk()
+        disk = SssdDisk(disk_data)
+        batch = [(f"F{i}.C", b"x") for i in range(disk.DIR_ENTRIES + 1)]
+        self.assertFalse(disk.add_files(batch, quiet=True))
+        self.assertEqual(disk.list_files(), {})
+        self.assertEqual(disk_data, create_sssd_disk())
+
+
+class TestStreamingExtract(unittest.TestCase):
+    """Tests for iter_file_chunks() and write_chunks()."""
+
+    def test_hd1k_contiguous_file_is_one_view(self):
+        disk = Hd1kDisk(create_hd1k_disk(combo=False))
+        data = os.urandom(BLOCK_SIZE * 20 + 300)
+        disk.add_file("BIG.DAT", data)
+        chunks = list(disk.iter_file_chunks("BIG.DAT"))
+        self.assertEqual(len(chunks), 1)
+        self.assertIsInstance(chunks[0], memoryview)
+        self.assertEqual(bytes(chunks[0]), data + b"\x1a" * 84)
+
+    def test_sssd_chunks_follow_skew(self):
+        disk = SssdDisk(create_sssd_disk())
+        data = os.urandom(5000)
+        disk.add_file("SKEW.DAT", data)
+        chunks = list(disk.iter_file_chunks("SKEW.DAT"))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), data + b"\x1a" * 120)
+
+    def test_missing_file(self):
+        disk = Hd1kDisk(create_hd1k_disk(combo=False))
+        self.assertIsNone(disk.iter_file_chunks("NONE.COM"))
+
+    def test_write_chunks(self):
+        chunks = [memoryview(b"abc"), b"", memoryview(b"defgh")[1:]]
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(write_chunks(f, chunks), 7)
+            f.seek(0)
+            self.assertEqual(f.read(), b"abcefgh")
+
+
+class TestBulkExtract(unittest.TestCase):
+    """Tests for wildcard and all-users extraction."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        disk_data = create_hd1k_disk(combo=False)
+        disk = Hd1kDisk(disk_data)
+        disk.add_files([("A.COM", b"a" * 200), ("B.TXT", b"b" * 10)])
+        disk.add_file("C.COM", b"c" * 5000, user=3)
+        self.path = os.path.join(self.tmp.name, "disk.img")
+        with open(self.path, "wb") as f:
+            f.write(disk_data)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_wildcard_single_user(self):
+        out = os.path.join(self.tmp.name, "out")
+        results = extract_slice(0, self.path, "hd1k", ["*.COM"], 0, out)
+        self.assertEqual([(r[1], r[3]) for r in results], [("A.COM", 256)])
+        self.assertEqual(os.listdir(out), ["a.com"])
+
+    def test_all_users_mirrors_user_areas(self):
+        out = os.path.join(self.tmp.name, "out")
+        results = extract_slice(0, self.path, "hd1k", ["*.*", "*.COM", "NONE.X"], 0, out,
+                                all_users=True)
+        written = sorted(os.path.relpath(r[2], out) for r in results if r[2])
+        self.assertEqual(written, ["user0/a.com", "user0/b.txt", "user3/c.com"])
+        self.assertIn(("NONE.X", "NONE.X", None, 0), results)
+        with open(os.path.join(out, "user3", "c.com"), "rb") as f:
+            self.assertEqual(f.read(), b"c" * 5000 + b"\x1a" * 120)
+
+
+class TestCreateAndFormat(unittest.TestCase):
+    """Tests for sparse image creation and in-place formatting."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "disk.img")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_created_files_match_in_memory_images(self):
+        for fmt, expected in [("sssd", create_sssd_disk()),
+                              ("hd1k", create_hd1k_disk(combo=False)),
+                              ("combo", create_hd1k_disk(combo=True))]:
+            self.assertEqual(create_image_file(self.path, fmt), len(expected))
+            with open(self.path, "rb") as f:
+                self.assertEqual(f.read(), bytes(expected), fmt)
+
+    def test_skewed_sssd_directory_is_empty(self):
+        for use_skew in (True, False):
+            disk = SssdDisk(create_sssd_disk(), use_skew=use_skew)
+            self.assertEqual(disk.directory.free_count, 64)
+
+    def test_format_in_place(self):
+        create_image_file(self.path, "combo")
+        with DiskImage(self.path, writable=True) as image:
+            for slice_num in (0, 1):
+                ComboDisk(image, slice_num).add_file("A.COM", b"a" * 100)
+            image.commit()
+        with mock.patch("sys.stdout"):
+            cmd_format(argparse.Namespace(disk=self.path, slice=1))
+        with DiskImage(self.path) as image:
+            self.assertIn((0, "A.COM"), ComboDisk(image, 0).list_files())
+            self.assertEqual(ComboDisk(image, 1).list_files(), {})
+
+
+class TestSync(unittest.TestCase):
+    """Tests for mirroring a host directory into a disk."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.disk = Hd1kDisk(create_hd1k_disk(combo=False))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data):
+        with open(os.path.join(self.tmp.name, name), "wb") as f:
+            f.write(data)
+
+    def sync(self, cached=None):
+        with mock.patch("sys.stdout"):
+            return sync_disk(self.disk, self.tmp.name, cached=cached)
+
+    def test_only_changed_files_are_rewritten(self):
+        self.write("a.com", b"a" * 300)
+        self.write("b.txt", b"b" * 5000)
+        self.disk.add_file("OLD.DAT", b"old")
+        changes, area = self.sync()
+        self.assertEqual(changes["added"], ["A.COM", "B.TXT"])
+        self.assertEqual(changes["deleted"], ["OLD.DAT"])
+
+        self.write("b.txt", b"B" * 5000)
+        changes, area = self.sync(area)
+        self.assertEqual(changes["replaced"], ["B.TXT"])
+        self.assertEqual(changes["unchanged"], ["A.COM"])
+        self.assertEqual(self.disk.extract_file("B.TXT")[:5000], b"B" * 5000)
+
+    def test_identical_content_without_cache(self):
+        """A file already on disk with the same content is not rewritten."""
+        self.write("a.com", b"a" * 300)
+        self.disk.add_file("A.COM", b"a" * 300)
+        changes, _ = self.sync()
+        self.assertEqual(changes["unchanged"], ["A.COM"])
+
+
+class TestImageServer(unittest.TestCase):
+    """Tests for the serve request handling."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "disk.img")
+        create_image_file(self.path, "hd1k")
+        self.server = ImageServer(os.path.join(self.tmp.name, "sock"))
+
+    def tearDown(self):
+        for served in self.server.images.values():
+            served.disks.clear()
+            served.image.close()
+        self.tmp.cleanup()
+
+    def call(self, **req):
+        with mock.patch("sys.stdout"):
+            return asyncio.run(self.server.dispatch(dict(req, disk=self.path)))
+
+    def test_changes_are_written_back_on_flush(self):
+        data = base64.b64encode(b"x" * 300).decode()
+        self.assertTrue(self.call(op="add", files=[{"name": "X.COM", "data": data}])["ok"])
+        self.assertEqual(self.call(op="list")["files"][0]["name"], "X.COM")
+        with DiskImage(self.path) as image:
+            self.assertEqual(Hd1kDisk(image).list_files(), {})
+
+        self.assertGreater(self.call(op="flush")["written"], 0)
+        with DiskImage(self.path) as image:
+            self.assertIn((0, "X.COM"), Hd1kDisk(image).list_files())
+
+    def test_inline_extract_and_delete(self):
+        data = base64.b64encode(b"y" * 128).decode()
+        self.call(op="add", files=[{"name": "Y.TXT", "data": data}])
+        files = self.call(op="extract", files=["*.TXT"])["files"]
+        self.assertEqual(base64.b64decode(files[0]["data"]), b"y" * 128)
+        self.assertEqual(self.call(op="delete", files=["Y.*"])["deleted"], ["Y.TXT"])
+        self.assertEqual(self.call(op="list")["files"], [])
+
+
+    def test_format_options_select_geometry(self):
+        path = os.path.join(self.tmp.name, "noskew.img")
+        create_image_file(path, "sssd")
+        with DiskImage(path, writable=True) as image, mock.patch("sys.stdout"):
+            SssdDisk(image, use_skew=False).add_file("RAW.TXT", bytes(range(256)) * 8)
+            image.commit()
+        args = cpm_disk_client.make_parser().parse_args(
+            ["extract", "--no-skew", "-o", "-", path, "RAW.TXT"])
+        req = cpm_disk_client.build_request(args)
+        self.assertTrue(req["no_skew"])
+        with mock.patch("sys.stdout"):
+            files = asyncio.run(self.server.dispatch(req))["files"]
+            skewed = asyncio.run(self.server.dispatch(dict(req, no_skew=False)))["files"]
+        self.assertEqual(base64.b64decode(files[0]["data"]), bytes(range(256)) * 8)
+        self.assertNotEqual(skewed[0].get("data"), files[0]["data"])
+
+    def test_refuses_socket_of_running_server(self):
+        sock_path = self.server.socket_path
+
+        async def scenario():
+            task = asyncio.create_task(self.server.run())
+            while self.server.socket_ino is None:
+                await asyncio.sleep(0.01)
+            with self.assertRaisesRegex(ValueError, 'already running'):
+                await ImageServer(sock_path).run()
+            self.assertTrue(os.path.exists(sock_path))
+            self.server.stopping.set()
+            await task
+
+        asyncio.run(scenario())
+        self.assertFalse(os.path.exists(sock_path))
+
+    def test_replaces_stale_socket_and_leaves_a_new_one(self):
+        sock_path = self.server.socket_path
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+            stale.bind(sock_path)
+
+        async def scenario():
+            task = asyncio.create_task(self.server.run())
+            while self.server.socket_ino is None:
+                await asyncio.sleep(0.01)
+            # Another server took the path over; shutting down must not remove it
+            os.unlink(sock_path)
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as other:
+                other.bind(sock_path)
+            self.server.stopping.set()
+            await task
+
+        asyncio.run(scenario())
+        self.assertTrue(os.path.exists(sock_path))
+
+class TestDiskImage(unittest.TestCase):
+    """Tests for the mmap-backed image with dirty-range write-back."""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.img')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(create_hd1k_disk(combo=False))
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_commit_writes_only_dirty_ranges(self):
+        """Adding a file should flush just the data block and directory sector."""
+        with DiskImage(self.path, writable=True) as image:
+            Hd1kDisk(image).add_file("TEST.COM", b"Hello")
+            ranges = image.dirty_ranges()
+            written = image.commit()
+
+        dir_start = Hd1kDisk.DIR_START
+        self.assertEqual(ranges, [
+            (dir_start, dir_start + 512),
+            (dir_start + 8 * BLOCK_SIZE, dir_start + 9 * BLOCK_SIZE),
+        ])
+        self.assertEqual(written, 512 + BLOCK_SIZE)
+
+        with DiskImage(self.path) as image:
+            self.assertEqual(Hd1kDisk(image).extract_file("TEST.COM"),
+                             b"Hello" + b"\x1a" * 123)
+
+    def test_uncommitted_changes_are_discarded(self):
+        """Closing without commit must leave the file untouched."""
+        with DiskImage(self.path, writable=True) as image:
+            Hd1kDisk(image).add_file("TEST.COM", b"Hello")
+
+        with DiskImage(self.path) as image:
+            self.assertEqual(Hd1kDisk(image).list_files(), {})
+
+    def test_write_past_end_raises(self):
+        """Unlike bytearray, the image must not grow on oversized writes."""
+        with DiskImage(self.path, writable=True) as image:
+            with self.assertRaises(IndexError):
+                image[len(image) - 1:len(image) + 1] = b"ab"
+
+
+class TestImdImage(unittest.TestCase):
+    """Tests for ImageDisk files opened as flat sector images."""
+
+    def setUp(self):
+        self.raw = create_sssd_disk()
+        SssdDisk(self.raw).add_file("TEST.TXT", bytes(range(256)) * 20)
+        fd, self.path = tempfile.mkstemp(suffix='.imd')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw_to_imd(self.raw, DISKDEFS['ibm-3740'], 'test disk\r\n'))
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_reads_match_raw_image(self):
+        """The IMD image should read back byte-for-byte as the raw image."""
+        self.assertLess(os.path.getsize(self.path), len(self.raw) // 2)
+        with open_image(self.path) as image:
+            self.assertIsInstance(image, ImdImage)
+            self.assertEqual(len(image), len(self.raw))
+            self.assertEqual(image[:], bytes(self.raw))
+            self.assertEqual(image[-1], self.raw[-1])
+            self.assertEqual(SssdDisk(image).extract_file("TEST.TXT"),
+                             bytes(range(256)) * 20)
+
+    def test_sectors_in_id_order(self):
+        """Sectors are laid out by ID, whatever the numbering map order."""
+        track = bytes((0, 0, 0, 3, 0, 1, 3, 2))
+        track += b'\x01' + b'a' * 128 + b'\x02c' + b'\x01' + b'b' * 128
+        with open(self.path, 'wb') as f:
+            f.write(b'IMD 1.18: test\r\n\x1a' + track)
+        with ImdImage(self.path) as image:
+            self.assertEqual(image[:], b'a' * 128 + b'b' * 128 + b'c' * 128)
+
+    def test_commit_round_trip(self):
+        """Written sectors persist, and uniform sectors are stored compressed."""
+        with open_image(self.path, writable=True) as image:
+            disk = SssdDisk(image)
+            disk.add_file("NEW.COM", b"Hello")
+            disk.delete_file("TEST.TXT")
+            image.commit()
+        SssdDisk(self.raw).add_file("NEW.COM", b"Hello")
+        SssdDisk(self.raw).delete_file("TEST.TXT")
+
+        with open_image(self.path) as image:
+            self.assertEqual(image[:], bytes(self.raw))
+            self.assertEqual(list(SssdDisk(image).list_files()), [(0, "NEW.COM")])
+        with open(self.path, 'rb') as f:
+            header, tracks = f.read().split(b'\x1a', 1)
+        self.assertTrue(header.endswith(b'test disk\r\n'))
+        self.assertEqual(tracks, raw_to_imd(self.raw, DISKDEFS['ibm-3740']).split(b'\x1a', 1)[1])
+
+    def test_uncommitted_changes_are_discarded(self):
+        with open_image(self.path, writable=True) as image:
+            SssdDisk(image).delete_file("TEST.TXT")
+        with open_image(self.path) as image:
+            self.assertEqual(len(SssdDisk(image).list_files()), 1)
+
+
+class TestCompressedImage(unittest.TestCase):
+    """Tests for the chunked compressed container."""
+
+    def setUp(self):
+        self.raw = create_hd1k_disk(combo=False)
+        Hd1kDisk(self.raw).add_file("BIG.DAT", os.urandom(100000))
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'disk.cpmz')
+        compress_image(self.raw, self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_reads_match_raw_image(self):
+        """Every byte reads back, and fill chunks take no space."""
+        self.assertLess(os.path.getsize(self.path), 150000)
+        with open_image(self.path) as image:
+            self.assertIsInstance(image, CompressedImage)
+            self.assertEqual(len(image), len(self.raw))
+            self.assertEqual(image[:], bytes(self.raw))
+            self.assertEqual(image[-1], self.raw[-1])
+
+    def test_only_touched_chunks_are_decompressed(self):
+        """Listing and extracting one file should not expand the whole image."""
+        with CompressedImage(self.path, cache_chunks=2) as image:
+            with mock.patch.object(image, '_decompress', wraps=image._decompress) as decompress:
+                disk = Hd1kDisk(image)
+                self.assertEqual(len(disk.extract_file("BIG.DAT")), 100096)
+                self.assertEqual(decompress.call_count, 3)
+                self.assertEqual(len(image._cache), 2)
+
+    def test_commit_round_trip(self):
+        """Changes persist and unchanged chunks are copied over as they were."""
+        with open_image(self.path, writable=True) as image:
+            disk = Hd1kDisk(image)
+            disk.delete_file("BIG.DAT")
+            disk.add_file("NEW.COM", b"Hello")
+            image.commit()
+            self.assertEqual(list(Hd1kDisk(image).list_files()), [(0, "NEW.COM")])
+        disk = Hd1kDisk(self.raw)
+        disk.delete_file("BIG.DAT")
+        disk.add_file("NEW.COM", b"Hello")
+
+        with open_image(self.path) as image:
+            self.assertEqual(image[:], bytes(self.raw))
+
+    def test_lzma_and_raw_export(self):
+        lzma_path = os.path.join(self.tmpdir.name, 'disk.xz.cpmz')
+        raw_path = os.path.join(self.tmpdir.name, 'disk.img')
+        compress_image(self.raw, lzma_path, codec='lzma', chunk_size=4096)
+        with open_image(lzma_path) as image:
+            self.assertEqual(image.codec, 'lzma')
+            write_raw_image(image, raw_path)
+        with open(raw_path, 'rb') as f:
+            self.assertEqual(f.read(), bytes(self.raw))
+        with self.assertRaises(ValueError):
+            compress_image(self.raw, lzma_path, codec='bz2')
+
+
+class TestDedupStore(unittest.TestCase):
+    """Tests for the content-addressed block store and recipes."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.payload = os.urandom(20000)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_segments_cover_image_once(self):
+        for fmt, size in (('sssd', 256256), ('hd1k', 8388608), ('combo', 51380224)):
+            spans = sorted(span for seg in block_segments(fmt, size) for span in seg)
+            pos = 0
+            for start, length in spans:
+                self.assertEqual(start, pos)
+                pos += length
+            self.assertEqual(pos, size)
+
+    def test_shared_file_blocks_stored_once(self):
+        """A file common to two differently skewed images shares its blocks."""
+        first = create_sssd_disk()
+        second = create_sssd_disk()
+        SssdDisk(first).add_file("COMMON.COM", self.payload)
+        SssdDisk(second).add_file("OTHER.TXT", os.urandom(3000))
+        SssdDisk(second).add_file("COMMON.COM", self.payload)
+        for store_name in ('store', 'store.db'):
+            with open_block_store(self.path(store_name)) as store:
+                _, new_first, _ = store_image(store, first, 'sssd')
+                _, new_second, _ = store_image(store, second, 'sssd')
+            # Only OTHER.TXT's 3 blocks and the changed directory block are new
+            self.assertEqual(new_second, 4, store_name)
+            self.assertLess(new_first, 40)
+
+    def test_mount_and_restore_recipe(self):
+        raw = create_hd1k_disk(combo=False)
+        Hd1kDisk(raw).add_file("BIG.DAT", self.payload)
+        recipe_path = self.path('disk.img.recipe')
+        with open_block_store(self.path('store.sqlite')) as store:
+            recipe, _, _ = store_image(store, raw, 'hd1k')
+        write_recipe(recipe_path, recipe, self.path('store.sqlite'))
+        self.assertLess(os.path.getsize(recipe_path), 1000)
+
+        with open_image(recipe_path) as image:
+            disk = cpm_disk.get_disk_object(image)
+            self.assertEqual(disk.extract_file("BIG.DAT")[:20000], self.payload)
+            self.assertLessEqual(len(image._cache), 8)
+            write_raw_image(image, self.path('restored.img'))
+            with self.assertRaises(TypeError):
+                image[0] = 1
+        with open(self.path('restored.img'), 'rb') as f:
+            self.assertEqual(f.read(), bytes(raw))
+        with self.assertRaises(PermissionError):
+            open_image(recipe_path, writable=True)
+
+
+class TestBuildMany(unittest.TestCase):
+    """Tests for building images from a manifest."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.base = self.tmpdir.name
+        os.mkdir(os.path.join(self.base, 'bin'))
+        for name, data in (('A.COM', b'a' * 5000), ('B.COM', b'b' * 100)):
+            with open(os.path.join(self.base, 'bin', name), 'wb') as f:
+                f.write(data)
+        with open(os.path.join(self.base, 'boot.bin'), 'wb') as f:
+            f.write(b'\xc3' * 256)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def build(self, manifest):
+        path = os.path.join(self.base, 'm.toml')
+        with open(path, 'w') as f:
+            f.write(manifest)
+        args = argparse.Namespace(manifest=path, jobs=2, force=False, quiet=True)
+        with mock.patch('sys.stdout'):
+            return cmd_build_many(args)
+
+    def test_builds_images_and_reports_failures(self):
+        status = self.build("""
+[defaults]
+format = "sssd"
+boot = "boot.bin"
+
+[[image]]
+output = "out/a.img"
+files = ["bin/*.COM"]
+
+[[image]]
+output = "out/b.img"
+format = "hd1k"
+user = 2
+files = ["bin/B.COM"]
+
+[[image]]
+output = "out/full.img"
+files = ["bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM",
+         "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM",
+         "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM",
+         "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM",
+         "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM",
+         "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM",
+         "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM",
+         "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM", "bin/A.COM",
+         "bin/A.COM", "bin/A.COM"]
+""")
+        self.assertEqual(status, 1)
+        out = os.path.join(self.base, 'out')
+        self.assertEqual(sorted(os.listdir(out)), ['a.img', 'b.img'])
+        with DiskImage(os.path.join(out, 'a.img')) as image:
+            disk = SssdDisk(image)
+            self.assertEqual(sorted(disk.list_files()), [(0, 'A.COM'), (0, 'B.COM')])
+            self.assertEqual(disk.read_boot_area()[:256], b'\xc3' * 256)
+        with DiskImage(os.path.join(out, 'b.img')) as image:
+            self.assertEqual(list(Hd1kDisk(image).list_files()), [(2, 'B.COM')])
+
+    def test_build_image_reports_why_files_do_not_fit(self):
+        template = os.path.join(self.base, 'template.img')
+        cpm_disk.build_template(template, 'sssd', None)
+        a_com = os.path.join(self.base, 'bin', 'A.COM')
+        entry = {'output': os.path.join(self.base, 'full.img'), 'format': 'sssd',
+                 'files': [a_com] * 50, 'user': 0, 'sys': False, 'slice': 0}
+        with mock.patch('sys.stdout') as stdout:
+            output, error, count, size = cpm_disk.build_image(entry, template)
+        stdout.write.assert_not_called()
+        self.assertRegex(error, r'^No free blocks for 50 files')
+        self.assertFalse(os.path.exists(output))
+
+    def test_manifest_types_are_checked(self):
+        path = os.path.join(self.base, 'm.toml')
+        for body, message in (('output = 5', 'output must be a string'),
+                              ('output = "x.img"\nfiles = "bin/A.COM"', 'files must be a list'),
+                              ('output = "x.img"\nfiles = [1]', 'files must be a list'),
+                              ('output = "x.img"\nuser = "2"', 'user must be an integer'),
+                              ('output = "x.img"\nslice = true', 'slice must be an integer'),
+                              ('output = "x.img"\nformat = ["hd1k"]', 'format must be a string')):
+            with self.subTest(body=body):
+                with open(path, 'w') as f:
+                    f.write(f"[[image]]\n{body}\n")
+                with self.assertRaisesRegex(ValueError, f'image 0: {message}'):
+                    load_manifest(path)
+
+    def test_clone_keeps_holes(self):
+        src = os.path.join(self.base, 'src.img')
+        dst = os.path.join(self.base, 'dst.img')
+        create_image_file(src, 'hd1k')
+        copied = clone_file(src, dst)
+        with open(src, 'rb') as a, open(dst, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertLessEqual(copied, os.path.getsize(src))
+
+
+class TestFromCfg(unittest.TestCase):
+    """Tests for building images from a cpmemu .cfg file."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.base = self.tmpdir.name
+        for sub in ('src', 'inc', 'bin'):
+            os.mkdir(os.path.join(self.base, sub))
+        self.write('src/MAIN.C', b'int main()\n{\n}\n' * 2000)
+        self.write('src/DATA.BIN', b'\n' * 300)
+        self.write('src/long_name.c', b'skipped')
+        self.write('inc/STDIO.H', b'#define EOF -1\n\x1aignored')
+        self.write('bin/C.COM', b'\xc3\n' * 100)
+        self.write('bin/NOTES.TXT', b'line\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, data):
+        with open(os.path.join(self.base, name), 'wb') as f:
+            f.write(data)
+
+    def test_expand_vars(self):
+        env = {'HOME': '/h', 'X_1': 'x'}
+        self.assertEqual(expand_cfg_vars('${HOME}/a/$X_1/$NOPE.b', env), '/h/a/x/.b')
+        self.assertEqual(expand_cfg_vars('${HOME', env), '/h')
+
+    def test_host_file_text_conversion(self):
+        path = os.path.join(self.base, 'inc', 'STDIO.H')
+        text = HostFile(path, text=True, chunk_size=4)
+        self.assertEqual(len(text), 16)
+        self.assertEqual(b''.join(text.chunks()), b'#define EOF -1\r\n')
+        raw_text = HostFile(path, text=True, eol=False, chunk_size=4)
+        self.assertEqual(len(raw_text), 15)
+        self.assertEqual(b''.join(raw_text.chunks()), b'#define EOF -1\n')
+        self.assertEqual(len(HostFile(path)), 23)
+
+    def test_builds_one_image_per_drive(self):
+        cfg = os.path.join(self.base, 'proj.cfg')
+        with open(cfg, 'w') as f:
+            f.write("""# test
+program = $ROOT/bin/C.COM
+cd = ${ROOT}
+*.C = text
+NOTES.TXT = bin/NOTES.TXT binary
+drive_B = src   # sources
+eol_convert = false
+drive_C = inc
+*.H = text
+debug = true
+""")
+        out = os.path.join(self.base, 'out')
+        args = argparse.Namespace(config=cfg, output=out, diskdef=None, sssd=True, combo=False,
+                                  no_skew=False, sys=False, force=False)
+        with mock.patch.dict(os.environ, {'ROOT': self.base}), mock.patch('sys.stdout'):
+            config = parse_cpmemu_cfg(cfg)
+            self.assertEqual(config['drives']['B'], os.path.join(self.base, 'src'))
+            self.assertEqual(cmd_from_cfg(args), 0)
+        self.assertEqual(sorted(os.listdir(out)), ['proj_A.img', 'proj_B.img', 'proj_C.img'])
+
+        def files(letter):
+            with DiskImage(os.path.join(out, f'proj_{letter}.img')) as image:
+                disk = SssdDisk(image)
+                return {name: disk.extract_file(name) for _, name in disk.list_files()}
+
+        a = files('A')
+        self.assertEqual(sorted(a), ['C.COM', 'NOTES.TXT'])
+        self.assertEqual(a['C.COM'], b'\xc3\n' * 100 + b'\x1a' * 56)
+        self.assertTrue(a['NOTES.TXT'].startswith(b'line\n\x1a'))
+        b = files('B')
+        self.assertEqual(sorted(b), ['DATA.BIN', 'MAIN.C'])
+        main_c = b'int main()\r\n{\r\n}\r\n' * 2000
+        self.assertEqual(b['MAIN.C'].rstrip(b'\x1a'), main_c)
+        self.assertEqual(len(b['MAIN.C']), -(-len(main_c) // 128) * 128)
+        self.assertEqual(b['DATA.BIN'][:300], b'\n' * 300)
+        # Text mode without eol_convert still ends at the ^Z
+        self.assertEqual(files('C')['STDIO.H'].rstrip(b'\x1a'), b'#define EOF -1\n')
+
+
+class TestVerify(unittest.TestCase):
+    """Tests for the verify command's directory and allocation checks."""
+
+    def setUp(self):
+        self.data = create_hd1k_disk()
+        self.disk = Hd1kDisk(self.data)
+        self.disk.add_files([('BIG.DAT', os.urandom(70000)), ('SMALL.TXT', b'hi')], quiet=True)
+        self.diskdef = DISKDEFS['wbw_hd1k']
+
+    def entry_offset(self, name, extent=0):
+        extents = self.disk.directory.lookup(0, cpm_disk.cpm_filename_to_83(name))
+        return self.disk.dir_entry_offsets[extents[extent].slot]
+
+    def kinds(self):
+        return sorted({p['kind'] for p in verify_volume(self.data, self.diskdef)['problems']})
+
+    def test_clean_image(self):
+        report = verify_volume(self.data, self.diskdef)
+        self.assertEqual(report['problems'], [])
+        self.assertEqual((report['files'], report['entries']), (2, 4))
+
+    def test_block_pointer_damage(self):
+        big = self.entry_offset('BIG.DAT')
+        small = self.entry_offset('SMALL.TXT')
+        self.data[small + 16:small + 18] = self.data[big + 16:big + 18]
+        self.data[big + 18:big + 20] = struct.pack('<H', 5000)
+        self.data[big + 20:big + 22] = struct.pack('<H', 3)
+        self.assertEqual(self.kinds(), ['double-allocated', 'out-of-range', 'reserved-block'])
+
+    def test_extent_damage(self):
+        self.data[self.entry_offset('BIG.DAT', 1)] = 0xE5
+        small = self.entry_offset('SMALL.TXT')
+        self.data[small + 15] = 40
+        self.data[small + 1] = 0x01
+        self.assertEqual(self.kinds(), ['extent-gap', 'orphaned'])
+        self.data[small + 1] = ord('S')
+        self.assertEqual(self.kinds(), ['extent-gap', 'rc-mismatch'])
+
+    def test_command_exit_status(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'c.img')
+            create_image_file(path, 'combo')
+            args = argparse.Namespace(disk=path, json=True, slice=None, diskdef=None,
+                                      sssd=False, combo=False, no_skew=False)
+            with mock.patch('sys.stdout'):
+                self.assertEqual(cmd_verify(args), 0)
+            with DiskImage(path, writable=True) as image, mock.patch('sys.stdout'):
+                ComboDisk(image, 3).add_file('A.COM', b'x' * 5000)
+                offset = ComboDisk(image, 3).dir_entry_offsets[0]
+                image[offset + 15] = 0x90
+                image.commit()
+            with mock.patch('sys.stdout'):
+                self.assertEqual(cmd_verify(args), 1)
+
+
+class TestCompact(unittest.TestCase):
+    """Tests for defragmenting an image with compact."""
+
+    def fragmented(self, disk_class, create):
+        data = create()
+        disk = disk_class(data)
+        blocksize = disk.diskdef.blocksize
+        files = {f'F{i}.DAT': os.urandom(blocksize * (i % 3 + 1) - 7) for i in range(8)}
+        disk.add_files(sorted(files.items()), quiet=True)
+        for name in ('F1.DAT', 'F4.DAT', 'F6.DAT'):
+            disk.delete_file(name)
+            del files[name]
+        files['BIG.DAT'] = os.urandom(blocksize * 5)
+        disk.add_file('BIG.DAT', files['BIG.DAT'])
+        return data, files
+
+    def check_compact(self, disk_class, data, files):
+        disk = disk_class(data)
+        self.assertEqual(verify_volume(data, disk.diskdef)['problems'], [])
+        extents = sorted(disk.directory.files.values(), key=lambda e: min(x.slot for x in e))
+        blocks = [b for file_extents in extents for e in file_extents for b in e.blocks]
+        start = disk.diskdef.dir_blocks
+        self.assertEqual(blocks, list(range(start, start + len(blocks))))
+        for name, content in files.items():
+            self.assertEqual(disk.extract_file(name)[:len(content)], content)
+
+    def test_compacts_fragmented_disks(self):
+        for disk_class, create in ((Hd1kDisk, create_hd1k_disk), (SssdDisk, create_sssd_disk)):
+            with self.subTest(disk_class.__name__), mock.patch('sys.stdout'):
+                data, files = self.fragmented(disk_class, create)
+                passes = compact_plan(disk_class(data))
+                self.assertTrue(passes)
+                apply_compaction(disk_class(data), passes)
+                self.check_compact(disk_class, data, files)
+                self.assertEqual(compact_plan(disk_class(data)), [])
+
+    def test_interrupted_run_stays_consistent(self):
+        with mock.patch('sys.stdout'):
+            data, files = self.fragmented(Hd1kDisk, create_hd1k_disk)
+        snapshots = []
+        apply_compaction(Hd1kDisk(data), compact_plan(Hd1kDisk(data)),
+                         commit=lambda: snapshots.append(bytes(data)))
+        self.assertGreater(len(snapshots), 2)
+        for snapshot in snapshots:
+            disk = Hd1kDisk(bytearray(snapshot))
+            self.assertEqual(verify_volume(disk.data, disk.diskdef)['problems'], [])
+            for name, content in files.items():
+                self.assertEqual(disk.extract_file(name)[:len(content)], content)
+
+    def test_swapped_files_use_a_spare_block(self):
+        data = create_hd1k_disk()
+        disk = Hd1kDisk(data)
+        files = {'A.DAT': os.urandom(8192), 'B.DAT': os.urandom(8192)}
+        disk.add_files(sorted(files.items()), quiet=True)
+        a, b = disk.dir_entry_offsets[0], disk.dir_entry_offsets[1]
+        data[a:a + 32], data[b:b + 32] = data[b:b + 32], data[a:a + 32]
+        passes = compact_plan(Hd1kDisk(data))
+        self.assertEqual(sum(count for runs in passes for _, _, count in runs), 6)
+        self.assertEqual([len(runs) for runs in passes], [1, 1, 1])
+        apply_compaction(Hd1kDisk(data), passes)
+        self.check_compact(Hd1kDisk, data, files)
+
+
+class TestDiff(unittest.TestCase):
+    """Tests for mapping image differences back to files."""
+
+    def test_diff_volume_classifies_files(self):
+        before = create_hd1k_disk()
+        disk = Hd1kDisk(before)
+        with mock.patch('sys.stdout'):
+            disk.add_files([('KEEP.COM', os.urandom(9000)), ('EDIT.DAT', os.urandom(20000)),
+                            ('GONE.TXT', b'bye'), ('MOVE.DAT', os.urandom(5000))])
+        after = bytearray(before)
+        disk = Hd1kDisk(after)
+        disk.delete_file('GONE.TXT')
+        disk.write_block(disk.directory.lookup(0, 'EDIT    DAT')[0].blocks[1], b'x' * 4096)
+        with mock.patch('sys.stdout'):
+            disk.add_file('NEW.COM', b'n' * 5000)
+        apply_compaction(Hd1kDisk(after), compact_plan(Hd1kDisk(after)))
+        after[100] ^= 0xFF
+
+        result = diff_volume(before, after, DISKDEFS['wbw_hd1k'], changed_chunks(before, after),
+                             lambda: (Hd1kDisk(before), Hd1kDisk(after)))
+        self.assertTrue(result['boot'])
+        self.assertTrue(result['directory'])
+        self.assertEqual(result['added'], [{'file': '0:NEW.COM', 'size': 5120}])
+        self.assertEqual(result['removed'], [{'file': '0:GONE.TXT', 'size': 128}])
+        self.assertEqual(result['modified'], [{'file': '0:EDIT.DAT', 'old_size': 20096,
+                                               'size': 20096, 'blocks_changed': 1}])
+        self.assertEqual(result['moved'], [{'file': '0:MOVE.DAT'}])
+
+    def test_command_compares_every_slice(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            a = os.path.join(tmpdir, 'a.img')
+            b = os.path.join(tmpdir, 'b.img')
+            create_image_file(a, 'combo')
+            create_image_file(b, 'combo')
+            args = argparse.Namespace(disk=a, other=b, json=False, slice=None, diskdef=None,
+                                      sssd=False, combo=False, no_skew=False)
+            with mock.patch('sys.stdout'):
+                self.assertEqual(cmd_diff(args), 0)
+            with DiskImage(b, writable=True) as image, mock.patch('sys.stdout'):
+                ComboDisk(image, 4).add_file('A.COM', b'x' * 5000)
+                image.commit()
+            with mock.patch('sys.stdout') as stdout:
+                self.assertEqual(cmd_diff(args), 1)
+            output = ''.join(call.args[0] for call in stdout.write.call_args_list)
+            self.assertIn("Slice 4:\n  + 0:A.COM (5120 bytes)", output)
+            self.assertNotIn("Slice 0", output)
+            with mock.patch.object(cpm_disk, 'get_disk_object',
+                                   side_effect=get_disk_object) as opened, mock.patch('sys.stdout'):
+                cmd_diff(args)
+            self.assertEqual({call.args[2] for call in opened.call_args_list}, {4})
+
+
+class TestOverlay(unittest.TestCase):
+    """Tests for copy-on-write overlay images."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self.tmpdir.name, 'base.img')
+        self.overlay = os.path.join(self.tmpdir.name, 'jobs', 'job.cow')
+        os.mkdir(os.path.dirname(self.overlay))
+        create_image_file(self.base, 'hd1k')
+        with DiskImage(self.base, writable=True) as image, mock.patch('sys.stdout'):
+            Hd1kDisk(image).add_file('BASE.COM', b'b' * 6000)
+            image.commit()
+        with open(self.base, 'rb') as f:
+            self.pristine = f.read()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def base_bytes(self):
+        with open(self.base, 'rb') as f:
+            return f.read()
+
+    def add_to_overlay(self, name, data):
+        with open_image(self.overlay, writable=True) as image, mock.patch('sys.stdout'):
+            Hd1kDisk(image).add_file(name, data)
+            image.commit()
+
+    def overlay_files(self):
+        with open_image(self.overlay) as image:
+            return sorted(name for _, name in Hd1kDisk(image).list_files())
+
+    def test_writes_stay_in_overlay(self):
+        self.assertLessEqual(create_overlay(self.base, self.overlay), 8192)
+        self.add_to_overlay('JOB.COM', b'j' * 3000)
+        self.assertEqual(self.base_bytes(), self.pristine)
+        self.assertEqual(self.overlay_files(), ['BASE.COM', 'JOB.COM'])
+        with open_image(self.overlay) as image:
+            self.assertEqual(Hd1kDisk(image).extract_file('BASE.COM')[:6000], b'b' * 6000)
+            self.assertEqual(len(image), len(self.pristine))
+            self.assertEqual(len(image.stored_granules()), 2)
+        self.assertLess(os.stat(self.overlay).st_blocks * 512, 64 * 1024)
+
+        with mock.patch('sys.stdout'):
+            cmd_overlay_discard(argparse.Namespace(overlay=self.overlay))
+        self.assertEqual(self.overlay_files(), ['BASE.COM'])
+
+    def test_commit_into_base(self):
+        create_overlay(self.base, self.overlay)
+        other = os.path.join(self.tmpdir.name, 'other.cow')
+        create_overlay(self.base, other)
+        self.add_to_overlay('JOB.COM', b'j' * 3000)
+        with mock.patch('sys.stdout'):
+            cmd_overlay_commit(argparse.Namespace(overlay=self.overlay))
+        with DiskImage(self.base) as image:
+            self.assertEqual(Hd1kDisk(image).extract_file('JOB.COM')[:3000], b'j' * 3000)
+        with open_image(self.overlay) as image:
+            self.assertEqual(image.stored_granules(), [])
+        self.assertEqual(self.overlay_files(), ['BASE.COM', 'JOB.COM'])
+        with self.assertRaisesRegex(ValueError, 'has changed'):
+            open_image(other)
+
+    def test_failed_open_closes_base(self):
+        create_overlay(self.base, self.overlay)
+        bases = []
+
+        def open_base(path, writable=False):
+            # Open the base, then remove the overlay so opening it fails
+            bases.append(open_image(path, writable))
+            os.unlink(self.overlay)
+            return bases[0]
+
+        with mock.patch.object(cpm_disk, 'open_image', open_base):
+            with self.assertRaises(FileNotFoundError):
+                cpm_disk.OverlayImage(self.overlay)
+        self.assertIsNone(bases[0]._map)
+
+
+class TestSliceCopy(unittest.TestCase):
+    """Tests for moving slices between combo and hd1k images."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.combo = os.path.join(self.tmpdir.name, 'combo.img')
+        create_image_file(self.combo, 'combo')
+        with DiskImage(self.combo, writable=True) as image, mock.patch('sys.stdout'):
+            ComboDisk(image, 2).add_file('TWO.COM', b'2' * 9000)
+            image.commit()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def files(self, path, slice_num=0):
+        with open_image(path) as image:
+            return sorted(name for _, name in get_disk_object(image, None, slice_num).list_files())
+
+    def test_export_import_and_copy(self):
+        single = self.path('two.img')
+        copy_slice(self.combo, 2, single, 0, create=True)
+        self.assertEqual(os.path.getsize(single), cpm_disk.HD1K_SINGLE_SIZE)
+        self.assertEqual(self.files(single), ['TWO.COM'])
+
+        other = self.path('other.img')
+        create_image_file(other, 'combo')
+        self.assertEqual(copy_slice(single, 0, other, 5), cpm_disk.HD1K_SLICE_SIZE)
+        copy_slice(self.combo, 2, other, 1)
+        copy_slice(other, 5, other, 0)
+        for slice_num, expected in ((0, ['TWO.COM']), (1, ['TWO.COM']), (2, []), (5, ['TWO.COM'])):
+            self.assertEqual(self.files(other, slice_num), expected)
+        with DiskImage(other) as image:
+            self.assertEqual(ComboDisk(image, 5).extract_file('TWO.COM')[:9000], b'2' * 9000)
+
+    def test_rejects_bad_slices(self):
+        with self.assertRaisesRegex(ValueError, 'out of range'):
+            copy_slice(self.combo, 6, self.path('x.img'), 0, create=True)
+        with self.assertRaisesRegex(ValueError, 'same slice'):
+            copy_slice(self.combo, 2, self.combo, 2)
+        with DiskImage(self.combo, writable=True) as image:
+            offset = ComboDisk(image, 2).dir_entry_offsets[0]
+            image[offset + 15] = 0x99
+            image.commit()
+        with self.assertRaisesRegex(ValueError, 'directory problem'):
+            copy_slice(self.combo, 2, self.combo, 3)
+
+    def test_failed_import_restores_slice(self):
+        single = self.path('two.img')
+        copy_slice(self.combo, 2, single, 0, create=True)
+        with DiskImage(self.combo, writable=True) as image, mock.patch('sys.stdout'):
+            ComboDisk(image, 3).add_file('OLD.COM', b'3' * 5000)
+            image.commit()
+        offset = cpm_disk.HD1K_MBR_PREFIX + 3 * cpm_disk.HD1K_SLICE_SIZE
+
+        def slice_bytes():
+            with open(self.combo, 'rb') as f:
+                f.seek(offset)
+                return f.read(cpm_disk.HD1K_SLICE_SIZE)
+
+        original = slice_bytes()
+        source_ino = os.stat(single).st_ino
+        real_copy_range = cpm_disk.copy_range
+
+        def copy_then_fail(fd_in, fd_out, offset_in, offset_out, length):
+            real_copy_range(fd_in, fd_out, offset_in, offset_out, length)
+            if os.fstat(fd_in).st_ino == source_ino:
+                raise OSError("disk full")
+
+        with mock.patch.object(cpm_disk, 'copy_range', copy_then_fail):
+            with self.assertRaisesRegex(OSError, 'disk full'):
+                copy_slice(single, 0, self.combo, 3)
+        self.assertEqual(slice_bytes(), original)
+
+        real_check = cpm_disk.check_slice
+
+        def fail_after_copy(disk_data, offset, what):
+            if 'after the copy' in what:
+                raise ValueError(f"{what} has 1 directory problem(s)")
+            real_check(disk_data, offset, what)
+
+        with mock.patch.object(cpm_disk, 'check_slice', fail_after_copy):
+            with self.assertRaisesRegex(ValueError, 'after the copy'):
+                copy_slice(single, 0, self.combo, 3)
+        self.assertEqual(slice_bytes(), original)
+        self.assertEqual(self.files(self.combo, 3), ['OLD.COM'])
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ['combo.img', 'two.img'])
+
+    def test_failed_export_removes_output(self):
+        single = self.path('two.img')
+        with mock.patch.object(cpm_disk, 'copy_range', side_effect=OSError("disk full")):
+            with self.assertRaisesRegex(OSError, 'disk full'):
+                copy_slice(self.combo, 2, single, 0, create=True)
+        self.assertFalse(os.path.exists(single))
+
+
+class TestStats(unittest.TestCase):
+    """Tests for the --stats counters."""
+
+    def test_counters_follow_disk_operations(self):
+        self.assertIsNone(cpm_disk.STATS)
+        stats = cpm_disk.DiskStats()
+        with mock.patch.object(cpm_disk, 'STATS', stats):
+            disk = SssdDisk(create_sssd_disk())
+            disk.add_file("TEST.COM", b"x" * 3000)
+            self.assertEqual(disk.extract_file("TEST.COM"), b"x" * 3000 + b"\x1a" * 72)
+
+        self.assertEqual(stats.dir_entries_scanned, 64)
+        self.assertEqual(stats.dir_entries_written, 1)
+        self.assertEqual(stats.blocks_read, 2 + 3)  # directory, then the file
+        self.assertEqual(stats.blocks_written, 3)
+        self.assertEqual(stats.sectors_written, 3 * 8 + 1)
+        self.assertEqual(stats.alloc_searches, 1)
+        self.assertIn('directory', stats.phases)
+
+
+class TestBenchmarks(unittest.TestCase):
+    """Tests for the benchmark runner and its baseline comparison."""
+
+    def test_run_records_each_benchmark(self):
+        results = bench_cpm_disk.run_benchmarks(
+            formats=['sssd'], mixes=['small'], levels=['full'], repeat=1, log=None)
+        keys = sorted(results['results'])
+        self.assertEqual(len(keys), len(bench_cpm_disk.OPERATIONS))
+        self.assertEqual(results['results']['sssd/small/full/list']['entries'], 64)
+
+    def test_failed_add_fails_the_run(self):
+        with tempfile.TemporaryDirectory() as workdir, mock.patch('sys.stdout'):
+            scenario = bench_cpm_disk.Scenario('sssd', 'small', 'empty', 2, workdir)
+            scenario.prepare('add')
+            with mock.patch.object(CpmDisk, 'add_files', return_value=False):
+                with self.assertRaisesRegex(ValueError, 'add failed'):
+                    scenario.run('add')
+
+    def test_compare_flags_slowdowns_past_threshold(self):
+        def doc(**seconds):
+            return {'results': {key: {'seconds': value} for key, value in seconds.items()}}
+        baseline = doc(a=0.010, b=0.010, c=0.0001, d=0.010)
+        current = doc(a=0.011, b=0.020, c=0.0009, e=0.5)
+        rows, regressions, missing = bench_cpm_disk.compare_results(baseline, current,
+                                                                    threshold=0.25)
+        self.assertEqual([row[0] for row in rows], ['a', 'b', 'c'])
+        # c is 9x slower but under the noise floor
+        self.assertEqual(regressions, ['b'])
+        self.assertEqual(missing, ['d'])
+
+    def test_missing_benchmark_fails_comparison(self):
+        def doc(**seconds):
+            return {'results': {key: {'seconds': value} for key, value in seconds.items()}}
+        baseline = doc(a=0.010, d=0.010)
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+            status = bench_cpm_disk.report_comparison(baseline, doc(a=0.010), 0.25, 0.001)
+        self.assertEqual(status, 1)
+        self.assertIn('MISSING', out.getvalue())
+        self.assertIn('1 baseline benchmark(s) missing', out.getvalue())
+        with mock.patch('sys.stdout'):
+            self.assertEqual(bench_cpm_disk.report_comparison(
+                baseline, doc(a=0.010, d=0.010), 0.25, 0.001), 0)
+
+
 if __name__ == '__main__':
     unittest.main()